@@ -0,0 +1,146 @@
+import json
+import select
+import socket
+import sys
+from time import monotonic, sleep
+
+from core import GPIO, DEFAULT_AGENT_PORT, init_gpio
+
+# Longest wait between reconnection attempts, in seconds
+MAX_RECONNECT_DELAY = 30
+# An empty batch is sent this often so a dead connection is noticed
+HEARTBEAT_INTERVAL = 5.0
+
+
+class GpioAgent:
+    # Runs on a secondary Pi: samples its pins and streams the changes to the
+    # main app (RemoteGPIO in core.py), where they show up as "node:pin".
+    # Changes within one interval are sent as one batch with a sequence
+    # number. Every (re)connection starts with the full state, the main app
+    # asks for it again if it sees a gap in the sequence. A main app reachable
+    # beyond its own Pi only accepts agents that send its token.
+    def __init__(self, node, host, port=DEFAULT_AGENT_PORT, pins=(), interval=.05, gpio=None, token=None):
+        self.node = node
+        self.token = token
+        self.host = host
+        self.port = port
+        self.pins = sorted(pins)
+        self.interval = interval
+        self.gpio = gpio or GPIO
+        self.seq = 0
+        self.running = False
+        self.sock = None
+        self.sent = {}
+
+        for pin in self.pins:
+            self.gpio.setup(pin, self.gpio.IN, pull_up_down=self.gpio.PUD_DOWN)
+
+    def run(self):
+        self.running = True
+        delay = 1
+        while self.running:
+            try:
+                self.connect()
+                delay = 1
+                self.stream()
+            except OSError as e:
+                if self.running:
+                    print(f"Connection to {self.host}:{self.port} lost: {e}, retrying in {delay} s")
+            finally:
+                self.disconnect()
+            if self.running:
+                sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def stop(self):
+        self.running = False
+        self.disconnect()
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=5)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_state()
+        print(f"Agent '{self.node}' connected to {self.host}:{self.port}, {len(self.pins)} pins")
+
+    def disconnect(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def send(self, message):
+        self.seq += 1
+        message["seq"] = self.seq
+        self.sock.sendall(json.dumps(message, separators=(",", ":")).encode() + b"\n")
+
+    def send_state(self):
+        self.sent = self.gpio.read_snapshot(self.pins)
+        hello = {"type": "hello", "node": self.node, "state": self.sent}
+        if self.token is not None:
+            hello["token"] = self.token
+        self.send(hello)
+
+    def stream(self):
+        last_send = monotonic()
+        while self.running:
+            if self.resync_requested():
+                self.send_state()
+                last_send = monotonic()
+
+            values = self.gpio.read_snapshot(self.pins)
+            changes = {pin: value for pin, value in values.items() if self.sent.get(pin) != value}
+            if changes or monotonic() - last_send >= HEARTBEAT_INTERVAL:
+                self.send({"type": "delta", "changes": changes})
+                self.sent.update(changes)
+                last_send = monotonic()
+            sleep(self.interval)
+
+    def resync_requested(self):
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        if not readable:
+            return False
+        data = self.sock.recv(4096)
+        if not data:
+            raise ConnectionResetError("main app closed the connection")
+        return b"resync" in data
+
+
+if __name__ == "__main__":
+    # python3 agent.py --node=pi2 --main=192.168.1.10[:8766] --pins=17,27,22 [--interval=0.05] [--agent-token=SECRET]
+    node = socket.gethostname()
+    host = None
+    port = DEFAULT_AGENT_PORT
+    pins = []
+    interval = .05
+    token = None
+
+    for arg in sys.argv[1:]:
+        if arg.startswith("--node="):
+            node = arg.split("=")[1]
+        elif arg.startswith("--main="):
+            host = arg.split("=")[1]
+            if ":" in host:
+                host, port = host.rsplit(":", 1)
+                port = int(port)
+        elif arg.startswith("--pins="):
+            pins = [int(pin) for pin in arg.split("=")[1].split(",") if pin]
+        elif arg.startswith("--interval="):
+            interval = float(arg.split("=")[1])
+        elif arg.startswith("--agent-token="):
+            token = arg.split("=", 1)[1]
+
+    if not host or not pins:
+        print("Usage: python3 agent.py --main=HOST[:PORT] --pins=17,27 [--node=NAME] [--interval=0.05] [--agent-token=SECRET]")
+        sys.exit(1)
+
+    init_gpio("gpiod" if "--gpiod" in sys.argv else None)
+    agent = GpioAgent(node, host, port, pins, interval, token=token)
+    try:
+        agent.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent.stop()
+        GPIO.cleanup()
@@ -1,414 +1,196 @@
-import platform
-import sys
-import random
-import tkinter as tk
-from tkinter import simpledialog, filedialog
-import json
-from time import sleep
-from threading import Thread
+from time import monotonic, perf_counter
 
-is_raspberry_pi = platform.machine().startswith('aarch64')
-print(f"Running on a Raspberry Pi: {is_raspberry_pi}")
-print(platform.machine())
-
-if is_raspberry_pi:
-    import RPi.GPIO as RealGPIO
-
-    class GPIOWrapper:
-        def __init__(self):
-            self.simulating = False
-            self.BCM = RealGPIO.BCM
-            self.IN = RealGPIO.IN
-            self.OUT = RealGPIO.OUT
-            self.PUD_DOWN = RealGPIO.PUD_DOWN
-            self.PUD_UP = RealGPIO.PUD_UP
-            self.HIGH = RealGPIO.HIGH
-            self.LOW = RealGPIO.LOW
-            self.mock_values = {}
-
-        def set_simulating(self, simulating):
-            self.simulating = simulating
-
-        def set_mock_value(self, pin, value):
-            self.mock_values[pin] = value
-
-        def input(self, pin):
-            if self.simulating:
-                value = self.mock_values.get(pin, self.LOW)
-                print(f"GPIO: Reading pin {pin}: {'HIGH' if value == self.HIGH else 'LOW'}")
-                return value
-            return RealGPIO.input(pin)
-
-        # Implement other necessary methods, forwarding them to RealGPIO
-        def setmode(self, mode):
-            RealGPIO.setmode(mode)
-
-        def setup(self, pin, mode, pull_up_down=None):
-            if pull_up_down:
-                RealGPIO.setup(pin, mode, pull_up_down=pull_up_down)
-            else:
-                RealGPIO.setup(pin, mode)
-
-        def cleanup(self):
-            RealGPIO.cleanup()
-
-    GPIO = GPIOWrapper()
-    GPIO.setmode(GPIO.BCM)
-else:
-    print("Not running on a Raspberry Pi. GPIO functionality will be simulated.")
-
-    class MockGPIO:
-        BCM = "BCM"
-        OUT = "OUT"
-        IN = "IN"
-        HIGH = 1
-        LOW = 0
-        PUD_DOWN = "PUD_DOWN"
-        PUD_UP = "PUD_UP"
-        
-        def __init__(self):
-            self.pin_values = {}
-            self.simulating = False
-
-        def setmode(self, mode):
-            print(f"Mock: Setting GPIO mode to {mode}")
-
-        def set_simulating(self, simulating):
-            self.simulating = simulating
-
-        def setwarnings(self, flag):
-            print(f"Mock: Setting warnings to {flag}")
-
-        def setup(self, pin, mode, pull_up_down=None):
-            pull_up_down_str = f" with pull_up_down={pull_up_down}" if pull_up_down else ""
-            print(f"Mock: Setting up GPIO pin {pin} as {'input' if mode == self.IN else 'output'}{pull_up_down_str}")
-            if pin not in self.pin_values:
-                self.pin_values[pin] = self.LOW 
-
-        def input(self, pin):
-            if pin not in self.pin_values:
-                self.pin_values[pin] = self.LOW
-            if self.simulating:
-                value = "HIGH" if self.pin_values[pin] == self.HIGH else "LOW"
-                print(f"Mock: Reading GPIO pin {pin}: {value}")
-            return self.pin_values[pin]
-        
-        def set_mock_value(self, pin, value):
-            self.pin_values[pin] = value
+# Reference point for the --startup-probe time to first frame
+STARTUP = perf_counter()
 
+import os
+import sys
+from threading import Thread
 
-        def cleanup(self, pin=None):
-            if pin is None:
-                print("Mock: Cleaning up all GPIO pins")
+from core import (
+    GPIO, DEFAULT_STATE_PORT, DEFAULT_AGENT_HOST, DEFAULT_AGENT_PORT, DEFAULT_WEB_PORT, Rectangle, Line, Point, Layout, LayoutJournal,
+    AspectEngine, GpioMonitor, StateDeltaQueue, compile_layout, parse_pin, parse_poll_caps, accept_agents, start_pico,
+    enable_profiling, is_loopback, init_gpio, run_headless
+)
+import perf
+
+# Imported by load_tk() once a window is needed, the optional features
+# (recorder, replay, picoserial, trainsim) are imported where they are used
+tk = None
+simpledialog = None
+filedialog = None
+
+# GPIO state and drag updates are rendered at most once per frame (~60 fps)
+FRAME_MS = 16
+# In --autosave mode the edit journal is folded into the layout file this often
+JOURNAL_COMPACT_MS = 60000
+# With --profile the Tk backlog and canvas size are sampled this often
+PROFILE_SAMPLE_MS = 100
+
+
+def load_tk():
+    global tk, simpledialog, filedialog
+    if tk is None:
+        import tkinter as tk
+        from tkinter import simpledialog, filedialog
+    return tk
+
+
+class CanvasScene:
+    # Retained view of the layout on the canvas. Shapes and lines keep their
+    # items between updates, edits mark the objects they touched and flush()
+    # creates, updates or deletes the items of just those, so the cost follows
+    # the size of the change and not of the layout.
+    def __init__(self, canvas, layout):
+        self.canvas = canvas
+        self.layout = layout
+        self.pending = {}
+
+    def mark(self, *objects):
+        for obj in objects:
+            self.pending[obj] = None
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        for obj in pending:
+            if self.contains(obj):
+                self.draw(obj)
             else:
-                print(f"Mock: Cleaning up GPIO pin {pin}")
-
-    GPIO = MockGPIO()
-
-
-class Rectangle:
-    def __init__(self, name, x, y, width, height, gpio=None):
-        self.name = name
-        self.x = x
-        self.y = y
-        self.width = width
-        self.height = height
-        self.gpio = gpio
-        if self.gpio is not None:
-            self.setup_gpio()
-        self.canvas_item = None
-        self.text_item = None
-        self.gpio_text_item = None
-        self.p1_item = None  # Input point (left)
-        self.p2_item = None  # Output point (right)
-        self.points_swapped = False
-        self.update_connection_points()
-
-        self.red_box = None
-        self.blue_box = None
-        self.yellow_box = None
-
-        self.red_signal = False
-        self.blue_signal = False
-        self.yellow_signal = False
-
-    def simulate_gpio(self):
-        return random.choice([GPIO.HIGH, GPIO.LOW])
-
-    def get_gpio_state(self, simulating):
-        if self.gpio is None:
-            return None
-        if simulating:
-            return self.simulate_gpio()
-        else:
-            return GPIO.input(self.gpio)
-
-    def setup_gpio(self):
-        if self.gpio is not None:
-            GPIO.setup(self.gpio, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-
-    def update_gpio(self, new_gpio):
-        if self.gpio is not None:
-            GPIO.cleanup(self.gpio)
-        self.gpio = new_gpio
-        if self.gpio is not None:
-            self.setup_gpio()
-
-    def read_gpio(self):
-        if self.gpio is not None:
-            return GPIO.input(self.gpio)
-        return None
-
-    def update_connection_points(self):
-        if not self.points_swapped:
-            self.p1 = (self.x, self.y + (self.height / 2))
-            self.p2 = (self.x + self.width, self.y + (self.height / 2))
+                self.erase(obj)
+        return len(pending)
+
+    def contains(self, obj):
+        if isinstance(obj, Line):
+            objects = self.layout.lines
+        elif isinstance(obj, Rectangle):
+            objects = self.layout.rectangles
         else:
-            self.p2 = (self.x, self.y + (self.height / 2))
-            self.p1 = (self.x + self.width, self.y + (self.height / 2))
-
-    def set_mock_gpio(self, value):
-        if self.gpio is not None:
-            GPIO.set_mock_value(self.gpio, value)
-
-
-    def update_connection_points(self):
-        if not self.points_swapped:
-            self.p1 = (self.x, self.y + (self.height / 2))
-            self.p2 = (self.x + self.width, self.y + (self.height / 2))
-        else:
-            self.p2 = (self.x, self.y + (self.height / 2))
-            self.p1 = (self.x + self.width, self.y + (self.height / 2))
-
-    def draw(self, canvas):
-        if self.canvas_item:
-            canvas.delete(self.canvas_item)
-        if self.text_item:
-            canvas.delete(self.text_item)
-        if self.gpio_text_item:
-            canvas.delete(self.gpio_text_item)
-        if self.p1_item:
-            canvas.delete(self.p1_item)
-        if self.p2_item:
-            canvas.delete(self.p2_item)
-        if self.red_box:
-            canvas.delete(self.red_box)
-        if self.blue_box:
-            canvas.delete(self.blue_box)
-        if self.yellow_box:
-            canvas.delete(self.yellow_box)
-
-        self.canvas_item = canvas.create_rectangle(
-            self.x, self.y, self.x + self.width, self.y + self.height,
-            outline="black", fill="lightblue"
-        )
-        self.text_item = canvas.create_text(
-            self.x + 5, self.y + 5,
-            text=self.name,
-            anchor="nw",
-            font=("Arial", 10),
-            fill="black"
-        )
-        
-        if self.gpio is not None:
-            self.gpio_text_item = canvas.create_text(
-                self.x + 5, self.y + 20,
-                text=f"gpio: {self.gpio}",
-                anchor="nw",
-                font=("Arial", 8),
-                fill="black"
-            )
-        
-        point_radius = 3
-        self.p1_item = canvas.create_oval(
-            self.p1[0] - point_radius, self.p1[1] - point_radius,
-            self.p1[0] + point_radius, self.p1[1] + point_radius,
-            fill="blue"
-        )
-        self.p2_item = canvas.create_oval(
-            self.p2[0] - point_radius, self.p2[1] - point_radius,
-            self.p2[0] + point_radius, self.p2[1] + point_radius,
-            fill="red"
-        )
-
-        # Draw wider colored boxes with padding
-        box_width = 30
-        box_height = (self.height - 20) / 3
-        box_x = self.x + self.width - box_width - 5
-        box_y = self.y + 10
-
-        self.red_box = canvas.create_rectangle(
-            box_x, box_y, 
-            box_x + box_width, box_y + box_height,
-            fill="red" if self.red_signal else "gray", outline=""
-        )
-        self.blue_box = canvas.create_rectangle(
-            box_x, box_y + box_height, 
-            box_x + box_width, box_y + 2*box_height,
-            fill="blue" if self.blue_signal else "gray", outline=""
-        )
-        self.yellow_box = canvas.create_rectangle(
-            box_x, box_y + 2*box_height, 
-            box_x + box_width, box_y + 3*box_height,
-            fill="yellow" if self.yellow_signal else "gray", outline=""
-        )
-
-    def move_to(self, new_x, new_y):
-        self.x = new_x
-        self.y = new_y
-        self.update_connection_points()
-
-    def resize(self, new_width, new_height):
-        self.width = new_width
-        self.height = new_height
-        self.update_connection_points()
-
-    def switch_points(self):
-        self.points_swapped = not self.points_swapped
-        self.update_connection_points()
-
-    def set_signal(self, color, signal):
-        if color == "red":
-            self.red_signal = signal
-            if self.gpio is not None:
-                if isinstance(GPIO, GPIOWrapper):
-                    GPIO.set_mock_value(self.gpio, GPIO.HIGH if signal else GPIO.LOW)
-                else:
-                    # For MockGPIO
-                    GPIO.set_mock_value(self.gpio, GPIO.HIGH if signal else GPIO.LOW)
-        elif color == "blue":
-            self.blue_signal = signal
-        elif color == "yellow":
-            self.yellow_signal = signal
-        else:
-            raise ValueError("Invalid color. Use 'red', 'blue', or 'yellow'.")
-
-    def get_signal(self, color):
-        if color == "red":
-            return self.red_signal
-        elif color == "blue":
-            return self.blue_signal
-        elif color == "yellow":
-            return self.yellow_signal
-        else:
-            raise ValueError("Invalid color. Use 'red', 'blue', or 'yellow'.")
-        
-    def get_gpio_state(self, simulating):
-        if self.gpio is None:
-            return None
-        return GPIO.input(self.gpio)
-    
-
-class Line:
-    def __init__(self, name, start_shape, end_shape, start_is_output=True):
-        self.name = name
-        self.start_shape = start_shape
-        self.end_shape = end_shape
-        self.start_is_output = start_is_output
-        self.canvas_item = None
-        self.update_coordinates()
-
-    def update_coordinates(self):
-        if isinstance(self.start_shape, Rectangle):
-            self.x1, self.y1 = self.start_shape.p2 if self.start_is_output else self.start_shape.p1
-        else:  # Point
-            self.x1, self.y1 = self.start_shape.x, self.start_shape.y
-
-        if isinstance(self.end_shape, Rectangle):
-            self.x2, self.y2 = self.end_shape.p1 if self.start_is_output else self.end_shape.p2
-        else:  # Point
-            self.x2, self.y2 = self.end_shape.x, self.end_shape.y
-
-    def draw(self, canvas):
-        if self.canvas_item:
-            canvas.delete(self.canvas_item)
-        self.canvas_item = canvas.create_line(
-            self.x1, self.y1, self.x2, self.y2,
-            fill="red", width=2
-        )
+            objects = self.layout.points
+        return objects.get(obj.name) is obj
+
+    def draw(self, obj):
+        created = obj.canvas_item is None
+        obj.draw(self.canvas)
+        if created and isinstance(obj, Line):
+            # Lines stay below the shapes they join
+            self.canvas.tag_lower(obj.canvas_item)
+
+    def erase(self, obj):
+        if obj.canvas_item is not None:
+            self.canvas.delete(obj.canvas_item if isinstance(obj, Line) else obj.tag)
+        obj.forget_canvas_items()
+
+    def rebuild(self, previous=None):
+        # After the layout was replaced, e.g. loaded. previous holds the old
+        # (lines, rectangles, points) dicts: a new object takes over the items
+        # of the old one with its name and the old leftovers are deleted.
+        # Without it the canvas is cleared and drawn from scratch.
+        self.pending.clear()
+        current = (self.layout.lines, self.layout.rectangles, self.layout.points)
+        if previous is None:
+            self.canvas.delete("all")
+            for objects in current:
+                for obj in objects.values():
+                    obj.forget_canvas_items()
+            previous = ({}, {}, {})
+
+        for old_objects, objects in zip(previous, current):
+            old_objects = dict(old_objects)
+            for name, obj in objects.items():
+                old = old_objects.pop(name, None)
+                if old is not None and old is not obj and old.canvas_item is not None:
+                    obj.take_canvas_items(old)
+                self.draw(obj)
+            for old in old_objects.values():
+                self.erase(old)
+
+    def clear(self):
+        self.canvas.delete("all")
+        self.pending.clear()
 
-class Point:
-    def __init__(self, name, x, y):
-        self.name = name
-        self.x = x
-        self.y = y
-        self.canvas_item = None
-        self.text_item = None
-        self.is_visible = True
-
-    def draw(self, canvas):
-        if self.canvas_item:
-            canvas.delete(self.canvas_item)
-        if self.text_item:
-            canvas.delete(self.text_item)
-
-        if self.is_visible:
-            point_radius = 3
-            self.canvas_item = canvas.create_oval(
-                self.x - point_radius, self.y - point_radius,
-                self.x + point_radius, self.y + point_radius,
-                fill="black"
-            )
-            self.text_item = canvas.create_text(
-                self.x, self.y - 15,
-                text=self.name,
-                anchor="center",
-                font=("Arial", 8),
-                fill="black"
-            )
-
-    def move_to(self, new_x, new_y):
-        self.x = new_x
-        self.y = new_y
-
-    def toggle_visibility(self):
-        self.is_visible = not self.is_visible
-
-    # Addded these methods to make Points compatible with the existing Rectangle interface
-    @property
-    def width(self):
-        return 0
-
-    @property
-    def height(self):
-        return 0
-
-    @property
-    def p1(self):
-        return (self.x, self.y)
-
-    @property
-    def p2(self):
-        return (self.x, self.y)
 
 class DrawingApp:
-    def __init__(self, master, live_mode=False, load_file=True):
+    def __init__(self, master, live_mode=False, load_file=True, edge_events=True, canvas=None, autosave=False, record_file=None, aspects=True, agent_port=None, pico_device=None,
+                 profile_interval=None, poll_caps=None, sampler_process=False, runtime=None, web_port=None, agent_host=DEFAULT_AGENT_HOST, agent_token=None):
         self.master = master
+        # An AsyncRuntime (runtime.py) pumps Tk and runs the I/O, otherwise
+        # master.mainloop() and threads do
+        self.runtime = runtime
         self.live_mode = live_mode
+        self.edge_events = edge_events
+        self.autosave = autosave
+        self.journal = None
         self.default_canvas_file = "qq.json"
 
         self.simulating = False
         
-        self.canvas = tk.Canvas(self.master, width=800, height=600, bg="white")
+        # A canvas can be passed in, e.g. a stub for benchmarks without a display
+        if canvas is None or not live_mode:
+            load_tk()
+        self.canvas = canvas or tk.Canvas(self.master, width=800, height=600, bg="white")
         self.canvas.pack()
         
-        self.rectangles = {}
-        self.lines = {}
-        self.points = {}
+        # The model lives in core.Layout, these are the same dicts
+        self.layout = Layout()
+        self.rectangles = self.layout.rectangles
+        self.lines = self.layout.lines
+        self.points = self.layout.points
+        # What is on the canvas, see update_canvas()
+        self.scene = CanvasScene(self.canvas, self.layout)
+        # Blue/yellow follow the occupancy downstream unless set by hand
+        self.aspects = AspectEngine(self.layout) if aspects else None
 
         self.dragged_shape = None
         self.drag_start_x = 0
         self.drag_start_y = 0
+        self.drag_target = None
+        self.drag_frame = None
+        self.drag_origin = None
         self.temp_connections = []
 
-        self.polling = False
-        self.poll_thread = None
+        # Pins of other Pis ("node:pin") come in through agents, see agent.py
+        if agent_port is not None:
+            accept_agents(agent_port, runtime, agent_host, agent_token)
+        self.pico_reader = None
+        if pico_device:
+            self.pico_reader = start_pico(pico_device, runtime)
+        # With sampler_process the pins are read in another process, see sampler.py
+        self.monitor = GpioMonitor(self.layout, edge_events=edge_events, pin_caps=poll_caps, sampler_process=sampler_process, runtime=runtime)
+        self.state_queue = StateDeltaQueue()
+        self.last_frame = 0
+        self.frame_requested = None
+
+        self.profile_interval = profile_interval
+        if profile_interval:
+            enable_profiling()
+            perf.instrument(self, "update_canvas", "update_canvas")
+            perf.instrument(self, "render_frame", "render_frame")
+            self.last_profile_dump = monotonic()
+            self.master.after(PROFILE_SAMPLE_MS, self.profile_tick)
+        self.monitor.add_listener(self.on_pin_change)
+
+        # Browsers can follow the layout and its signals, see webview.py
+        self.viewers = None
+        self.viewer_refresh = None
+        if web_port is not None:
+            from webview import WebViewer
+            self.viewers = WebViewer(self.layout, port=web_port, runtime=runtime)
+
+        # Optional on-disk trace of every pin transition, see recorder.py
+        self.recorder = None
+        if record_file:
+            from recorder import TransitionRecorder
+            self.recorder = TransitionRecorder(record_file)
+            self.recorder.attach(self.monitor)
 
         if load_file:
             self.load_canvas(self.default_canvas_file)
         else:
             self.create_initial_setup()
 
+        if self.autosave:
+            self.master.after(JOURNAL_COMPACT_MS, self.periodic_compaction)
+
         if not live_mode:
 
             self.canvas.bind("<ButtonPress-1>", self.on_press)
@@ -498,12 +280,7 @@ class DrawingApp:
         self.update_all_rectangles()
 
     def update_all_rectangles(self):
-            for rect in self.rectangles.values():
-                if rect.gpio is not None:
-                    value = rect.get_gpio_state(self.simulating)
-                    if value is not None:
-                        rect.set_signal("red", value == GPIO.HIGH)
-                        rect.draw(self.canvas)
+            self.monitor.sample(force=True)
 
 
     def load_default_canvas(self):
@@ -524,11 +301,11 @@ class DrawingApp:
         p2 = Point("p2", 500, 400)
 
         for rect in [r1, r2, r3]:
-            self.rectangles[rect.name] = rect
+            self.layout.add_rectangle(rect)
             rect.draw(self.canvas)
 
         for point in [p1, p2]:
-            self.points[point.name] = point
+            self.layout.add_point(point)
             point.draw(self.canvas)
 
         self.connect_shapes("r1", "r2")
@@ -545,103 +322,80 @@ class DrawingApp:
         if file_path:
             self.load_canvas(file_path)
 
-    def save_canvas(self):
-        file_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON files", "*.json")])
+    def save_canvas(self, file_path=None):
+        if file_path is None:
+            file_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON files", "*.json")])
         if not file_path:
             return
 
-        canvas_state = {
-            "rectangles": [],
-            "points": [],
-            "lines": []
-        }
-
-        for rect in self.rectangles.values():
-            canvas_state["rectangles"].append({
-                "name": rect.name,
-                "x": rect.x,
-                "y": rect.y,
-                "width": rect.width,
-                "height": rect.height,
-                "gpio": rect.gpio,  # Save the GPIO pin
-                "points_swapped": rect.points_swapped,
-                "red_signal": rect.red_signal,
-                "blue_signal": rect.blue_signal,
-                "yellow_signal": rect.yellow_signal
-            })
-
-        for point in self.points.values():
-            canvas_state["points"].append({
-                "name": point.name,
-                "x": point.x,
-                "y": point.y,
-                "is_visible": point.is_visible
-            })
-
-        for line in self.lines.values():
-            canvas_state["lines"].append({
-                "name": line.name,
-                "start_shape": line.start_shape.name,
-                "end_shape": line.end_shape.name,
-                "start_is_output": line.start_is_output
-            })
-
-        with open(file_path, 'w') as f:
-            json.dump(canvas_state, f, indent=2)
+        if self.journal and os.path.abspath(file_path) == os.path.abspath(self.journal.layout_path):
+            # Saving over the autosaved file is just an early compaction
+            self.journal.compact(self.layout.to_dict(), wait=True)
+        else:
+            self.layout.save(file_path)
 
         print(f"Canvas state saved to {file_path}")
 
     def load_canvas(self, file_path):
+        previous = (dict(self.lines), dict(self.rectangles), dict(self.points))
         try:
-            with open(file_path, 'r') as f:
-                canvas_state = json.load(f)
-
-            self.clear_canvas()
-
-            for rect_data in canvas_state["rectangles"]:
-                gpio = rect_data.get("gpio")
-                if gpio == 0:
-                    gpio = None
-                rect = Rectangle(
-                    rect_data["name"],
-                    rect_data["x"],
-                    rect_data["y"],
-                    rect_data["width"],
-                    rect_data["height"],
-                    gpio
-                )
-                rect.points_swapped = rect_data["points_swapped"]
-                rect.red_signal = rect_data.get("red_signal", False)
-                rect.blue_signal = rect_data.get("blue_signal", False)
-                rect.yellow_signal = rect_data.get("yellow_signal", False)
-                rect.update_connection_points()
-                self.rectangles[rect.name] = rect
-                rect.draw(self.canvas)
-
-            for point_data in canvas_state.get("points", []):
-                point = Point(point_data["name"], point_data["x"], point_data["y"])
-                point.is_visible = point_data.get("is_visible", True)
-                self.points[point.name] = point
-                if point.is_visible:
-                    point.draw(self.canvas)
-
-            for line_data in canvas_state["lines"]:
-                start_shape = self.rectangles.get(line_data["start_shape"]) or self.points.get(line_data["start_shape"])
-                end_shape = self.rectangles.get(line_data["end_shape"]) or self.points.get(line_data["end_shape"])
-                if start_shape and end_shape:
-                    line = Line(line_data["name"], start_shape, end_shape, line_data["start_is_output"])
-                    self.lines[line.name] = line
-                    line.draw(self.canvas)
-
-            print(f"Canvas state loaded from {file_path}")
+            # Parsed, validated and built first, the canvas is only touched after
+            self.layout.load(file_path)
         except Exception as e:
             print(f"Error loading canvas from {file_path}: {str(e)}")
+            return
+
+        if self.aspects:
+            self.aspects.refresh()
+        # Shapes that kept their name reuse their canvas items
+        self.scene.rebuild(previous)
+        self.monitor.refresh()
+        self.layout_edited()
+        print(f"Canvas state loaded from {file_path}")
+
+        if self.autosave:
+            self.open_journal(file_path)
+
+    def open_journal(self, file_path):
+        if self.journal:
+            # The previous file plus its journal is already complete on disk
+            self.journal.close()
+        self.journal = LayoutJournal(file_path)
+        if self.journal.pending():
+            # Fold whatever was recovered on load into a fresh snapshot
+            self.journal.compact(self.layout.to_dict())
+        print(f"Autosaving edits to {self.journal.path}")
+
+    def record_edit(self, op, **fields):
+        # Every shape edit passes here, signals reach viewers as deltas instead
+        if op != "signal":
+            self.layout_edited()
+        if self.journal and self.journal.append(op, **fields):
+            self.compact_journal()
+
+    def layout_edited(self):
+        # Viewers get the whole layout once per user action, however many
+        # shapes it edited, from the first idle moment after it
+        if self.viewers and not self.viewer_refresh:
+            self.viewer_refresh = self.master.after_idle(self.refresh_viewers)
+
+    def refresh_viewers(self):
+        self.viewer_refresh = None
+        self.viewers.refresh()
+
+    def compact_journal(self):
+        if self.journal and self.journal.pending():
+            self.journal.compact(self.layout.to_dict())
+
+    def periodic_compaction(self):
+        self.compact_journal()
+        self.master.after(JOURNAL_COMPACT_MS, self.periodic_compaction)
 
 
     def clear_canvas(self):
-        self.canvas.delete("all")
-        self.rectangles.clear()
-        self.lines.clear()
+        self.scene.clear()
+        self.layout.clear()
+        self.layout_edited()
 
     def prompt_add_edit_rectangle(self):
         name = simpledialog.askstring("Input", "Enter the name of the rectangle (new or existing):", parent=self.master)
@@ -655,22 +409,27 @@ class DrawingApp:
         y = simpledialog.askinteger("Input", f"Enter y coordinate for {name}:", parent=self.master, initialvalue=rectangle.y if rectangle else 0)
         width = simpledialog.askinteger("Input", f"Enter width for {name}:", parent=self.master, initialvalue=rectangle.width if rectangle else 50)
         height = simpledialog.askinteger("Input", f"Enter height for {name}:", parent=self.master, initialvalue=rectangle.height if rectangle else 50)
-        gpio = simpledialog.askinteger("Input", f"Enter GPIO pin for {name} (or 0 for none):", parent=self.master, initialvalue=rectangle.gpio if rectangle else 0)
-        
-        if gpio == 0:
-            gpio = None
+        gpio = simpledialog.askstring("Input", f"Enter GPIO pin for {name}, node:pin for another Pi (or 0 for none):", parent=self.master, initialvalue=rectangle.gpio if rectangle else 0)
+
+        try:
+            gpio = parse_pin(gpio) or None
+        except ValueError as e:
+            print(f"Operation cancelled: {e}")
+            return
 
         if all(value is not None for value in (x, y, width, height)):
             if rectangle:
-                rectangle.x, rectangle.y, rectangle.width, rectangle.height = x, y, width, height
+                rectangle.move_to(x, y)
+                rectangle.resize(width, height)
                 rectangle.update_gpio(gpio)
-                rectangle.update_connection_points()
             else:
                 rectangle = Rectangle(name, x, y, width, height, gpio)
-                self.rectangles[name] = rectangle
+                self.layout.add_rectangle(rectangle)
             
             rectangle.draw(self.canvas)
             self.update_connected_lines(rectangle)
+            self.monitor.refresh()
+            self.record_edit("rectangle", name=name, x=x, y=y, width=width, height=height, gpio=gpio)
             print(f"Rectangle '{name}' {'updated' if name in self.rectangles else 'created'}.")
         else:
             print("Operation cancelled or invalid input.")
@@ -696,6 +455,7 @@ class DrawingApp:
                 shape.move_to(new_x, new_y)
                 shape.draw(self.canvas)
                 self.update_connected_lines(shape)
+                self.record_edit("move", name=name, x=new_x, y=new_y)
                 print(f"Rectangle '{name}' moved to ({new_x}, {new_y}).")
             else:
                 print("Move operation cancelled or invalid input.")
@@ -732,6 +492,7 @@ class DrawingApp:
             shape.resize(width, height)
             shape.draw(self.canvas)
             self.update_connected_lines(shape)
+            self.record_edit("resize", name=name, width=width, height=height)
             print(f"Rectangle '{name}' resized.")
         else:
             print("Resize operation cancelled or invalid input.")
@@ -755,7 +516,7 @@ class DrawingApp:
 
         line_name = f"Line_{rect1_name}_to_{rect2_name}"
         new_line = Line(line_name, rect1, rect2, True)
-        self.lines[line_name] = new_line
+        self.add_line(new_line)
         self.update_canvas()
 
     def prompt_disconnect_shapes(self):
@@ -770,12 +531,10 @@ class DrawingApp:
         reverse_line_name = f"Line_{shape2_name}_to_{shape1_name}"
 
         if line_name in self.lines:
-            self.canvas.delete(self.lines[line_name].canvas_item)
-            del self.lines[line_name]
+            self.remove_line(line_name)
             print(f"Disconnected {shape1_name} from {shape2_name}")
         elif reverse_line_name in self.lines:
-            self.canvas.delete(self.lines[reverse_line_name].canvas_item)
-            del self.lines[reverse_line_name]
+            self.remove_line(reverse_line_name)
             print(f"Disconnected {shape2_name} from {shape1_name}")
         else:
             print(f"No connection found between {shape1_name} and {shape2_name}")
@@ -797,6 +556,7 @@ class DrawingApp:
         
         rectangle.switch_points()
         rectangle.draw(self.canvas)
+        self.record_edit("points_swapped", name=name, value=rectangle.points_swapped)
         
         print(f"Switched input and output points for rectangle '{name}' and disconnected all connected lines.")
 
@@ -824,46 +584,73 @@ class DrawingApp:
         if self.live_mode:
             return
         
-        for shape in list(self.rectangles.values()) + list(self.points.values()):
-            if isinstance(shape, Rectangle):
-                if shape.x <= event.x <= shape.x + shape.width and shape.y <= event.y <= shape.y + shape.height:
-                    self.dragged_shape = shape
-                    self.drag_start_x = event.x - shape.x
-                    self.drag_start_y = event.y - shape.y
-                    break
-            elif isinstance(shape, Point):
-                if shape.x - 5 <= event.x <= shape.x + 5 and shape.y - 5 <= event.y <= shape.y + 5:
-                    self.dragged_shape = shape
-                    self.drag_start_x = event.x - shape.x
-                    self.drag_start_y = event.y - shape.y
-                    break
+        shape = self.layout.find_shape_at(event.x, event.y)
+        if shape:
+            self.dragged_shape = shape
+            self.drag_start_x = event.x - shape.x
+            self.drag_start_y = event.y - shape.y
+            self.drag_origin = (shape.x, shape.y)
 
     def on_drag(self, event):
         if self.live_mode or not self.dragged_shape:
             return
         
-        new_x = event.x - self.drag_start_x
-        new_y = event.y - self.drag_start_y
-        
-        self.dragged_shape.move_to(new_x, new_y)
-        self.dragged_shape.draw(self.canvas)
-        
-        self.update_connected_lines(self.dragged_shape)
+        # Motion events can arrive faster than Tk redraws, so only keep the
+        # newest position and apply it once per frame
+        self.drag_target = (event.x - self.drag_start_x, event.y - self.drag_start_y)
+        if self.drag_frame is None:
+            self.drag_frame = self.master.after(FRAME_MS, self.flush_drag)
+
+    def flush_drag(self):
+        self.drag_frame = None
+        shape = self.dragged_shape
+        target = self.drag_target
+        self.drag_target = None
+        if not shape or target is None:
+            return
+
+        dx = target[0] - shape.x
+        dy = target[1] - shape.y
+        if dx or dy:
+            shape.shift(self.canvas, dx, dy)
+            self.update_connected_lines(shape)
 
     def on_release(self, event):
         if self.live_mode:
             return
+        if self.drag_frame is not None:
+            self.master.after_cancel(self.drag_frame)
+        self.flush_drag()
+        shape = self.dragged_shape
+        if shape and (shape.x, shape.y) != self.drag_origin:
+            # One journal entry per drag, not per motion event
+            self.record_edit("move", name=shape.name, x=shape.x, y=shape.y)
         self.dragged_shape = None
 
     def remove_connections(self, shape_name):
-        shape = self.rectangles.get(shape_name) or self.points.get(shape_name)
-        lines_to_remove = []
-        for line_name, line in self.lines.items():
-            if line.start_shape == shape or line.end_shape == shape:
-                self.canvas.delete(line.canvas_item)
-                lines_to_remove.append(line_name)
-        for line_name in lines_to_remove:
-            del self.lines[line_name]
+        shape = self.layout.get_shape_by_name(shape_name)
+        if not shape:
+            return
+        for line in self.layout.get_shape_lines(shape):
+            self.remove_line(line.name)
+
+    def add_line(self, line):
+        if line.name in self.lines:
+            self.remove_line(line.name)
+        self.layout.add_line(line)
+        self.scene.mark(line)
+        self.update_aspects([line.start_shape, line.end_shape])
+        self.record_edit(
+            "connect", name=line.name, start_shape=line.start_shape.name,
+            end_shape=line.end_shape.name, start_is_output=line.start_is_output
+        )
+
+    def remove_line(self, line_name):
+        line = self.layout.remove_line(line_name)
+        self.scene.erase(line)
+        self.update_aspects([line.start_shape, line.end_shape])
+        self.record_edit("disconnect", name=line_name)
+        return line
 
     def reconnect(self, shape_name, connected_info):
         shape = self.get_shape_by_name(shape_name)
@@ -879,48 +666,26 @@ class DrawingApp:
 
 
     def get_connected_with_info(self, shape_name):
-        shape = self.get_shape_by_name(shape_name)
-        if not shape:
+        if not self.layout.get_shape_by_name(shape_name):
             print(f"No shape named '{shape_name}' found.")
             return []
-
-        connected = []
-
-        for line in self.lines.values():
-            if line.start_shape == shape:
-                connected.append((line.end_shape, True, line.name))
-            elif line.end_shape == shape:
-                connected.append((line.start_shape, False, line.name))
-
-        return connected
+        return self.layout.get_connected_with_info(shape_name)
     
     def get_shape_by_name(self, name):
-        return self.rectangles.get(name) or self.points.get(name)
+        return self.layout.get_shape_by_name(name)
 
     def update_connected_lines(self, shape):
-        for line in self.lines.values():
-            if line.start_shape == shape or line.end_shape == shape:
-                line.update_coordinates()
-                line.draw(self.canvas)
+        for line in self.layout.get_shape_lines(shape):
+            line.update_coordinates()
+            line.draw(self.canvas)
 
     def update_canvas(self):
-        self.canvas.delete("all")  # Clear the canvas
-        self.draw_all_lines()
-        self.redraw_all_rectangles()
-        self.redraw_all_points()
+        # Applies the objects marked since the last update, see CanvasScene
+        self.scene.flush()
 
-    def redraw_all_points(self):
-        for point in self.points.values():
-            if point.is_visible:
-                point.draw(self.canvas)
-
-    def redraw_all_rectangles(self):
-        for rect in self.rectangles.values():
-            rect.draw(self.canvas)
-
-    def draw_all_lines(self):
-        for line in self.lines.values():
-            line.draw(self.canvas)
+    def redraw_canvas(self):
+        # Everything from scratch, for a canvas that was cleared behind our back
+        self.scene.rebuild()
 
     def toggle_signal(self, rect_name, color):
         if rect_name in self.rectangles:
@@ -947,7 +712,11 @@ class DrawingApp:
             rect = self.rectangles[rect_name]
             for color in ["red", "blue", "yellow"]:
                 rect.set_signal(color, signal)
+                self.record_edit("signal", name=rect_name, color=color, value=signal)
             rect.draw(self.canvas)
+            self.publish_signals([rect])
+            # Red changed too, so the sections behind this one may show another aspect
+            self.update_aspects([rect])
         else:
             print(f"Rectangle '{rect_name}' not found.")
 
@@ -964,6 +733,10 @@ class DrawingApp:
             current_signal = rect.get_signal(color)
             rect.set_signal(color, not current_signal)
             rect.draw(self.canvas)
+            self.publish_signals([rect])
+            if color == "red":
+                self.update_aspects([rect])
+            self.record_edit("signal", name=rect_name, color=color, value=not current_signal)
         else:
             print(f"Rectangle '{rect_name}' not found.")
 
@@ -978,8 +751,9 @@ class DrawingApp:
         
         if x is not None and y is not None:
             point = Point(name, x, y)
-            self.points[name] = point
+            self.layout.add_point(point)
             point.draw(self.canvas)
+            self.record_edit("point", name=name, x=x, y=y)
             print(f"Point '{name}' created at ({x}, {y}).")
         else:
             print("Operation cancelled or invalid input.")
@@ -1004,8 +778,8 @@ class DrawingApp:
 
         line_name = f"Line_{shape1_name}_to_{shape2_name}"
         new_line = Line(line_name, shape1, shape2, True)
-        self.lines[line_name] = new_line
-        new_line.draw(self.canvas)
+        self.add_line(new_line)
+        self.update_canvas()
         print(f"Connected {shape1_name} to {shape2_name}")
 
     def toggle_all_points_visibility(self):
@@ -1017,7 +791,10 @@ class DrawingApp:
         new_visibility = not next(iter(self.points.values())).is_visible
 
         for point in self.points.values():
-            point.is_visible = new_visibility
+            if point.is_visible != new_visibility:
+                point.is_visible = new_visibility
+                self.scene.mark(point)
+                self.record_edit("point_visibility", name=point.name, value=new_visibility)
 
         self.update_canvas()
         visibility = "visible" if new_visibility else "hidden"
@@ -1025,35 +802,104 @@ class DrawingApp:
 
 
     def start_gpio_polling(self):
-        if not self.polling:
-            self.polling = True
-            self.poll_thread = Thread(target=self.poll_gpio)
-            self.poll_thread.daemon = True
-            self.poll_thread.start()
+        self.monitor.start()
 
     def stop_gpio_polling(self):
-        self.polling = False
-        if self.poll_thread and self.poll_thread.is_alive():
-            self.poll_thread.join(timeout=1)
+        self.monitor.stop()
+
+    def start_replay(self, source, speed=1.0):
+        # Replays a recording or script through the mock GPIO in the background,
+        # the transitions reach the canvas through the normal sampling path
+        from replay import ReplayEngine, load_events, print_report
+        events = load_events(source)
+        engine = ReplayEngine(self.monitor, events, speed)
+        print(f"Replaying {len(events)} transitions from {source}")
+        thread = Thread(target=lambda: print_report(engine.run()))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def start_train_simulation(self, trains=100, speed=1.0, ticks=36000):
+        # Drives the mock pins from simulated trains on the current layout
+        import trainsim
+        graph = trainsim.compile_section_graph(compile_layout(self.layout.to_dict()))
+        simulator = trainsim.TrainSimulator(graph, trains)
+        print(f"Simulating {len(simulator.positions)} trains on {len(graph)} sections")
+        thread = Thread(target=lambda: trainsim.print_report(simulator.run(ticks, speed)))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def on_pin_change(self, pin, value):
+        # Called from the sampling thread: only queue the state and make sure one
+        # frame is scheduled, the Tk thread applies and draws the whole batch
+        if self.state_queue.put(pin, value):
+            if perf.enabled:
+                self.frame_requested = perf_counter()
+            delay = max(0, self.last_frame + FRAME_MS / 1000 - monotonic())
+            if self.runtime:
+                # Tk calls from other threads need a running mainloop
+                self.runtime.call_later(delay, self.render_frame)
+            else:
+                self.master.after(int(delay * 1000), self.render_frame)
+
+    def render_frame(self):
+        self.last_frame = monotonic()
+        if perf.enabled and self.frame_requested:
+            # From the first queued pin change to its frame, grows with Tk backlog
+            perf.timing("frame_latency", perf_counter() - self.frame_requested)
+            self.frame_requested = None
+        changed = self.layout.apply_pin_states(self.state_queue.drain())
+        for rect in changed:
+            rect.draw(self.canvas)
+        if changed:
+            self.publish_signals(changed)
+            self.update_aspects(changed)
+
+    def update_aspects(self, shapes):
+        # Recomputes the aspects around shapes whose occupancy or lines changed
+        if self.aspects:
+            changed = self.aspects.update(shapes)
+            for rect in changed:
+                rect.draw(self.canvas)
+            self.publish_signals(changed)
+
+    def publish_signals(self, rects):
+        if self.viewers and rects:
+            self.viewers.publish(rects)
 
-    def poll_gpio(self):
-        while self.polling:
-            for rect in self.rectangles.values():
-                if rect.gpio is not None:
-                    try:
-                        value = rect.get_gpio_state(self.simulating)
-                        if value is not None:
-                            rect.set_signal("red", value == GPIO.HIGH)
-                            self.master.after(0, rect.draw, self.canvas)
-                    except Exception as e:
-                        print(f"Error polling GPIO for rectangle {rect.name}: {str(e)}")
-            sleep(.1)
 
+    def pending_callbacks(self):
+        try:
+            return len(self.master.tk.splitlist(self.master.tk.call("after", "info")))
+        except AttributeError:
+            return len(getattr(self.master, "callbacks", ()))
+
+    def profile_tick(self):
+        perf.sample("after_pending", self.pending_callbacks())
+        perf.sample("canvas_items", len(self.canvas.find_all()))
+        if monotonic() - self.last_profile_dump >= self.profile_interval:
+            self.last_profile_dump = monotonic()
+            perf.dump()
+        self.master.after(PROFILE_SAMPLE_MS, self.profile_tick)
 
     def cleanup(self):
         print("Starting cleanup...")
         self.stop_gpio_polling()
         print("GPIO polling stopped.")
+
+        if self.journal:
+            print("Compacting edit journal...")
+            self.journal.close(self.layout.to_dict())
+
+        if self.recorder:
+            self.recorder.close()
+
+        if self.pico_reader:
+            self.pico_reader.stop()
+
+        if self.viewers:
+            self.viewers.close()
         
         print("Cleaning up GPIO...")
         GPIO.cleanup()
@@ -1068,18 +914,91 @@ class DrawingApp:
 
 if __name__ == "__main__":
     live_mode = "--live" in sys.argv
+    edge_events = "--poll" not in sys.argv
+    autosave = "--autosave" in sys.argv
     load_file = True
+    record_file = None
+    replay_source = None
+    replay_speed = 1.0
+    trains = 0
+    aspects = "--manual-signals" not in sys.argv
+    agent_port = DEFAULT_AGENT_PORT if "--agents" in sys.argv else None
+    agent_host = DEFAULT_AGENT_HOST
+    agent_token = None
+    pico_device = None
+    profile_interval = 5 if "--profile" in sys.argv else None
+    poll_caps = None
+    sampler_process = "--sampler-process" in sys.argv
+    web_port = DEFAULT_WEB_PORT if "--web" in sys.argv else None
+    runtime = None
+    if "--asyncio" in sys.argv:
+        # One event loop for sampling, sockets and Tk instead of threads
+        from runtime import AsyncRuntime
+        runtime = AsyncRuntime()
 
     for arg in sys.argv:
         if arg.startswith("--load="):
             load_file = arg.split("=")[1]
-            break
+        elif arg.startswith("--record="):
+            record_file = arg.split("=")[1]
+        elif arg.startswith("--replay="):
+            replay_source = arg.split("=")[1]
+        elif arg.startswith("--speed="):
+            from replay import parse_speed
+            replay_speed = parse_speed(arg.split("=")[1])
+        elif arg.startswith("--trains="):
+            trains = int(arg.split("=")[1])
+        elif arg.startswith("--agent-port="):
+            agent_port = int(arg.split("=")[1])
+        elif arg.startswith("--agent-host="):
+            agent_host = arg.split("=")[1]
+        elif arg.startswith("--agent-token="):
+            agent_token = arg.split("=", 1)[1]
+        elif arg.startswith("--pico="):
+            pico_device = arg.split("=")[1]
+        elif arg.startswith("--profile="):
+            profile_interval = float(arg.split("=")[1])
+        elif arg.startswith("--web="):
+            web_port = int(arg.split("=")[1])
+        elif arg.startswith("--poll-cap="):
+            poll_caps = parse_poll_caps(arg.split("=")[1])
+
+    if agent_port is not None and agent_token is None and not is_loopback(agent_host):
+        # Anyone reaching the port could set pins otherwise
+        print(f"Accepting agents on {agent_host} needs --agent-token=SECRET, the same on every agent")
+        sys.exit(1)
+
+    if sampler_process and (replay_source or trains):
+        # Replays and simulations drive the mock pins of this process
+        print("--sampler-process is ignored with --replay and --trains")
+        sampler_process = False
+
+    # Backend selection is explicit here, importing core doesn't pick one
+    init_gpio("gpiod" if "--gpiod" in sys.argv else None)
+
+    if "--headless" in sys.argv:
+        # No Tk root or display needed, clients use the local state socket
+        port = DEFAULT_STATE_PORT
+        for arg in sys.argv:
+            if arg.startswith("--port="):
+                port = int(arg.split("=")[1])
+        layout_file = load_file if isinstance(load_file, str) else "qq.json"
+        run_headless(layout_file, edge_events=edge_events, port=port, record_file=record_file, aspects=aspects, agent_port=agent_port, pico_device=pico_device,
+                     profile_interval=profile_interval, poll_caps=poll_caps, sampler_process=sampler_process, runtime=runtime, web_port=web_port,
+                     agent_host=agent_host, agent_token=agent_token)
+        sys.exit(0)
 
-    root = tk.Tk()
+    root = load_tk().Tk()
     app = None
 
     try:
-        app = DrawingApp(root, live_mode=live_mode, load_file=load_file)
+        app = DrawingApp(root, live_mode=live_mode, load_file=load_file, edge_events=edge_events, autosave=autosave, record_file=record_file, aspects=aspects, agent_port=agent_port, pico_device=pico_device,
+                         profile_interval=profile_interval, poll_caps=poll_caps, sampler_process=sampler_process, runtime=runtime, web_port=web_port,
+                         agent_host=agent_host, agent_token=agent_token)
+        if replay_source:
+            app.start_replay(replay_source, replay_speed)
+        elif trains:
+            app.start_train_simulation(trains, replay_speed)
         
         def on_closing():
             if app:
@@ -1093,7 +1012,21 @@ if __name__ == "__main__":
             sys.exit(0)
         
         root.protocol("WM_DELETE_WINDOW", on_closing)
-        root.mainloop()
+
+        if "--startup-probe" in sys.argv:
+            # Used by bench.py --startup: report once the first frame is on screen, then quit
+            def report_first_frame():
+                root.update_idletasks()
+                print(f"First frame after {(perf_counter() - STARTUP) * 1000:.1f} ms")
+                sys.stdout.flush()
+                on_closing()
+            root.after_idle(report_first_frame)
+
+        if runtime:
+            runtime.attach_tk(root)
+            runtime.run()
+        else:
+            root.mainloop()
     except Exception as e:
         print(f"Error during application execution: {e}")
         import traceback
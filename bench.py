@@ -0,0 +1,619 @@
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+# Shape counts of the synthetic layouts, override with --sizes=10,100
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+DEFAULT_OUTPUT = "bench_results.json"
+
+
+def generate_layout(shape_count, seed=0):
+    # Synthetic layout in the qq.json schema: roughly 3/4 rectangles on a grid,
+    # the rest points, rectangles chained together and every point wired to one
+    rng = random.Random(seed)
+    rect_count = max(2, shape_count * 3 // 4)
+    point_count = max(0, shape_count - rect_count)
+    columns = max(1, int(rect_count ** 0.5))
+
+    rectangles = []
+    for i in range(rect_count):
+        rectangles.append({
+            "name": f"r{i}",
+            "x": (i % columns) * 220 + 20,
+            "y": (i // columns) * 140 + 20,
+            "width": 150,
+            "height": 80,
+            "gpio": i + 1,
+            "points_swapped": rng.random() < 0.2,
+            "red_signal": False,
+            "blue_signal": False,
+            "yellow_signal": False
+        })
+
+    points = []
+    for i in range(point_count):
+        points.append({
+            "name": f"p{i}",
+            "x": rng.randrange(0, columns * 220),
+            "y": rng.randrange(0, (rect_count // columns + 1) * 140),
+            "is_visible": rng.random() < 0.5
+        })
+
+    lines = []
+    for i in range(rect_count - 1):
+        lines.append({
+            "name": f"Line_r{i}_to_r{i + 1}",
+            "start_shape": f"r{i}",
+            "end_shape": f"r{i + 1}",
+            "start_is_output": True
+        })
+    for i in range(point_count):
+        target = f"r{rng.randrange(rect_count)}"
+        lines.append({
+            "name": f"Line_p{i}_to_{target}",
+            "start_shape": f"p{i}",
+            "end_shape": target,
+            "start_is_output": True
+        })
+
+    return {"rectangles": rectangles, "points": points, "lines": lines}
+
+
+class StubCanvas:
+    # Just enough of tk.Canvas to drive DrawingApp without a display
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.items = set()
+        self.tagged = {}
+
+    def create_item(self, *args, tags=None, **kwargs):
+        item = next(self.ids)
+        self.items.add(item)
+        if tags:
+            self.tagged.setdefault(tags, set()).add(item)
+        return item
+
+    create_rectangle = create_oval = create_text = create_line = create_item
+
+    def delete(self, *items):
+        for item in items:
+            if item == "all":
+                self.items.clear()
+                self.tagged.clear()
+            elif item in self.tagged:
+                self.items.difference_update(self.tagged.pop(item))
+            else:
+                self.items.discard(item)
+
+    def coords(self, *args):
+        return []
+
+    def itemconfig(self, *args, **kwargs):
+        pass
+
+    def move(self, *args):
+        pass
+
+    def tag_lower(self, *args):
+        pass
+
+    def find_all(self):
+        return tuple(self.items)
+
+    def pack(self, *args, **kwargs):
+        pass
+
+    def bind(self, *args, **kwargs):
+        pass
+
+
+class StubMaster:
+    # Collects after() callbacks so the benchmark can run them explicitly
+    def __init__(self):
+        self.callbacks = []
+
+    def after(self, ms, callback=None, *args):
+        self.callbacks.append((callback, args))
+        return len(self.callbacks)
+
+    def after_idle(self, callback, *args):
+        return self.after(0, callback, *args)
+
+    def after_cancel(self, callback_id):
+        pass
+
+    def run_pending(self):
+        while self.callbacks:
+            callback, args = self.callbacks.pop(0)
+            callback(*args)
+
+
+class Event:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+def measure(func, repeat, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = perf_counter()
+        func()
+        timings.append(perf_counter() - start)
+    return {
+        "repeat": repeat,
+        "min_s": min(timings),
+        "median_s": statistics.median(timings),
+        "mean_s": statistics.fmean(timings)
+    }
+
+
+def model_bytes_per_shape(layout_path, shape_count):
+    # Memory held by a built Layout: shapes, lines and their indexes
+    from core import Layout, read_compiled_layout
+
+    compiled = read_compiled_layout(layout_path, use_cache=False)
+    tracemalloc.start()
+    try:
+        layout = Layout()
+        layout.build(compiled)
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return size / shape_count
+
+
+def make_app(use_tk):
+    import app
+
+    if use_tk:
+        import tkinter as tk
+        master = tk.Tk()
+        master.withdraw()
+        canvas = None
+    else:
+        master = StubMaster()
+        canvas = StubCanvas()
+    drawing_app = app.DrawingApp(master, live_mode=True, load_file=False, canvas=canvas)
+    # Benchmarks drive sampling themselves
+    drawing_app.monitor.stop()
+    return app, drawing_app, master
+
+
+def run_pending(master):
+    if hasattr(master, "run_pending"):
+        master.run_pending()
+    else:
+        master.update()
+
+
+def bench_size(shape_count, repeat, use_tk, workdir):
+    from core import GPIO
+
+    layout_path = os.path.join(workdir, f"layout_{shape_count}.json")
+    save_path = os.path.join(workdir, f"saved_{shape_count}.json")
+    with open(layout_path, "w") as f:
+        json.dump(generate_layout(shape_count), f)
+
+    app, drawing_app, master = make_app(use_tk)
+    rng = random.Random(shape_count)
+    results = {}
+
+    def load_uncached():
+        drawing_app.layout.load(layout_path, use_cache=False)
+        drawing_app.redraw_canvas()
+
+    results["load_canvas_uncached"] = measure(load_uncached, repeat)
+    # The first call compiles the cache, the timed ones read it. Reloading the
+    # same file reuses the canvas items of every shape.
+    drawing_app.load_canvas(layout_path)
+    results["load_canvas"] = measure(lambda: drawing_app.load_canvas(layout_path), repeat)
+    run_pending(master)
+    results["redraw_canvas"] = measure(drawing_app.redraw_canvas, repeat)
+
+    # Incremental scene updates: one new connection, all points hidden or shown
+    rect_names = list(drawing_app.rectangles)
+    results["connect_shapes"] = measure(lambda: drawing_app.connect_shapes(rect_names[0], rect_names[-1]), repeat)
+    results["toggle_points"] = measure(drawing_app.toggle_all_points_visibility, repeat)
+
+    # One poll cycle: bulk read, queue the deltas, render the frame.
+    # About 1% of the pins flip before every cycle.
+    pins = sorted(drawing_app.monitor.pins)
+
+    def flip_pins():
+        for pin in rng.sample(pins, max(1, len(pins) // 100)):
+            GPIO.set_mock_value(pin, GPIO.HIGH if rng.random() < 0.5 else GPIO.LOW)
+
+    def poll_cycle():
+        drawing_app.monitor.sample()
+        run_pending(master)
+
+    results["poll_cycle"] = measure(poll_cycle, repeat, setup=flip_pins)
+
+    # Seeded traffic pushed through sampling, the state queue and rendering
+    # as fast as the virtual clock allows
+    from replay import ReplayEngine, generate_traffic
+    # (~1 transition per pin per 30 s, so ask for a little more than needed)
+    traffic = generate_traffic(pins, 10000 * 36 / len(pins))[:10000]
+
+    def replay():
+        ReplayEngine(drawing_app.monitor, traffic, speed=None).run()
+        run_pending(master)
+
+    results["replay_10000_events"] = measure(replay, repeat)
+
+    # Simulated trains (needs numpy), one tick includes the bulk pin write
+    import trainsim
+    if trainsim.np is not None:
+        from core import compile_layout
+        graph = trainsim.compile_section_graph(compile_layout(drawing_app.layout.to_dict()))
+        simulator = trainsim.TrainSimulator(graph, max(1, len(graph) // 10))
+
+        def train_ticks():
+            for _ in range(100):
+                simulator.step()
+                simulator.write_gpio()
+                drawing_app.monitor.sample()
+            run_pending(master)
+
+        results["train_sim_100_ticks"] = measure(train_ticks, repeat)
+
+    rects = list(drawing_app.rectangles.values())
+    max_x = max(rect.x + rect.width for rect in rects)
+    max_y = max(rect.y + rect.height for rect in rects)
+    clicks = [Event(rng.uniform(0, max_x), rng.uniform(0, max_y)) for _ in range(1000)]
+
+    def hit_test():
+        for event in clicks:
+            drawing_app.on_press(event)
+            drawing_app.dragged_shape = None
+
+    drawing_app.live_mode = False
+    results["on_press_1000"] = measure(hit_test, repeat)
+
+    # Drag the most connected rectangle: one motion event plus the frame flush
+    target = max(rects, key=lambda rect: len(drawing_app.layout.get_shape_lines(rect)))
+    drag_steps = [Event(target.x + 10 + i % 50, target.y + 10 + i % 30) for i in range(200)]
+
+    def drag():
+        drawing_app.on_press(Event(target.x + 10, target.y + 10))
+        for event in drag_steps:
+            drawing_app.on_drag(event)
+            drawing_app.flush_drag()
+        drawing_app.on_release(drag_steps[-1])
+
+    results["drag_200_frames"] = measure(drag, repeat)
+    drawing_app.live_mode = True
+
+    results["save_canvas"] = measure(lambda: drawing_app.save_canvas(save_path), repeat)
+
+    drawing_app.monitor.stop()
+    if use_tk:
+        master.destroy()
+
+    return {
+        "shapes": shape_count,
+        "rectangles": len(drawing_app.rectangles),
+        "points": len(drawing_app.points),
+        "lines": len(drawing_app.lines),
+        "model_bytes_per_shape": model_bytes_per_shape(layout_path, shape_count),
+        "results": results
+    }
+
+
+def simulate_polling(scheduler, pins, events, duration, neighbours=None):
+    # Drives a PollScheduler on a virtual clock against a transition list.
+    # A change counts as detected at the first read that sees it. neighbours
+    # maps a pin to the pins of the sections next to it, which are read fast
+    # while it is occupied, like GpioMonitor.sample_due does.
+    neighbours = neighbours or {}
+    values = {pin: 0 for pin in pins}
+    seen = dict(values)
+    changed_at = {}
+    latencies = {pin: [] for pin in pins}
+    scheduler.set_pins(frozenset(pins), 0.0)
+    upcoming = iter(events)
+    event = next(upcoming, None)
+    wakeups = 0
+    while True:
+        now = scheduler.next_deadline()
+        if now is None or now > duration:
+            break
+        wakeups += 1
+        while event is not None and event.time <= now:
+            values[event.pin] = event.value
+            if values[event.pin] == seen[event.pin]:
+                changed_at.pop(event.pin, None)  # flipped back before it was read
+            else:
+                changed_at.setdefault(event.pin, event.time)
+            event = next(upcoming, None)
+        moved = []
+        for pin in scheduler.due(now):
+            changed = values[pin] != seen[pin]
+            if changed:
+                latencies[pin].append(now - changed_at.pop(pin))
+                seen[pin] = values[pin]
+                moved.append(pin)
+            scheduler.reschedule(pin, changed, now)
+        for pin in moved:
+            for other in neighbours.get(pin, ()):
+                scheduler.set_hot(other, any(seen[near] for near in neighbours.get(other, ())), now)
+    return scheduler.reads / duration, wakeups / duration, latencies
+
+
+def polling_benchmarks(pin_count=200, duration=120.0, active_share=0.1, seed=0):
+    # Fixed 100 ms polling against the adaptive scheduler on a mostly idle
+    # layout: a tenth of the pins change every ~2 s, the rest every ~5 min.
+    # The active pins are sections of one line, each next to the one before.
+    # Fails unless the adaptive scheduler reads less than fixed polling.
+    from core import PollScheduler
+    from replay import generate_traffic
+
+    pins = list(range(1, pin_count + 1))
+    active = pins[:max(1, int(pin_count * active_share))]
+    idle = pins[len(active):]
+    neighbours = {pin: [other for other in (pin - 1, pin + 1) if other in active] for pin in active}
+    events = sorted(generate_traffic(active, duration, mean_dwell=2.0, seed=seed)
+                    + generate_traffic(idle, duration, mean_dwell=300.0, seed=seed + 1),
+                    key=lambda event: event.time)
+
+    def mean_ms(latencies, group):
+        values = [value for pin in group for value in latencies[pin]]
+        return 1000 * statistics.fmean(values) if values else None
+
+    results = {}
+    schedulers = {
+        "fixed": PollScheduler(.1, min_interval=.1, max_interval=.1),
+        "adaptive": PollScheduler(.1)
+    }
+    for name, scheduler in schedulers.items():
+        reads_per_s, wakeups_per_s, latencies = simulate_polling(scheduler, pins, events, duration, neighbours)
+        results[name] = {
+            "reads_per_s": reads_per_s,
+            "wakeups_per_s": wakeups_per_s,
+            "active_latency_ms": mean_ms(latencies, active),
+            "idle_latency_ms": mean_ms(latencies, idle),
+            "max_latency_ms": 1000 * max((value for values in latencies.values() for value in values), default=0)
+        }
+        print(f"polling {name}: {reads_per_s:.0f} reads/s in {wakeups_per_s:.0f} wakeups/s, mean detection latency "
+              f"{results[name]['active_latency_ms']:.1f} ms active, {results[name]['idle_latency_ms']:.1f} ms idle pins, "
+              f"worst {results[name]['max_latency_ms']:.0f} ms")
+    if results["adaptive"]["reads_per_s"] >= results["fixed"]["reads_per_s"]:
+        raise RuntimeError(f"Adaptive polling reads {results['adaptive']['reads_per_s']:.0f} pins/s, "
+                           f"fixed polling only {results['fixed']['reads_per_s']:.0f}")
+    return results
+
+
+def sampler_benchmarks(duration=2.0, pin_count=32):
+    # Sampling rate while this process holds the GIL in long C calls, as Tk
+    # redraws do: a sampler thread here against the sampler process
+    from threading import Thread
+    from time import monotonic, sleep
+    from core import GPIO
+    from sampler import SAMPLER_INTERVAL, ProcessSampler
+
+    data = [random.random() for _ in range(300000)]
+
+    def busy():
+        end = monotonic() + duration
+        while monotonic() < end:
+            sorted(data)
+
+    pins = list(range(pin_count))
+    gaps = []
+
+    def sample_thread():
+        last = monotonic()
+        while running:
+            GPIO.read_snapshot(pins)
+            now = monotonic()
+            gaps.append(now - last)
+            last = now
+            sleep(SAMPLER_INTERVAL)
+
+    running = True
+    thread = Thread(target=sample_thread, daemon=True)
+    thread.start()
+    busy()
+    running = False
+    thread.join()
+
+    sampler = ProcessSampler()
+    sampler.start(pins, block=True)
+    before = sampler.state.samples()
+    busy()
+    samples = sampler.state.samples() - before
+    sampler.stop()
+
+    results = {
+        "expected_per_s": 1 / SAMPLER_INTERVAL,
+        "thread_per_s": len(gaps) / duration,
+        "thread_max_gap_ms": 1000 * max(gaps),
+        "process_per_s": samples / duration
+    }
+    print(f"sampler under load: thread {results['thread_per_s']:.0f}/s (max gap {results['thread_max_gap_ms']:.0f} ms), "
+          f"process {results['process_per_s']:.0f}/s, expected {results['expected_per_s']:.0f}/s")
+    return results
+
+
+def web_benchmarks(clients=20, shape_count=1000, changes=500):
+    # Bytes the web viewer sends per client: the layout once on connect,
+    # then per signal change, against a loopback client reading the stream
+    import socket
+    from threading import Thread
+    from time import monotonic, sleep
+    from core import Layout, Line, Point, Rectangle
+    from webview import WebViewer
+
+    # Rectangles joined through points, the line ends then come from both
+    layout = Layout()
+    for i in range(shape_count):
+        layout.add_rectangle(Rectangle(f"r{i}", i % 50 * 200, i // 50 * 120, 150, 80))
+        if i % 50:
+            point = Point(f"p{i}", i % 50 * 200 - 25, i // 50 * 120 + 40)
+            layout.add_point(point)
+            layout.add_line(Line(f"l{i}a", layout.rectangles[f"r{i - 1}"], point))
+            layout.add_line(Line(f"l{i}b", point, layout.rectangles[f"r{i}"]))
+    viewer = WebViewer(layout, host="127.0.0.1", port=0)
+    while not viewer.server_address:
+        sleep(.01)
+
+    received = []
+
+    def read_events():
+        sock = socket.create_connection(viewer.server_address)
+        sock.sendall(b"GET /events HTTP/1.1\r\n\r\n")
+        total = 0
+        received.append(0)
+        slot = len(received) - 1
+        while chunk := sock.recv(65536):
+            total += len(chunk)
+            received[slot] = total
+
+    for _ in range(clients):
+        Thread(target=read_events, daemon=True).start()
+    while len(viewer.clients) < clients:
+        sleep(.01)
+    sleep(.2)
+    connected = viewer.bytes_sent
+
+    rects = list(layout.rectangles.values())
+    start = monotonic()
+    for n in range(changes):
+        rect = rects[n * 7 % shape_count]
+        rect.red_signal = not rect.red_signal
+        viewer.publish([rect])
+        sleep(.001)
+    expected = viewer.bytes_sent
+    while monotonic() - start < 10 and sum(received) < expected:
+        sleep(.01)
+    viewer.close()
+
+    results = {
+        "clients": clients,
+        "shapes": shape_count,
+        "layout_bytes": connected // clients,
+        "bytes_per_change_per_client": (expected - connected) / changes / clients
+    }
+    print(f"web viewer, {clients} clients, {shape_count} shapes: layout {results['layout_bytes']} bytes once, "
+          f"then {results['bytes_per_change_per_client']:.1f} bytes per change and client")
+    return results
+
+
+def run_startup(command, env):
+    start = perf_counter()
+    result = subprocess.run(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                            capture_output=True, text=True, timeout=60)
+    elapsed = perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed: {result.stderr.strip()[-500:]}")
+    return elapsed, result.stdout
+
+
+def startup_benchmarks(repeat=5):
+    # Fresh interpreters, with the bytecode cache on as on the Pi. The first
+    # run of each command only warms the cache and isn't counted.
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    commands = {
+        "python": [sys.executable, "-c", "pass"],
+        "import_core": [sys.executable, "-c", "import core"],
+        "import_app": [sys.executable, "-c", "import app"]
+    }
+    if os.environ.get("DISPLAY"):
+        commands["first_frame_live"] = [sys.executable, "app.py", "--live", "--startup-probe"]
+
+    results = {}
+    for name, command in commands.items():
+        run_startup(command, env)
+        timings = []
+        first_frames = []
+        for _ in range(repeat):
+            elapsed, output = run_startup(command, env)
+            timings.append(elapsed)
+            for line in output.splitlines():
+                if line.startswith("First frame after"):
+                    first_frames.append(float(line.split()[3]) / 1000)
+        results[name] = {
+            "repeat": repeat,
+            "min_s": min(timings),
+            "median_s": statistics.median(timings),
+            "mean_s": statistics.fmean(timings)
+        }
+        if first_frames:
+            # Measured inside the app, from its first line to the drawn frame
+            results[name]["in_app_median_s"] = statistics.median(first_frames)
+        print(f"startup {name}: {results[name]['median_s'] * 1000:.1f} ms")
+    if "first_frame_live" not in results:
+        print("startup first_frame_live: skipped, needs a display (e.g. xvfb-run)")
+    return results
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat=5, use_tk=False):
+    runs = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for shape_count in sizes:
+            # The app and the mock GPIO are chatty, keep the report readable
+            with contextlib.redirect_stdout(io.StringIO()):
+                run = bench_size(shape_count, repeat, use_tk, workdir)
+            runs.append(run)
+            summary = ", ".join(f"{name} {stats['median_s'] * 1000:.2f} ms" for name, stats in run["results"].items())
+            print(f"{shape_count} shapes: {summary}, {run['model_bytes_per_shape']:.0f} bytes/shape")
+
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "canvas": "tk" if use_tk else "stub",
+        "runs": runs,
+        "polling": polling_benchmarks()
+    }
+
+
+if __name__ == "__main__":
+    sizes = DEFAULT_SIZES
+    repeat = 5
+    output = DEFAULT_OUTPUT
+    use_tk = "--tk" in sys.argv  # needs a display, e.g. under xvfb-run
+    startup = "--startup" in sys.argv
+    sampler = "--sampler" in sys.argv
+    web = "--web" in sys.argv
+
+    for arg in sys.argv:
+        if arg.startswith("--sizes="):
+            sizes = [int(size) for size in arg.split("=")[1].split(",")]
+        elif arg.startswith("--repeat="):
+            repeat = int(arg.split("=")[1])
+        elif arg.startswith("--output="):
+            output = arg.split("=")[1]
+
+    if startup:
+        # Only the startup group: python3 bench.py --startup
+        report = {"python": platform.python_version(), "machine": platform.machine(),
+                  "startup": startup_benchmarks(repeat)}
+    elif web:
+        # Only the web viewer group: python3 bench.py --web
+        report = {"python": platform.python_version(), "machine": platform.machine(),
+                  "web": web_benchmarks()}
+    elif sampler:
+        # Only the sampler group: python3 bench.py --sampler
+        from core import init_gpio
+        init_gpio("mock")
+        report = {"python": platform.python_version(), "machine": platform.machine(),
+                  "sampler": sampler_benchmarks()}
+    else:
+        report = run_benchmarks(sizes, repeat, use_tk)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
@@ -0,0 +1,2427 @@
+import sys
+import json
+import marshal
+import os
+import heapq
+import hmac
+import queue
+import socketserver
+from time import sleep, monotonic
+from threading import Thread, Lock
+from array import array
+import itertools
+from operator import attrgetter
+
+import perf
+
+# Debounce window for GPIO edge events, in milliseconds
+GPIO_BOUNCE_MS = 5
+# Port of the local state server used in --headless mode
+DEFAULT_STATE_PORT = 8765
+# Port the main app listens on for remote GPIO agents (agent.py)
+DEFAULT_AGENT_PORT = 8766
+# Interface the agent port is opened on. Agents on other Pis need another one
+# and a shared token, see accept_agents.
+DEFAULT_AGENT_HOST = "127.0.0.1"
+# Port of the browser viewer (webview.py)
+DEFAULT_WEB_PORT = 8080
+# Sections looked ahead of a clear section when deriving its aspect
+ASPECT_LOOKAHEAD = 2
+# Adaptive polling, for backends without edge events: a pin is read every
+# POLL_MIN_INTERVAL seconds while a section next to it is occupied and for
+# POLL_HOLD seconds after it changed, otherwise its interval doubles with
+# every read without a change, up to POLL_MAX_INTERVAL or the pin's own cap.
+# Intervals are POLL_MIN_INTERVAL times a power of two, so quiet pins are
+# read together in the slots of the busy ones.
+POLL_MIN_INTERVAL = .05
+POLL_MAX_INTERVAL = .8
+POLL_HOLD = 2.0
+# Bump when the compiled layout tuples change shape
+LAYOUT_CACHE_VERSION = 1
+
+# Imported by the backends that need them, see GPIOWrapper and GpiodGPIO
+RealGPIO = None
+gpiod = None
+
+
+class GPIOWrapper:
+    def __init__(self):
+        # RPi.GPIO only exists on a Pi, so it is imported when the backend is made
+        global RealGPIO
+        import RPi.GPIO as RealGPIO
+        self.simulating = False
+        self.BCM = RealGPIO.BCM
+        self.IN = RealGPIO.IN
+        self.OUT = RealGPIO.OUT
+        self.PUD_DOWN = RealGPIO.PUD_DOWN
+        self.PUD_UP = RealGPIO.PUD_UP
+        self.HIGH = RealGPIO.HIGH
+        self.LOW = RealGPIO.LOW
+        self.BOTH = RealGPIO.BOTH
+        self.mock_values = {}
+        self.event_callbacks = {}
+
+    def set_simulating(self, simulating):
+        self.simulating = simulating
+
+    def set_mock_value(self, pin, value):
+        old_value = self.mock_values.get(pin, self.LOW)
+        self.mock_values[pin] = value
+        # Real edges still come from the hardware, simulated ones are raised here
+        if self.simulating and value != old_value and pin in self.event_callbacks:
+            self.event_callbacks[pin](pin)
+
+    def set_mock_values(self, values):
+        for pin, value in values.items():
+            self.set_mock_value(pin, value)
+
+    def input(self, pin):
+        if self.simulating:
+            value = self.mock_values.get(pin, self.LOW)
+            print(f"GPIO: Reading pin {pin}: {'HIGH' if value == self.HIGH else 'LOW'}")
+            return value
+        return RealGPIO.input(pin)
+
+    # Implement other necessary methods, forwarding them to RealGPIO
+    def setmode(self, mode):
+        RealGPIO.setmode(mode)
+
+    def setup(self, pin, mode, pull_up_down=None):
+        if pull_up_down:
+            RealGPIO.setup(pin, mode, pull_up_down=pull_up_down)
+        else:
+            RealGPIO.setup(pin, mode)
+
+    def add_event_detect(self, pin, callback, bouncetime=None):
+        if bouncetime:
+            RealGPIO.add_event_detect(pin, RealGPIO.BOTH, callback=callback, bouncetime=bouncetime)
+        else:
+            RealGPIO.add_event_detect(pin, RealGPIO.BOTH, callback=callback)
+        self.event_callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.event_callbacks.pop(pin, None)
+        RealGPIO.remove_event_detect(pin)
+
+    def read_snapshot(self, pins):
+        return {pin: self.input(pin) for pin in pins}
+
+    def cleanup(self, pin=None):
+        if pin is None:
+            self.event_callbacks.clear()
+            RealGPIO.cleanup()
+        else:
+            self.event_callbacks.pop(pin, None)
+            RealGPIO.cleanup(pin)
+
+
+class GpiodGPIO:
+    # Reads every configured pin with one libgpiod bulk line request, so a
+    # poll cycle costs a single get_values() call instead of one read per pin.
+    # BCM numbers are the line offsets on gpiochip0, so no mode mapping is needed.
+    BCM = "BCM"
+    OUT = "OUT"
+    IN = "IN"
+    HIGH = 1
+    LOW = 0
+    PUD_DOWN = "PUD_DOWN"
+    PUD_UP = "PUD_UP"
+    BOTH = "BOTH"
+
+    def __init__(self, chip_name="gpiochip0"):
+        global gpiod
+        try:
+            import gpiod
+        except ImportError:
+            raise RuntimeError("gpiod is not installed (pip3 install gpiod)")
+        self.chip = gpiod.Chip(chip_name)
+        self.simulating = False
+        self.mock_values = {}
+        self.pins = {}
+        self.bulk = None
+        self.bulk_pins = ()
+
+    def setmode(self, mode):
+        pass
+
+    def set_simulating(self, simulating):
+        self.simulating = simulating
+
+    def set_mock_value(self, pin, value):
+        self.mock_values[pin] = value
+
+    def set_mock_values(self, values):
+        self.mock_values.update(values)
+
+    def setup(self, pin, mode, pull_up_down=None):
+        if mode != self.IN:
+            raise ValueError(f"GpiodGPIO only supports inputs, got {mode} for pin {pin}")
+        if self.pins.get(pin, -1) != pull_up_down:
+            self.pins[pin] = pull_up_down
+            self.release()
+
+    def request(self):
+        self.release()
+        self.bulk_pins = tuple(sorted(self.pins))
+        flags = 0
+        # Bias flags need libgpiod >= 1.5, older boards rely on the external pull-downs
+        if all(pull == self.PUD_DOWN for pull in self.pins.values()):
+            flags = getattr(gpiod, "LINE_REQ_FLAG_BIAS_PULL_DOWN", 0)
+        elif all(pull == self.PUD_UP for pull in self.pins.values()):
+            flags = getattr(gpiod, "LINE_REQ_FLAG_BIAS_PULL_UP", 0)
+        self.bulk = self.chip.get_lines(list(self.bulk_pins))
+        self.bulk.request(consumer="pi-surveillance", type=gpiod.LINE_REQ_DIR_IN, flags=flags)
+
+    def release(self):
+        if self.bulk is not None:
+            self.bulk.release()
+        self.bulk = None
+        self.bulk_pins = ()
+
+    def read_snapshot(self, pins):
+        if self.simulating:
+            return {pin: self.mock_values.get(pin, self.LOW) for pin in pins}
+        missing = [pin for pin in pins if pin not in self.pins]
+        for pin in missing:
+            self.setup(pin, self.IN, pull_up_down=self.PUD_DOWN)
+        if self.bulk is None and self.pins:
+            self.request()
+        if self.bulk is None:
+            return {}
+        values = dict(zip(self.bulk_pins, self.bulk.get_values()))
+        return {pin: values[pin] for pin in pins}
+
+    def input(self, pin):
+        return self.read_snapshot([pin])[pin]
+
+    def cleanup(self, pin=None):
+        if pin is None:
+            self.pins.clear()
+        else:
+            self.pins.pop(pin, None)
+        self.release()
+
+
+class MockGPIO:
+    BCM = "BCM"
+    OUT = "OUT"
+    IN = "IN"
+    HIGH = 1
+    LOW = 0
+    PUD_DOWN = "PUD_DOWN"
+    PUD_UP = "PUD_UP"
+    BOTH = "BOTH"
+
+    def __init__(self):
+        self.pin_values = {}
+        self.simulating = False
+        self.event_callbacks = {}
+
+    def setmode(self, mode):
+        print(f"Mock: Setting GPIO mode to {mode}")
+
+    def set_simulating(self, simulating):
+        self.simulating = simulating
+
+    def setwarnings(self, flag):
+        print(f"Mock: Setting warnings to {flag}")
+
+    def setup(self, pin, mode, pull_up_down=None):
+        pull_up_down_str = f" with pull_up_down={pull_up_down}" if pull_up_down else ""
+        print(f"Mock: Setting up GPIO pin {pin} as {'input' if mode == self.IN else 'output'}{pull_up_down_str}")
+        if pin not in self.pin_values:
+            self.pin_values[pin] = self.LOW 
+
+    def input(self, pin):
+        if pin not in self.pin_values:
+            self.pin_values[pin] = self.LOW
+        if self.simulating:
+            value = "HIGH" if self.pin_values[pin] == self.HIGH else "LOW"
+            print(f"Mock: Reading GPIO pin {pin}: {value}")
+        return self.pin_values[pin]
+
+    def set_mock_value(self, pin, value):
+        old_value = self.pin_values.get(pin, self.LOW)
+        self.pin_values[pin] = value
+        if value != old_value and pin in self.event_callbacks:
+            self.event_callbacks[pin](pin)
+
+    def set_mock_values(self, values):
+        # Bulk version for simulators, edges are raised once every pin is set
+        changed = [pin for pin, value in values.items() if self.pin_values.get(pin, self.LOW) != value]
+        self.pin_values.update(values)
+        for pin in changed:
+            if pin in self.event_callbacks:
+                self.event_callbacks[pin](pin)
+
+    def read_snapshot(self, pins):
+        values = {pin: self.pin_values.get(pin, self.LOW) for pin in pins}
+        if self.simulating:
+            print(f"Mock: Reading GPIO pins {values}")
+        return values
+
+    def add_event_detect(self, pin, callback, bouncetime=None):
+        print(f"Mock: Adding edge detection on GPIO pin {pin}")
+        self.event_callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        print(f"Mock: Removing edge detection on GPIO pin {pin}")
+        self.event_callbacks.pop(pin, None)
+
+    def cleanup(self, pin=None):
+        if pin is None:
+            print("Mock: Cleaning up all GPIO pins")
+            self.event_callbacks.clear()
+        else:
+            print(f"Mock: Cleaning up GPIO pin {pin}")
+            self.event_callbacks.pop(pin, None)
+
+
+def create_gpio_backend(name=None):
+    # "rpi", "gpiod" or "mock", by default RPi.GPIO on a Pi and the mock elsewhere
+    if name is None:
+        import platform
+        machine = platform.machine()
+        is_raspberry_pi = machine.startswith('aarch64')
+        print(f"Running on a Raspberry Pi: {is_raspberry_pi}")
+        print(machine)
+        if not is_raspberry_pi:
+            print("Not running on a Raspberry Pi. GPIO functionality will be simulated.")
+        name = "rpi" if is_raspberry_pi else "mock"
+
+    if name == "mock":
+        return MockGPIO()
+    backend = GpiodGPIO() if name == "gpiod" else GPIOWrapper()
+    backend.setmode(backend.BCM)
+    return backend
+
+
+class LazyGPIO:
+    # Stands in for the GPIO backend, which is only created on first use or by
+    # init_gpio(), so importing this module touches no hardware. Methods and
+    # constants are copied onto the proxy on first access, later calls cost
+    # the same as on the backend itself.
+    def __init__(self):
+        self.backend = None
+        self.lock = Lock()
+
+    def __getattr__(self, name):
+        # Only called for names the proxy doesn't have yet
+        if self.backend is None:
+            init_gpio()
+        value = getattr(self.backend, name)
+        if callable(value) or name.isupper():
+            setattr(self, name, value)
+        return value
+
+
+def init_gpio(name=None):
+    # Picks the backend now instead of on first use, call before any GPIO access
+    with GPIO.lock:
+        if GPIO.backend is None or name is not None:
+            backend = create_gpio_backend(name)
+            # Drop whatever was copied from a previous backend
+            for key in list(GPIO.__dict__):
+                if key not in ("backend", "lock"):
+                    del GPIO.__dict__[key]
+            GPIO.backend = backend
+    return GPIO.backend
+
+
+GPIO = LazyGPIO()
+
+# Backend for "node:pin" pins read by agents on other Pis, see start_remote_gpio
+remote_gpio = None
+
+
+def is_remote_pin(pin):
+    return isinstance(pin, str)
+
+
+def parse_pin(value):
+    # A local BCM pin number or "node:pin" for a pin on another Pi
+    if value is None or isinstance(value, int) and not isinstance(value, bool):
+        return value
+    text = str(value).strip()
+    if ":" in text:
+        node, pin = text.rsplit(":", 1)
+        if node and pin.isdigit():
+            return f"{node}:{int(pin)}"
+    elif text.isdigit():
+        return int(text)
+    raise ValueError(f"invalid GPIO pin '{value}', use a number or node:pin")
+
+
+def backend_for(pin):
+    return remote_gpio if is_remote_pin(pin) else GPIO
+
+
+def parse_poll_caps(value):
+    # --poll-cap: "0.5" sets the longest poll interval of every pin, "17:0.1"
+    # or "pi2:4:2" that of one pin, in seconds, comma separated
+    caps = {}
+    for item in value.split(","):
+        if item:
+            pin, _, seconds = item.rpartition(":")
+            caps[parse_pin(pin) if pin else None] = float(seconds)
+    return caps
+
+
+# Bits of ShapeStore.flags
+SWAPPED = 1        # rectangle points swapped
+VISIBLE = 2        # point visible
+MOVED = 4          # geometry differs from the canvas items
+GPIO_CHANGED = 8   # gpio label differs from the canvas
+# Bits of ShapeStore.signals
+RED = 1
+BLUE = 2
+YELLOW = 4
+SIGNAL_BITS = {"red": RED, "blue": BLUE, "yellow": YELLOW}
+# drawn_signals of a shape that has no items on the canvas
+NOT_DRAWN = 0xFF
+# Canvas item handles per shape, 0 is no item (Tk ids start at 1)
+ITEM_SLOTS = 8
+CANVAS_ITEM, TEXT_ITEM, GPIO_TEXT_ITEM, P1_ITEM, P2_ITEM, RED_BOX, BLUE_BOX, YELLOW_BOX = range(ITEM_SLOTS)
+EMPTY_ITEMS = array("I", bytes(4 * ITEM_SLOTS))
+# Canvas tags of the shapes, not id() based: a tag moves with its items to the
+# shape that takes them over and must not come back for a newer object
+canvas_tags = itertools.count(1)
+
+
+def coordinate(value):
+    # The columns hold floats, whole numbers come back as the ints they were.
+    # Line ends taken from Point.x/y are already ints.
+    if isinstance(value, int):
+        return value
+    return int(value) if value.is_integer() else value
+
+
+class ShapeStore:
+    # Struct-of-arrays storage for the rectangles and points of a layout, one
+    # row per shape. Rectangle and Point are views that only hold their row,
+    # so a shape costs a few packed numbers instead of an instance dict, and
+    # bulk operations (pin states, aspects, saving) read the columns directly.
+    # Free rows are reused. A shape dropped from its layout is first moved to
+    # a store of its own, so a stale reference never reads another shape.
+    def __init__(self):
+        self.x = array("d")
+        self.y = array("d")
+        self.width = array("d")
+        self.height = array("d")
+        self.gpio = []
+        self.flags = bytearray()
+        self.signals = bytearray()
+        self.drawn_signals = bytearray()
+        self.items = array("I")
+        self.shapes = []
+        self.free = []
+
+    def __len__(self):
+        return len(self.shapes) - len(self.free)
+
+    def add(self, shape, x, y, width=0, height=0, gpio=None, flags=0, signals=0):
+        if self.free:
+            row = self.free.pop()
+            self.x[row] = x
+            self.y[row] = y
+            self.width[row] = width
+            self.height[row] = height
+            self.gpio[row] = gpio
+            self.flags[row] = flags
+            self.signals[row] = signals
+            self.drawn_signals[row] = NOT_DRAWN
+            self.items[row * ITEM_SLOTS:(row + 1) * ITEM_SLOTS] = EMPTY_ITEMS
+            self.shapes[row] = shape
+        else:
+            row = len(self.shapes)
+            self.x.append(x)
+            self.y.append(y)
+            self.width.append(width)
+            self.height.append(height)
+            self.gpio.append(gpio)
+            self.flags.append(flags)
+            self.signals.append(signals)
+            self.drawn_signals.append(NOT_DRAWN)
+            self.items.extend(EMPTY_ITEMS)
+            self.shapes.append(shape)
+        shape.store = self
+        shape.row = row
+
+    def adopt(self, shape):
+        # Moves a shape, canvas items included, from its current store to this one
+        old, row = shape.store, shape.row
+        if old is self:
+            return
+        items = old.items[row * ITEM_SLOTS:(row + 1) * ITEM_SLOTS]
+        self.add(shape, old.x[row], old.y[row], old.width[row], old.height[row],
+                 old.gpio[row], old.flags[row], old.signals[row])
+        self.drawn_signals[shape.row] = old.drawn_signals[row]
+        self.items[shape.row * ITEM_SLOTS:(shape.row + 1) * ITEM_SLOTS] = items
+        old.release(row)
+
+    def release(self, row):
+        self.shapes[row] = None
+        self.gpio[row] = None
+        self.free.append(row)
+
+    def forget_items(self, row):
+        self.items[row * ITEM_SLOTS:(row + 1) * ITEM_SLOTS] = EMPTY_ITEMS
+        self.drawn_signals[row] = NOT_DRAWN
+
+    def take_items(self, row, old, old_row):
+        # Moves the canvas items of a row in another store to this row and
+        # flags whatever differs from what they show
+        self.items[row * ITEM_SLOTS:(row + 1) * ITEM_SLOTS] = old.items[old_row * ITEM_SLOTS:(old_row + 1) * ITEM_SLOTS]
+        self.drawn_signals[row] = old.drawn_signals[old_row]
+        flags = old.flags[old_row] & (MOVED | GPIO_CHANGED)
+        if ((self.x[row], self.y[row], self.width[row], self.height[row])
+                != (old.x[old_row], old.y[old_row], old.width[old_row], old.height[old_row])
+                or (self.flags[row] ^ old.flags[old_row]) & SWAPPED):
+            flags |= MOVED
+        if self.gpio[row] != old.gpio[old_row]:
+            flags |= GPIO_CHANGED
+        self.flags[row] |= flags
+        old.forget_items(old_row)
+
+
+# Shapes made outside a layout live here until Layout adopts them
+loose_shapes = ShapeStore()
+
+
+def geometry_column(column):
+    get_column = attrgetter(column)
+
+    def get(shape):
+        return coordinate(get_column(shape.store)[shape.row])
+
+    def set(shape, value):
+        store = shape.store
+        get_column(store)[shape.row] = value
+        store.flags[shape.row] |= MOVED
+
+    return property(get, set)
+
+
+def flag_bit(bit, changes):
+    def get(shape):
+        return bool(shape.store.flags[shape.row] & bit)
+
+    def set(shape, value):
+        flags = shape.store.flags
+        flags[shape.row] = (flags[shape.row] | bit if value else flags[shape.row] & ~bit) | changes
+
+    return property(get, set)
+
+
+def signal_bit(bit):
+    def get(shape):
+        return bool(shape.store.signals[shape.row] & bit)
+
+    def set(shape, value):
+        signals = shape.store.signals
+        signals[shape.row] = signals[shape.row] | bit if value else signals[shape.row] & ~bit
+
+    return property(get, set)
+
+
+def item_column(slot):
+    def get(shape):
+        return shape.store.items[shape.row * ITEM_SLOTS + slot] or None
+
+    def set(shape, value):
+        shape.store.items[shape.row * ITEM_SLOTS + slot] = value or 0
+
+    return property(get, set)
+
+
+def gpio_column():
+    def get(shape):
+        return shape.store.gpio[shape.row]
+
+    def set(shape, value):
+        shape.store.gpio[shape.row] = value
+        shape.store.flags[shape.row] |= GPIO_CHANGED
+
+    return property(get, set)
+
+
+class Rectangle:
+    __slots__ = ("store", "row", "name", "spatial_index", "canvas_tag")
+
+    x = geometry_column("x")
+    y = geometry_column("y")
+    width = geometry_column("width")
+    height = geometry_column("height")
+    gpio = gpio_column()
+    points_swapped = flag_bit(SWAPPED, MOVED)
+    red_signal = signal_bit(RED)
+    blue_signal = signal_bit(BLUE)
+    yellow_signal = signal_bit(YELLOW)
+
+    canvas_item = item_column(CANVAS_ITEM)
+    text_item = item_column(TEXT_ITEM)
+    gpio_text_item = item_column(GPIO_TEXT_ITEM)
+    p1_item = item_column(P1_ITEM)  # Input point (left)
+    p2_item = item_column(P2_ITEM)  # Output point (right)
+    red_box = item_column(RED_BOX)
+    blue_box = item_column(BLUE_BOX)
+    yellow_box = item_column(YELLOW_BOX)
+
+    def __init__(self, name, x, y, width, height, gpio=None, store=None):
+        self.name = name
+        (store if store is not None else loose_shapes).add(self, x, y, width, height, gpio)
+        if gpio is not None:
+            self.setup_gpio()
+        self.spatial_index = None
+        self.canvas_tag = None
+
+    @property
+    def tag(self):
+        # Shared canvas tag so all of the rectangle's items can be moved together
+        if self.canvas_tag is None:
+            self.canvas_tag = f"shape{next(canvas_tags)}"
+        return self.canvas_tag
+
+    @property
+    def p1(self):
+        # Input point, the left edge unless the points are swapped
+        store, row = self.store, self.row
+        x = store.x[row] + (store.width[row] if store.flags[row] & SWAPPED else 0)
+        return (x, store.y[row] + store.height[row] / 2)
+
+    @property
+    def p2(self):
+        store, row = self.store, self.row
+        x = store.x[row] + (0 if store.flags[row] & SWAPPED else store.width[row])
+        return (x, store.y[row] + store.height[row] / 2)
+
+    def simulate_gpio(self):
+        import random
+        return random.choice([GPIO.HIGH, GPIO.LOW])
+
+    def get_gpio_state(self, simulating):
+        if self.gpio is None:
+            return None
+        if simulating:
+            return self.simulate_gpio()
+        else:
+            return self.read_gpio()
+
+    def setup_gpio(self):
+        # Remote pins are set up by the agent on their own Pi
+        if self.gpio is not None and not is_remote_pin(self.gpio):
+            GPIO.setup(self.gpio, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+
+    def update_gpio(self, new_gpio):
+        if self.gpio is not None and not is_remote_pin(self.gpio):
+            GPIO.cleanup(self.gpio)
+        self.gpio = new_gpio
+        if self.gpio is not None:
+            self.setup_gpio()
+
+    def read_gpio(self):
+        if self.gpio is not None and backend_for(self.gpio):
+            return backend_for(self.gpio).input(self.gpio)
+        return None
+
+    def set_mock_gpio(self, value):
+        if self.gpio is not None:
+            GPIO.set_mock_value(self.gpio, value)
+
+    def draw(self, canvas):
+        # Items are created once and then updated in place, and only when
+        # the geometry, label or signals differ from what is on the canvas
+        store, row = self.store, self.row
+
+        if self.canvas_item is None:
+            self.create_items(canvas)
+        elif store.flags[row] & MOVED:
+            self.update_item_coords(canvas)
+
+        if store.flags[row] & GPIO_CHANGED:
+            self.draw_gpio_text(canvas)
+
+        signals = store.signals[row]
+        if signals != store.drawn_signals[row]:
+            canvas.itemconfig(self.red_box, fill="red" if signals & RED else "gray")
+            canvas.itemconfig(self.blue_box, fill="blue" if signals & BLUE else "gray")
+            canvas.itemconfig(self.yellow_box, fill="yellow" if signals & YELLOW else "gray")
+
+        store.drawn_signals[row] = signals
+        store.flags[row] &= ~MOVED
+
+    def create_items(self, canvas):
+        store, row = self.store, self.row
+        x, y, width, height = store.x[row], store.y[row], store.width[row], store.height[row]
+        p1, p2 = self.p1, self.p2
+        signals = store.signals[row]
+        tag = self.tag
+        canvas_item = canvas.create_rectangle(
+            x, y, x + width, y + height,
+            outline="black", fill="lightblue", tags=tag
+        )
+        text_item = canvas.create_text(
+            x + 5, y + 5,
+            text=self.name,
+            anchor="nw",
+            font=("Arial", 10),
+            fill="black", tags=tag
+        )
+
+        point_radius = 3
+        p1_item = canvas.create_oval(
+            p1[0] - point_radius, p1[1] - point_radius,
+            p1[0] + point_radius, p1[1] + point_radius,
+            fill="blue", tags=tag
+        )
+        p2_item = canvas.create_oval(
+            p2[0] - point_radius, p2[1] - point_radius,
+            p2[0] + point_radius, p2[1] + point_radius,
+            fill="red", tags=tag
+        )
+
+        # Draw wider colored boxes with padding
+        red_box, blue_box, yellow_box = self.signal_box_coords()
+        red_box = canvas.create_rectangle(
+            *red_box, fill="red" if signals & RED else "gray", outline="", tags=tag
+        )
+        blue_box = canvas.create_rectangle(
+            *blue_box, fill="blue" if signals & BLUE else "gray", outline="", tags=tag
+        )
+        yellow_box = canvas.create_rectangle(
+            *yellow_box, fill="yellow" if signals & YELLOW else "gray", outline="", tags=tag
+        )
+
+        # The gpio label is drawn by draw_gpio_text
+        store.items[row * ITEM_SLOTS:(row + 1) * ITEM_SLOTS] = array(
+            "I", (canvas_item, text_item, 0, p1_item, p2_item, red_box, blue_box, yellow_box)
+        )
+        store.flags[row] |= GPIO_CHANGED
+        store.drawn_signals[row] = signals
+
+    def update_item_coords(self, canvas):
+        x, y, width, height = self.x, self.y, self.width, self.height
+        p1, p2 = self.p1, self.p2
+        canvas.coords(self.canvas_item, x, y, x + width, y + height)
+        canvas.coords(self.text_item, x + 5, y + 5)
+        if self.gpio_text_item:
+            canvas.coords(self.gpio_text_item, x + 5, y + 20)
+
+        point_radius = 3
+        canvas.coords(
+            self.p1_item,
+            p1[0] - point_radius, p1[1] - point_radius,
+            p1[0] + point_radius, p1[1] + point_radius
+        )
+        canvas.coords(
+            self.p2_item,
+            p2[0] - point_radius, p2[1] - point_radius,
+            p2[0] + point_radius, p2[1] + point_radius
+        )
+
+        red_box, blue_box, yellow_box = self.signal_box_coords()
+        canvas.coords(self.red_box, *red_box)
+        canvas.coords(self.blue_box, *blue_box)
+        canvas.coords(self.yellow_box, *yellow_box)
+
+    def draw_gpio_text(self, canvas):
+        gpio = self.gpio
+        if gpio is None:
+            if self.gpio_text_item:
+                canvas.delete(self.gpio_text_item)
+                self.gpio_text_item = None
+        elif self.gpio_text_item:
+            canvas.itemconfig(self.gpio_text_item, text=f"gpio: {gpio}")
+        else:
+            self.gpio_text_item = canvas.create_text(
+                self.x + 5, self.y + 20,
+                text=f"gpio: {gpio}",
+                anchor="nw",
+                font=("Arial", 8),
+                fill="black", tags=self.tag
+            )
+        self.store.flags[self.row] &= ~GPIO_CHANGED
+
+    def signal_box_coords(self):
+        store, row = self.store, self.row
+        box_width = 30
+        box_height = (store.height[row] - 20) / 3
+        box_x = store.x[row] + store.width[row] - box_width - 5
+        box_y = store.y[row] + 10
+        return [
+            (box_x, box_y + i * box_height, box_x + box_width, box_y + (i + 1) * box_height)
+            for i in range(3)
+        ]
+
+    def forget_canvas_items(self):
+        # The canvas was cleared behind our back, next draw starts from scratch
+        self.store.forget_items(self.row)
+
+    def take_canvas_items(self, other):
+        # Reuse the items of the rectangle this one replaces, e.g. the one of
+        # the same name before a reload, draw() then only updates what differs
+        self.store.take_items(self.row, other.store, other.row)
+        self.canvas_tag = other.canvas_tag
+
+    def move_to(self, new_x, new_y):
+        store, row = self.store, self.row
+        store.x[row] = new_x
+        store.y[row] = new_y
+        store.flags[row] |= MOVED
+        if self.spatial_index is not None:
+            self.spatial_index.update(self)
+
+    def resize(self, new_width, new_height):
+        store, row = self.store, self.row
+        store.width[row] = new_width
+        store.height[row] = new_height
+        store.flags[row] |= MOVED
+        if self.spatial_index is not None:
+            self.spatial_index.update(self)
+
+    def shift(self, canvas, dx, dy):
+        self.move_to(self.x + dx, self.y + dy)
+        if self.canvas_item is None:
+            self.draw(canvas)
+            return
+        canvas.move(self.tag, dx, dy)
+        self.store.flags[self.row] &= ~MOVED
+
+    def get_bounds(self):
+        store, row = self.store, self.row
+        x, y = store.x[row], store.y[row]
+        x2, y2 = x + store.width[row], y + store.height[row]
+        return (min(x, x2), min(y, y2), max(x, x2), max(y, y2))
+
+    def switch_points(self):
+        self.points_swapped = not self.points_swapped
+
+    def set_signal(self, color, signal):
+        if color not in SIGNAL_BITS:
+            raise ValueError("Invalid color. Use 'red', 'blue', or 'yellow'.")
+        signals = self.store.signals
+        bit = SIGNAL_BITS[color]
+        signals[self.row] = signals[self.row] | bit if signal else signals[self.row] & ~bit
+        if color == "red" and self.gpio is not None:
+            GPIO.set_mock_value(self.gpio, GPIO.HIGH if signal else GPIO.LOW)
+
+    def get_signal(self, color):
+        if color not in SIGNAL_BITS:
+            raise ValueError("Invalid color. Use 'red', 'blue', or 'yellow'.")
+        return bool(self.store.signals[self.row] & SIGNAL_BITS[color])
+
+    def get_gpio_state(self, simulating):
+        if self.gpio is None:
+            return None
+        return self.read_gpio()
+
+
+class Line:
+    __slots__ = ("name", "start_shape", "end_shape", "start_is_output", "canvas_item", "drawn_coords",
+                 "x1", "y1", "x2", "y2")
+
+    def __init__(self, name, start_shape, end_shape, start_is_output=True):
+        self.name = name
+        self.start_shape = start_shape
+        self.end_shape = end_shape
+        self.start_is_output = start_is_output
+        self.canvas_item = None
+        self.drawn_coords = None
+        self.update_coordinates()
+
+    def update_coordinates(self):
+        if isinstance(self.start_shape, Rectangle):
+            self.x1, self.y1 = self.start_shape.p2 if self.start_is_output else self.start_shape.p1
+        else:  # Point
+            self.x1, self.y1 = self.start_shape.x, self.start_shape.y
+
+        if isinstance(self.end_shape, Rectangle):
+            self.x2, self.y2 = self.end_shape.p1 if self.start_is_output else self.end_shape.p2
+        else:  # Point
+            self.x2, self.y2 = self.end_shape.x, self.end_shape.y
+
+    def draw(self, canvas):
+        coords = (self.x1, self.y1, self.x2, self.y2)
+        if self.canvas_item is None:
+            self.canvas_item = canvas.create_line(*coords, fill="red", width=2)
+        elif coords != self.drawn_coords:
+            canvas.coords(self.canvas_item, *coords)
+        self.drawn_coords = coords
+
+    def forget_canvas_items(self):
+        self.canvas_item = None
+        self.drawn_coords = None
+
+    def take_canvas_items(self, other):
+        self.canvas_item = other.canvas_item
+        self.drawn_coords = other.drawn_coords
+        other.forget_canvas_items()
+
+class Point:
+    __slots__ = ("store", "row", "name", "spatial_index", "canvas_tag")
+
+    x = geometry_column("x")
+    y = geometry_column("y")
+    is_visible = flag_bit(VISIBLE, 0)
+    canvas_item = item_column(CANVAS_ITEM)
+    text_item = item_column(TEXT_ITEM)
+
+    def __init__(self, name, x, y, store=None):
+        self.name = name
+        (store if store is not None else loose_shapes).add(self, x, y, flags=VISIBLE)
+        self.spatial_index = None
+        self.canvas_tag = None
+
+    @property
+    def tag(self):
+        if self.canvas_tag is None:
+            self.canvas_tag = f"shape{next(canvas_tags)}"
+        return self.canvas_tag
+
+    def draw(self, canvas):
+        if not self.is_visible:
+            if self.canvas_item:
+                canvas.delete(self.canvas_item)
+            if self.text_item:
+                canvas.delete(self.text_item)
+            self.forget_canvas_items()
+            return
+
+        x, y = self.x, self.y
+        point_radius = 3
+        if self.canvas_item is None:
+            self.canvas_item = canvas.create_oval(
+                x - point_radius, y - point_radius,
+                x + point_radius, y + point_radius,
+                fill="black", tags=self.tag
+            )
+            self.text_item = canvas.create_text(
+                x, y - 15,
+                text=self.name,
+                anchor="center",
+                font=("Arial", 8),
+                fill="black", tags=self.tag
+            )
+        elif self.store.flags[self.row] & MOVED:
+            canvas.coords(
+                self.canvas_item,
+                x - point_radius, y - point_radius,
+                x + point_radius, y + point_radius
+            )
+            canvas.coords(self.text_item, x, y - 15)
+        self.store.flags[self.row] &= ~MOVED
+
+    def forget_canvas_items(self):
+        self.store.forget_items(self.row)
+
+    def take_canvas_items(self, other):
+        self.store.take_items(self.row, other.store, other.row)
+        self.canvas_tag = other.canvas_tag
+
+    def move_to(self, new_x, new_y):
+        store, row = self.store, self.row
+        store.x[row] = new_x
+        store.y[row] = new_y
+        store.flags[row] |= MOVED
+        if self.spatial_index is not None:
+            self.spatial_index.update(self)
+
+    def shift(self, canvas, dx, dy):
+        self.move_to(self.x + dx, self.y + dy)
+        if self.canvas_item is None:
+            self.draw(canvas)
+            return
+        canvas.move(self.tag, dx, dy)
+        self.store.flags[self.row] &= ~MOVED
+
+    def get_bounds(self):
+        # Points are picked within 5 pixels of their centre
+        x, y = self.store.x[self.row], self.store.y[self.row]
+        return (x - 5, y - 5, x + 5, y + 5)
+
+    def toggle_visibility(self):
+        self.is_visible = not self.is_visible
+
+    # Addded these methods to make Points compatible with the existing Rectangle interface
+    @property
+    def width(self):
+        return 0
+
+    @property
+    def height(self):
+        return 0
+
+    @property
+    def p1(self):
+        return (self.x, self.y)
+
+    @property
+    def p2(self):
+        return (self.x, self.y)
+
+class SpatialGrid:
+    # Uniform grid over shape bounds. Each shape is listed in every cell its
+    # bounds overlap, so point and region queries only look at nearby shapes.
+    # Cells are short lists, a set per cell costs more than the shape itself.
+    def __init__(self, cell_size=100):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.entries = {}  # shape -> (bounds, insertion order)
+        self.counter = 0
+
+    def cells_for(self, bounds):
+        x1, y1, x2, y2 = bounds
+        size = self.cell_size
+        return [
+            (col, row)
+            for col in range(int(x1 // size), int(x2 // size) + 1)
+            for row in range(int(y1 // size), int(y2 // size) + 1)
+        ]
+
+    def insert(self, shape, order=None):
+        if shape in self.entries:
+            self.remove(shape)
+        if order is None:
+            order = self.counter
+            self.counter += 1
+        bounds = shape.get_bounds()
+        for cell in self.cells_for(bounds):
+            self.cells.setdefault(cell, []).append(shape)
+        self.entries[shape] = (bounds, order)
+        shape.spatial_index = self
+
+    def remove(self, shape):
+        entry = self.entries.pop(shape, None)
+        if entry is None:
+            return
+        for cell in self.cells_for(entry[0]):
+            members = self.cells[cell]
+            members.remove(shape)
+            if not members:
+                del self.cells[cell]
+        shape.spatial_index = None
+
+    def update(self, shape):
+        entry = self.entries.get(shape)
+        if entry is None or entry[0] == shape.get_bounds():
+            return
+        self.insert(shape, order=entry[1])
+
+    def clear(self):
+        for shape in self.entries:
+            shape.spatial_index = None
+        self.cells.clear()
+        self.entries.clear()
+
+    def query_point(self, x, y):
+        size = self.cell_size
+        hits = []
+        for shape in self.cells.get((int(x // size), int(y // size)), ()):
+            x1, y1, x2, y2 = self.entries[shape][0]
+            if x1 <= x <= x2 and y1 <= y <= y2:
+                hits.append(shape)
+        hits.sort(key=lambda shape: self.entries[shape][1])
+        return hits
+
+    def query_region(self, x1, y1, x2, y2):
+        # Shapes whose bounds overlap the region, in insertion order
+        candidates = set()
+        for cell in self.cells_for((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))):
+            candidates.update(self.cells.get(cell, ()))
+        hits = []
+        for shape in candidates:
+            bx1, by1, bx2, by2 = self.entries[shape][0]
+            if bx1 <= max(x1, x2) and min(x1, x2) <= bx2 and by1 <= max(y1, y2) and min(y1, y2) <= by2:
+                hits.append(shape)
+        hits.sort(key=lambda shape: self.entries[shape][1])
+        return hits
+
+class LayoutError(ValueError):
+    pass
+
+
+def compile_layout(canvas_state):
+    # First loading phase: validate a parsed layout file into plain tuples.
+    # Raises LayoutError naming the bad entry, nothing is built before that.
+    def check(condition, where, message):
+        if not condition:
+            raise LayoutError(f"{where}: {message}")
+
+    def number(data, key, where):
+        value = data.get(key)
+        check(isinstance(value, (int, float)) and not isinstance(value, bool), where, f"{key} must be a number")
+        return value
+
+    def name(data, key, where):
+        value = data.get(key)
+        check(isinstance(value, str) and value != "", where, f"{key} must be a non-empty string")
+        return value
+
+    check(isinstance(canvas_state, dict), "layout", "must be a JSON object")
+    for key in ("rectangles", "lines"):
+        check(isinstance(canvas_state.get(key), list), "layout", f"'{key}' must be a list")
+    check(isinstance(canvas_state.get("points", []), list), "layout", "'points' must be a list")
+
+    rect_rows = []
+    for i, rect_data in enumerate(canvas_state["rectangles"]):
+        where = f"rectangles[{i}]"
+        check(isinstance(rect_data, dict), where, "must be an object")
+        try:
+            gpio = parse_pin(rect_data.get("gpio"))
+        except ValueError:
+            gpio = False
+        check(gpio is not False, where, "gpio must be an integer, \"node:pin\" or null")
+        rect_rows.append((
+            name(rect_data, "name", where),
+            number(rect_data, "x", where),
+            number(rect_data, "y", where),
+            number(rect_data, "width", where),
+            number(rect_data, "height", where),
+            gpio or None,  # 0 means no pin
+            bool(rect_data.get("points_swapped", False)),
+            bool(rect_data.get("red_signal", False)),
+            bool(rect_data.get("blue_signal", False)),
+            bool(rect_data.get("yellow_signal", False))
+        ))
+
+    point_rows = []
+    for i, point_data in enumerate(canvas_state.get("points", [])):
+        where = f"points[{i}]"
+        check(isinstance(point_data, dict), where, "must be an object")
+        point_rows.append((
+            name(point_data, "name", where),
+            number(point_data, "x", where),
+            number(point_data, "y", where),
+            bool(point_data.get("is_visible", True))
+        ))
+
+    shape_names = {row[0] for row in rect_rows} | {row[0] for row in point_rows}
+    line_rows = []
+    for i, line_data in enumerate(canvas_state["lines"]):
+        where = f"lines[{i}]"
+        check(isinstance(line_data, dict), where, "must be an object")
+        row = (
+            name(line_data, "name", where),
+            name(line_data, "start_shape", where),
+            name(line_data, "end_shape", where),
+            bool(line_data.get("start_is_output", True))
+        )
+        missing = [shape for shape in row[1:3] if shape not in shape_names]
+        if missing:
+            print(f"Skipping line '{row[0]}': unknown shape '{missing[0]}'")
+            continue
+        line_rows.append(row)
+
+    return (tuple(rect_rows), tuple(point_rows), tuple(line_rows))
+
+
+def layout_cache_path(file_path):
+    directory, filename = os.path.split(os.path.abspath(file_path))
+    return os.path.join(directory, f".{filename}.cache")
+
+
+def read_compiled_layout(file_path, use_cache=True):
+    # Compiled layouts are cached next to the file with marshal, keyed by the
+    # path, mtime and size, so restarting with an unchanged layout skips JSON
+    # parsing and validation
+    stat = os.stat(file_path)
+    key = (LAYOUT_CACHE_VERSION, sys.implementation.cache_tag, os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+    cache_path = layout_cache_path(file_path)
+
+    if use_cache:
+        try:
+            # loads() on the whole file, marshal.load() on a file object reads in tiny chunks
+            with open(cache_path, 'rb') as f:
+                cached_key, compiled = marshal.loads(f.read())
+            if cached_key == key:
+                return compiled
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+    with open(file_path, 'r') as f:
+        compiled = compile_layout(json.load(f))
+
+    if use_cache:
+        try:
+            temp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(marshal.dumps((key, compiled)))
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            print(f"Could not write layout cache {cache_path}: {str(e)}")
+
+    return compiled
+
+
+class Layout:
+    # The shapes of a layout file, their connections and the indexes over them.
+    # Nothing here touches tkinter, so it is shared by the UI and --headless.
+    def __init__(self):
+        self.rectangles = {}
+        self.lines = {}
+        self.points = {}
+        # Columns behind the rectangles and points, see ShapeStore
+        self.store = ShapeStore()
+        # Adjacency index: shape name -> {line name: Line}
+        self.outgoing_lines = {}
+        self.incoming_lines = {}
+        self.shape_index = SpatialGrid()
+        # GPIO pin -> rectangles and store rows, as of the last gpio_rectangles() call
+        self.pin_rectangles = None
+        self.pin_rows = None
+
+    def clear(self):
+        self.rectangles.clear()
+        self.lines.clear()
+        self.points.clear()
+        # Dropped shapes keep the old store, so references to them stay valid
+        self.store = ShapeStore()
+        self.outgoing_lines.clear()
+        self.incoming_lines.clear()
+        self.shape_index.clear()
+        self.pin_rectangles = None
+        self.pin_rows = None
+
+    def get_shape_by_name(self, name):
+        return self.rectangles.get(name) or self.points.get(name)
+
+    def add_rectangle(self, rect):
+        self.drop_shape(self.rectangles.get(rect.name), rect)
+        self.store.adopt(rect)
+        self.rectangles[rect.name] = rect
+        self.shape_index.insert(rect)
+
+    def add_point(self, point):
+        self.drop_shape(self.points.get(point.name), point)
+        self.store.adopt(point)
+        self.points[point.name] = point
+        self.shape_index.insert(point)
+
+    def drop_shape(self, shape, replacement):
+        if shape is not None and shape is not replacement:
+            self.shape_index.remove(shape)
+            ShapeStore().adopt(shape)
+        # A new shape can take a freed row, the pin maps hold rows
+        self.pin_rectangles = None
+        self.pin_rows = None
+
+    def add_line(self, line):
+        if line.name in self.lines:
+            self.remove_line(line.name)
+        self.lines[line.name] = line
+        self.outgoing_lines.setdefault(line.start_shape.name, {})[line.name] = line
+        self.incoming_lines.setdefault(line.end_shape.name, {})[line.name] = line
+
+    def remove_line(self, line_name):
+        line = self.lines.pop(line_name)
+        self.outgoing_lines.get(line.start_shape.name, {}).pop(line_name, None)
+        self.incoming_lines.get(line.end_shape.name, {}).pop(line_name, None)
+        return line
+
+    def get_shape_lines(self, shape):
+        # Lines touching the shape, a self-connection is only listed once
+        lines = dict(self.outgoing_lines.get(shape.name, {}))
+        lines.update(self.incoming_lines.get(shape.name, {}))
+        return list(lines.values())
+
+    def get_connected_with_info(self, shape_name):
+        shape = self.get_shape_by_name(shape_name)
+        if not shape:
+            return []
+
+        connected = []
+
+        for line in self.outgoing_lines.get(shape.name, {}).values():
+            connected.append((line.end_shape, True, line.name))
+        for line in self.incoming_lines.get(shape.name, {}).values():
+            if line.start_shape != shape:
+                connected.append((line.start_shape, False, line.name))
+
+        return connected
+
+    def adjacent_rectangles(self, shape):
+        # Rectangles joined to the shape in either direction, looking through points
+        found = []
+        seen = {shape.name}
+        pending = [shape]
+        while pending:
+            current = pending.pop()
+            adjacent = [line.end_shape for line in self.outgoing_lines.get(current.name, {}).values()]
+            adjacent += [line.start_shape for line in self.incoming_lines.get(current.name, {}).values()]
+            for other in adjacent:
+                if other.name in seen:
+                    continue
+                seen.add(other.name)
+                if isinstance(other, Rectangle):
+                    found.append(other)
+                else:
+                    pending.append(other)
+        return found
+
+    def find_shape_at(self, x, y):
+        hits = self.shape_index.query_point(x, y)
+        # Rectangles take precedence over points, as in the original linear scan
+        for shape in hits:
+            if isinstance(shape, Rectangle):
+                return shape
+        return hits[0] if hits else None
+
+    def gpio_rectangles(self):
+        # GPIO pin -> rectangles wired to it, straight from the gpio column
+        # (points have no pin)
+        shapes = self.store.shapes
+        by_pin = {}
+        rows = {}
+        for row, pin in enumerate(list(self.store.gpio)):
+            if pin is not None:
+                by_pin.setdefault(pin, []).append(shapes[row])
+                rows.setdefault(pin, []).append(row)
+        self.pin_rectangles = by_pin
+        self.pin_rows = rows
+        return by_pin
+
+    def apply_pin_states(self, values):
+        # Drive the red signal from sampled pin values, returns the changed rectangles
+        # Uses the pin map from the last gpio_rectangles() call (GpioMonitor.refresh
+        # makes one after every pin change), so the cost only depends on values
+        changed = []
+        if not values:
+            return changed
+        if self.pin_rows is None:
+            self.gpio_rectangles()
+        pin_rows = self.pin_rows
+        signals = self.store.signals
+        shapes = self.store.shapes
+        high = GPIO.HIGH
+        for pin, value in values.items():
+            red = RED if value == high else 0
+            for row in pin_rows.get(pin, ()):
+                if signals[row] & RED != red:
+                    # Not set_signal, that would write the sample back to the mock pin
+                    # and could undo a newer value set by a simulation or replay
+                    signals[row] ^= RED
+                    changed.append(shapes[row])
+        return changed
+
+    def to_dict(self):
+        canvas_state = {
+            "rectangles": [],
+            "points": [],
+            "lines": []
+        }
+
+        # Read from the columns, not through the shape properties
+        store = self.store
+        x, y, width, height = store.x, store.y, store.width, store.height
+        gpio, flags, signals = store.gpio, store.flags, store.signals
+        for rect in self.rectangles.values():
+            row = rect.row
+            canvas_state["rectangles"].append({
+                "name": rect.name,
+                "x": coordinate(x[row]),
+                "y": coordinate(y[row]),
+                "width": coordinate(width[row]),
+                "height": coordinate(height[row]),
+                "gpio": gpio[row],  # Save the GPIO pin
+                "points_swapped": bool(flags[row] & SWAPPED),
+                "red_signal": bool(signals[row] & RED),
+                "blue_signal": bool(signals[row] & BLUE),
+                "yellow_signal": bool(signals[row] & YELLOW)
+            })
+
+        for point in self.points.values():
+            row = point.row
+            canvas_state["points"].append({
+                "name": point.name,
+                "x": coordinate(x[row]),
+                "y": coordinate(y[row]),
+                "is_visible": bool(flags[row] & VISIBLE)
+            })
+
+        for line in self.lines.values():
+            canvas_state["lines"].append({
+                "name": line.name,
+                "start_shape": line.start_shape.name,
+                "end_shape": line.end_shape.name,
+                "start_is_output": line.start_is_output
+            })
+
+        return canvas_state
+
+    def save(self, file_path):
+        with open(file_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def load(self, file_path, use_cache=True):
+        self.build(read_compiled_layout(file_path, use_cache))
+        # Edits made after the last snapshot, e.g. before a crash in --autosave mode
+        LayoutJournal.replay(file_path, self)
+
+    def load_dict(self, canvas_state):
+        self.build(compile_layout(canvas_state))
+
+    def build(self, compiled):
+        # Second loading phase: construct the shapes and indexes on the side and
+        # only swap them in once everything was built
+        rect_rows, point_rows, line_rows = compiled
+        staged = Layout()
+
+        store = staged.store
+        for name, x, y, width, height, gpio, points_swapped, red, blue, yellow in rect_rows:
+            rect = Rectangle(name, x, y, width, height, gpio, store=store)
+            store.flags[rect.row] = SWAPPED if points_swapped else 0
+            store.signals[rect.row] = (RED if red else 0) | (BLUE if blue else 0) | (YELLOW if yellow else 0)
+            staged.add_rectangle(rect)
+
+        for name, x, y, is_visible in point_rows:
+            point = Point(name, x, y, store=store)
+            point.is_visible = is_visible
+            staged.add_point(point)
+
+        # compile_layout already dropped lines with unknown endpoints
+        shapes = dict(staged.points)
+        shapes.update(staged.rectangles)
+        for name, start_name, end_name, start_is_output in line_rows:
+            staged.add_line(Line(name, shapes[start_name], shapes[end_name], start_is_output))
+
+        self.clear()
+        self.rectangles.update(staged.rectangles)
+        self.points.update(staged.points)
+        self.lines.update(staged.lines)
+        self.outgoing_lines.update(staged.outgoing_lines)
+        self.incoming_lines.update(staged.incoming_lines)
+        self.shape_index = staged.shape_index
+        self.store = store
+
+    def apply_edit(self, edit):
+        # Apply one journal entry. Every operation sets absolute values, so
+        # replaying an entry that is already part of the snapshot is harmless.
+        op = edit["op"]
+        name = edit["name"]
+        shape = self.get_shape_by_name(name)
+
+        if op == "rectangle":
+            rect = self.rectangles.get(name)
+            if rect:
+                rect.move_to(edit["x"], edit["y"])
+                rect.resize(edit["width"], edit["height"])
+                if rect.gpio != edit["gpio"]:
+                    rect.update_gpio(edit["gpio"])
+            else:
+                self.add_rectangle(Rectangle(name, edit["x"], edit["y"], edit["width"], edit["height"], edit["gpio"], store=self.store))
+        elif op == "point":
+            self.add_point(Point(name, edit["x"], edit["y"], store=self.store))
+        elif op == "connect":
+            start_shape = self.get_shape_by_name(edit["start_shape"])
+            end_shape = self.get_shape_by_name(edit["end_shape"])
+            if not start_shape or not end_shape:
+                raise LayoutError(f"cannot connect {edit['start_shape']} to {edit['end_shape']}")
+            self.add_line(Line(name, start_shape, end_shape, edit["start_is_output"]))
+        elif op == "disconnect":
+            if name in self.lines:
+                self.remove_line(name)
+        elif not shape:
+            raise LayoutError(f"no shape named '{name}'")
+        elif op == "move":
+            shape.move_to(edit["x"], edit["y"])
+        elif op == "resize":
+            shape.resize(edit["width"], edit["height"])
+        elif op == "points_swapped":
+            shape.points_swapped = edit["value"]
+        elif op == "signal":
+            shape.set_signal(edit["color"], edit["value"])
+        elif op == "point_visibility":
+            shape.is_visible = edit["value"]
+        else:
+            raise LayoutError(f"unknown journal operation '{op}'")
+
+        if shape and op in ("rectangle", "move", "resize", "points_swapped"):
+            for line in self.get_shape_lines(shape):
+                line.update_coordinates()
+
+    def signal_state(self):
+        store = self.store
+        gpio, signals = store.gpio, store.signals
+        return {
+            rect.name: {
+                "gpio": gpio[rect.row],
+                "red": bool(signals[rect.row] & RED),
+                "blue": bool(signals[rect.row] & BLUE),
+                "yellow": bool(signals[rect.row] & YELLOW)
+            }
+            for rect in list(self.rectangles.values())
+        }
+
+
+class AspectEngine:
+    # Derives the blue (proceed) and yellow (caution) aspects of each section
+    # from the occupancy, i.e. the red signal, of the sections downstream of
+    # it: yellow if one within `lookahead` sections is occupied, blue if none.
+    # A line joins an output point to an input point, so start -> end is
+    # downstream when start_is_output and end -> start otherwise. Switching a
+    # rectangle's points reverses its direction and disconnects its lines, so
+    # the lines always agree with points_swapped. Points are passed through.
+    # Only sections within `lookahead` upstream of a change are recomputed.
+    def __init__(self, layout, lookahead=ASPECT_LOOKAHEAD):
+        self.layout = layout
+        self.lookahead = lookahead
+
+    def neighbours(self, shape, downstream=True):
+        # Adjacent rectangles in one direction, looking through points
+        found = []
+        seen = {shape.name}
+        pending = [shape]
+        while pending:
+            current = pending.pop()
+            adjacent = [
+                line.end_shape for line in self.layout.outgoing_lines.get(current.name, {}).values()
+                if line.start_is_output == downstream
+            ] + [
+                line.start_shape for line in self.layout.incoming_lines.get(current.name, {}).values()
+                if line.start_is_output != downstream
+            ]
+            for other in adjacent:
+                if other.name in seen:
+                    continue
+                seen.add(other.name)
+                if isinstance(other, Rectangle):
+                    found.append(other)
+                else:
+                    pending.append(other)
+        return found
+
+    def within(self, shape, downstream):
+        # Rectangles up to lookahead sections away, nearest first
+        found = []
+        seen = {shape.name}
+        frontier = [shape]
+        for _ in range(self.lookahead):
+            next_frontier = []
+            for current in frontier:
+                for other in self.neighbours(current, downstream):
+                    if other.name not in seen:
+                        seen.add(other.name)
+                        found.append(other)
+                        next_frontier.append(other)
+            frontier = next_frontier
+        return found
+
+    def aspect(self, rect):
+        signals = self.layout.store.signals
+        caution = any(signals[other.row] & RED for other in self.within(rect, True))
+        return not caution, caution
+
+    def update(self, shapes):
+        # Call with the shapes whose occupancy or lines changed, returns the
+        # rectangles whose blue or yellow signal changed
+        affected = {}
+        for shape in shapes:
+            if isinstance(shape, Rectangle):
+                affected[shape.name] = shape
+            for other in self.within(shape, False):
+                affected[other.name] = other
+        return self.apply(affected.values())
+
+    def refresh(self):
+        return self.apply(list(self.layout.rectangles.values()))
+
+    def apply(self, rects):
+        changed = []
+        signals = self.layout.store.signals
+        for rect in rects:
+            blue, yellow = self.aspect(rect)
+            bits = signals[rect.row] & RED | (BLUE if blue else 0) | (YELLOW if yellow else 0)
+            if signals[rect.row] != bits:
+                signals[rect.row] = bits
+                changed.append(rect)
+        return changed
+
+
+class PollScheduler:
+    # Per-pin read deadlines on the monotonic clock for the poll loop, see
+    # POLL_MIN_INTERVAL. Deadlines are multiples of the pin's interval on one
+    # grid for all pins, so slow cycles don't add up to drift and the pins
+    # due at the same time are read in one wakeup, one bulk read per backend.
+    # A pin that fell more than an interval behind skips ahead instead of
+    # being read in a burst. Not thread safe, only the poll thread uses it;
+    # stats() may be read from anywhere.
+    def __init__(self, start_interval=.1, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL,
+                 caps=None, hold=POLL_HOLD):
+        self.start_interval = start_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.caps = dict(caps or {})
+        self.hold = hold
+        self.pins = frozenset()
+        self.intervals = {}
+        self.deadlines = {}
+        self.last_change = {}
+        self.hot = set()
+        # (deadline, order, pin), entries whose deadline was moved are skipped
+        self.heap = []
+        self.order = itertools.count()
+
+        self.started = monotonic()
+        self.reads = 0
+        self.late_total = 0.0
+        self.late_max = 0.0
+
+    def cap(self, pin):
+        return self.caps.get(pin, self.max_interval)
+
+    def step(self, pin, interval):
+        # Clamped to the pin's cap and rounded down to min_interval times a
+        # power of two, never below min_interval
+        slots = max(1, int(min(interval, self.cap(pin)) / self.min_interval + 1e-6))
+        return self.min_interval * (1 << (slots.bit_length() - 1))
+
+    def next_slot(self, pin, now):
+        # The first multiple of the pin's interval after now
+        slots = round(self.intervals[pin] / self.min_interval)
+        return (int(now / self.min_interval + 1e-6) // slots + 1) * slots * self.min_interval
+
+    def set_pins(self, pins, now):
+        for pin in self.pins - pins:
+            self.intervals.pop(pin, None)
+            self.deadlines.pop(pin, None)
+            self.last_change.pop(pin, None)
+            self.hot.discard(pin)
+        for pin in pins - self.pins:
+            self.intervals[pin] = self.step(pin, self.start_interval)
+            self.schedule(pin, now)
+        self.pins = pins
+
+    def schedule(self, pin, deadline):
+        self.deadlines[pin] = deadline
+        heapq.heappush(self.heap, (deadline, next(self.order), pin))
+
+    def due(self, now):
+        pins = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            deadline, _, pin = heapq.heappop(heap)
+            if self.deadlines.get(pin) != deadline:
+                continue
+            late = now - deadline
+            self.late_total += late
+            if late > self.late_max:
+                self.late_max = late
+            if perf.enabled:
+                perf.timing("poll_jitter", late)
+            pins.append(pin)
+        self.reads += len(pins)
+        return pins
+
+    def next_deadline(self):
+        heap = self.heap
+        while heap and self.deadlines.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def reschedule(self, pin, changed, now):
+        # After reading a due pin
+        if pin not in self.deadlines:
+            return
+        if changed:
+            self.last_change[pin] = now
+        if pin in self.hot or now - self.last_change.get(pin, -self.hold) < self.hold:
+            interval = self.min_interval
+        else:
+            interval = self.intervals[pin] * 2
+        self.intervals[pin] = self.step(pin, interval)
+        self.schedule(pin, self.next_slot(pin, now))
+
+    def set_hot(self, pin, hot, now):
+        # Hot pins are read at the minimum interval, e.g. next to an occupied section
+        if pin not in self.deadlines:
+            return
+        if not hot:
+            self.hot.discard(pin)
+            return
+        if pin in self.hot:
+            return
+        self.hot.add(pin)
+        self.intervals[pin] = self.step(pin, self.min_interval)
+        deadline = self.next_slot(pin, now)
+        if self.deadlines[pin] > deadline:
+            self.schedule(pin, deadline)
+
+    def stats(self):
+        elapsed = monotonic() - self.started
+        intervals = list(self.intervals.values())
+        return {
+            "pins": len(intervals),
+            "fast_pins": sum(1 for interval in intervals if interval <= self.min_interval),
+            "mean_interval_ms": 1000 * sum(intervals) / len(intervals) if intervals else None,
+            "reads": self.reads,
+            "reads_per_s": self.reads / elapsed if elapsed > 0 else None,
+            "jitter_mean_ms": 1000 * self.late_total / self.reads if self.reads else None,
+            "jitter_max_ms": 1000 * self.late_max
+        }
+
+
+class StateDeltaQueue:
+    # Hands pin states from the sampling thread to the thread that owns the
+    # layout. Only the newest value per pin is kept, so however far the consumer
+    # falls behind it never holds more than one entry per configured pin.
+    def __init__(self):
+        self.lock = Lock()
+        self.pending = {}
+        self.waiting = False
+        self.coalesced = 0
+
+    def put(self, pin, value):
+        # Returns True when the consumer needs waking up for a new batch
+        with self.lock:
+            if pin in self.pending:
+                self.coalesced += 1
+            self.pending[pin] = value
+            wake = not self.waiting
+            self.waiting = True
+        return wake
+
+    def drain(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.waiting = False
+        return pending
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+
+class LayoutJournal:
+    # Append-only log of edit operations next to a layout file, one JSON object
+    # per line in <layout>.journal. A save costs one appended line instead of
+    # rewriting the layout. compact() folds the log into a fresh snapshot: the
+    # current segment is moved to <layout>.journal.compacting on the calling
+    # thread and a background thread writes the snapshot and then drops that
+    # segment. Loading replays the snapshot plus whatever segments are left.
+    def __init__(self, layout_path, compact_every=500):
+        self.layout_path = layout_path
+        self.path = f"{layout_path}.journal"
+        self.compacting_path = f"{self.path}.compacting"
+        self.compact_every = compact_every
+        self.entries = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.entries = sum(1 for _ in f)
+        self.compaction = None
+        self.file = open(self.path, 'a')
+
+    @staticmethod
+    def replay(layout_path, layout):
+        journal_path = f"{layout_path}.journal"
+        replayed = 0
+        for path in (f"{journal_path}.compacting", journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        edit = json.loads(line)
+                    except ValueError:
+                        # Torn last line from a crash mid-write
+                        print(f"Skipping unreadable journal entry in {path}")
+                        continue
+                    try:
+                        layout.apply_edit(edit)
+                        replayed += 1
+                    except (KeyError, LayoutError) as e:
+                        print(f"Skipping journal entry {edit}: {str(e)}")
+        if replayed:
+            print(f"Replayed {replayed} journal entries for {layout_path}")
+        return replayed
+
+    def pending(self):
+        # True if the journal holds edits that are not in the layout file yet
+        return self.entries > 0 or os.path.exists(self.compacting_path)
+
+    def append(self, op, **fields):
+        # Returns True once enough entries piled up to be worth compacting
+        fields["op"] = op
+        self.file.write(json.dumps(fields) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.entries += 1
+        return self.entries >= self.compact_every
+
+    def compact(self, snapshot, wait=False):
+        # snapshot is Layout.to_dict(), taken by the caller on the thread that
+        # owns the layout so it matches the journal up to this point
+        if self.compaction and self.compaction.is_alive():
+            if not wait:
+                return False
+            self.compaction.join()
+
+        self.file.close()
+        if os.path.exists(self.compacting_path):
+            # An earlier compaction never finished, its entries are not in any
+            # snapshot on disk yet, so keep them in front of the current ones
+            with open(self.path, 'r') as src, open(self.compacting_path, 'a') as dst:
+                dst.write(src.read())
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.compacting_path)
+        self.file = open(self.path, 'a')
+        self.entries = 0
+
+        self.compaction = Thread(target=self.write_snapshot, args=(snapshot,))
+        self.compaction.daemon = True
+        self.compaction.start()
+        if wait:
+            self.compaction.join()
+        return True
+
+    def write_snapshot(self, snapshot):
+        temp_path = f"{self.layout_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(snapshot, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.layout_path)
+            os.remove(self.compacting_path)
+        except OSError as e:
+            print(f"Error compacting journal into {self.layout_path}: {str(e)}")
+
+    def close(self, snapshot=None):
+        if snapshot is not None:
+            self.compact(snapshot, wait=True)
+        elif self.compaction:
+            self.compaction.join()
+        self.file.close()
+
+
+class GpioMonitor:
+    # Samples the GPIO pins used by a layout, from edge events or from the poll
+    # loop as a fallback, and reports pin changes as (pin, value) to listeners.
+    # Listeners run on the sampling (or RPi.GPIO event) thread. The sampler only
+    # sees the pin set published by refresh(), never the layout's dicts, so
+    # applying the values to rectangles is up to the thread that owns them.
+    # The poll loop reads each pin on its own schedule (PollScheduler),
+    # pin_caps maps a pin to its longest interval, None to the default one.
+    # With sampler_process the local pins are read by a separate process
+    # (sampler.py) and reach the listeners like edge events. With a runtime
+    # (runtime.py) the poll loop runs as a task on its event loop instead of
+    # a thread of its own.
+    def __init__(self, layout, edge_events=True, poll_interval=.1, pin_caps=None, sampler_process=False, runtime=None):
+        self.layout = layout
+        self.runtime = runtime
+        self.edge_events = edge_events
+        self.poll_interval = poll_interval
+        self.listeners = []
+        self.pins = frozenset()
+        self.local_pins = frozenset()
+        self.remote_pins = frozenset()
+        self.pin_names = {}
+        # Pin -> pins of the sections next to it
+        self.pin_neighbours = {}
+        self.values = {}
+
+        caps = dict(pin_caps or {})
+        self.scheduler = PollScheduler(poll_interval, max_interval=caps.pop(None, POLL_MAX_INTERVAL), caps=caps)
+
+        self.polling = False
+        self.poll_thread = None
+        self.last_poll = None
+        self.gpio_events = False
+
+        self.sampler = None
+        if sampler_process:
+            from sampler import ProcessSampler
+            self.sampler = ProcessSampler()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def start(self):
+        self.publish_pins()
+        if self.sampler:
+            watching = self.sampler.running
+            self.sampler.start(self.local_pins, watch=self.runtime is None)
+            if self.runtime and not watching:
+                self.runtime.watch_sampler(self.sampler)
+        if (self.edge_events or self.sampler) and self.start_gpio_events():
+            return
+        if not self.polling:
+            self.polling = True
+            self.publish_neighbours(self.layout.pin_rectangles or self.layout.gpio_rectangles())
+            if self.runtime:
+                self.runtime.run_polling(self)
+                return
+            self.poll_thread = Thread(target=self.poll_gpio)
+            self.poll_thread.daemon = True
+            self.poll_thread.start()
+
+    def stop(self):
+        self.stop_gpio_events()
+        self.polling = False
+        if self.poll_thread and self.poll_thread.is_alive():
+            self.poll_thread.join(timeout=1)
+        if self.sampler:
+            self.sampler.stop()
+
+    def refresh(self):
+        # Call from the layout's thread after rectangles or their pins changed
+        self.publish_pins()
+        if self.sampler and self.sampler.running:
+            self.sampler.start(self.local_pins)
+        if self.gpio_events:
+            self.sync_gpio_events()
+        self.sample(force=True)
+
+    def publish_pins(self):
+        # Fresh objects for the sampler, e.g. pin_names labels recorded transitions
+        rects_by_pin = self.layout.gpio_rectangles()
+        self.pin_names = {pin: ",".join(rect.name for rect in rects) for pin, rects in rects_by_pin.items()}
+        self.local_pins = frozenset(pin for pin in rects_by_pin if not is_remote_pin(pin))
+        self.remote_pins = frozenset(pin for pin in rects_by_pin if is_remote_pin(pin))
+        if self.remote_pins and remote_gpio is None:
+            print(f"{len(self.remote_pins)} remote pins are not read, start with --agents to accept agents")
+        if self.polling:
+            self.publish_neighbours(rects_by_pin)
+        self.pins = frozenset(rects_by_pin)
+
+    def publish_neighbours(self, rects_by_pin):
+        # Only the poll loop uses these
+        neighbours = {}
+        for pin, rects in rects_by_pin.items():
+            near = {other.gpio for rect in rects for other in self.layout.adjacent_rectangles(rect)}
+            near.discard(None)
+            near.discard(pin)
+            if near:
+                neighbours[pin] = tuple(near)
+        self.pin_neighbours = neighbours
+
+    def backends(self):
+        # (backend, pins) pairs, remote pins only once agents are accepted
+        yield self.sampler or GPIO, self.local_pins
+        if remote_gpio is not None:
+            yield remote_gpio, self.remote_pins
+
+    def backend_for(self, pin):
+        if self.sampler and not is_remote_pin(pin):
+            return self.sampler
+        return backend_for(pin)
+
+    def start_gpio_events(self):
+        if not hasattr(self.sampler or GPIO, "add_event_detect"):
+            print("GPIO backend has no edge detection, falling back to polling")
+            return False
+        try:
+            self.gpio_events = True
+            self.sync_gpio_events()
+        except (AttributeError, RuntimeError) as e:
+            print(f"GPIO edge detection unavailable, falling back to polling: {e}")
+            self.stop_gpio_events()
+            return False
+        # Edges only report changes, so pick up the current state once
+        self.sample(force=True)
+        print(f"Watching {sum(len(backend.event_callbacks) for backend, _ in self.backends())} GPIO pins for edges")
+        return True
+
+    def stop_gpio_events(self):
+        if not self.gpio_events:
+            return
+        self.gpio_events = False
+        for backend, _ in self.backends():
+            for pin in list(getattr(backend, "event_callbacks", {})):
+                try:
+                    backend.remove_event_detect(pin)
+                except RuntimeError as e:
+                    print(f"Error removing edge detection for GPIO {pin}: {str(e)}")
+
+    def sync_gpio_events(self):
+        for backend, pins in self.backends():
+            watched = set(backend.event_callbacks)
+            for pin in watched - pins:
+                backend.remove_event_detect(pin)
+            for pin in pins - watched:
+                backend.add_event_detect(pin, self.on_gpio_edge, bouncetime=GPIO_BOUNCE_MS)
+
+    def on_gpio_edge(self, channel):
+        if channel not in self.pins:
+            return
+        try:
+            value = self.backend_for(channel).input(channel)
+        except Exception as e:
+            print(f"Error reading GPIO {channel} after edge: {str(e)}")
+            return
+        self.update_pin(channel, value)
+
+    def poll_gpio(self):
+        while self.polling:
+            delay = self.poll_once()
+            if delay > 0:
+                sleep(delay)
+
+    def poll_once(self):
+        # Reads the pins that are due, see PollScheduler, and returns the
+        # seconds until the next one is. Never more than poll_interval, so
+        # the loop notices stop() and a new pin set.
+        scheduler = self.scheduler
+        now = monotonic()
+        if scheduler.pins is not self.pins:
+            scheduler.set_pins(self.pins, now)
+            for pin in self.pins:
+                scheduler.set_hot(pin, self.next_to_occupied(pin), now)
+        due = scheduler.due(now)
+        if due:
+            if perf.enabled:
+                perf.sample("poll_batch", len(due))
+                if self.last_poll is not None:
+                    perf.timing("poll_period", now - self.last_poll)
+                self.last_poll = now
+            self.sample_due(due, now)
+        deadline = scheduler.next_deadline()
+        return self.poll_interval if deadline is None else min(deadline - monotonic(), self.poll_interval)
+
+    def sample_due(self, pins, now):
+        scheduler = self.scheduler
+        try:
+            values = {}
+            for backend, backend_pins in self.backends():
+                wanted = [pin for pin in pins if pin in backend_pins]
+                if wanted:
+                    values.update(backend.read_snapshot(wanted))
+        except Exception as e:
+            print(f"Error reading GPIO snapshot: {str(e)}")
+            values = {}
+        changed = []
+        for pin in pins:
+            if pin not in values:
+                scheduler.reschedule(pin, False, now)
+                continue
+            value = values[pin]
+            moved = self.values.get(pin) != value
+            if moved:
+                changed.append(pin)
+            scheduler.reschedule(pin, moved, now)
+            self.update_pin(pin, value)
+        # A train entering or leaving a section is next seen on a neighbour
+        for pin in changed:
+            for other in self.pin_neighbours.get(pin, ()):
+                scheduler.set_hot(other, self.next_to_occupied(other), now)
+
+    def next_to_occupied(self, pin):
+        high = GPIO.HIGH
+        return any(self.values.get(other) == high for other in self.pin_neighbours.get(pin, ()))
+
+    def poll_stats(self):
+        # Read rates and deadline jitter of the poll loop, for monitoring
+        stats = self.scheduler.stats()
+        stats["polling"] = self.polling
+        if self.sampler:
+            stats["sampler"] = self.sampler.stats()
+        return stats
+
+    def sample(self, force=False):
+        try:
+            # One bulk read per backend and cycle instead of one input per rectangle
+            values = {}
+            for backend, pins in self.backends():
+                values.update(backend.read_snapshot(pins))
+        except Exception as e:
+            print(f"Error reading GPIO snapshot: {str(e)}")
+            return
+        for pin, value in values.items():
+            self.update_pin(pin, value, force)
+
+    def update_pin(self, pin, value, force=False):
+        if self.values.get(pin) == value and not force:
+            return
+        self.values[pin] = value
+        for listener in list(self.listeners):
+            try:
+                listener(pin, value)
+            except Exception as e:
+                print(f"Error in GPIO listener for pin {pin}: {str(e)}")
+
+
+class StateRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            self.serve_requests()
+        except OSError:
+            # Client went away, nothing to clean up beyond the subscription
+            pass
+
+    def serve_requests(self):
+        for raw in self.rfile:
+            command, reply = self.server.reply(raw)
+            if command == "subscribe":
+                self.stream()
+                return
+            self.send(reply)
+
+    def stream(self):
+        # Subscribe before sending the snapshot so no change can fall in between
+        messages = self.server.subscribe()
+        try:
+            self.send(self.server.state_message())
+            while True:
+                message = messages.get()
+                if message is None:
+                    self.send({"type": "error", "error": "client too slow, unsubscribed"})
+                    break
+                self.send(message)
+        finally:
+            self.server.unsubscribe(messages)
+
+    def send(self, message):
+        self.wfile.write(json.dumps(message).encode() + b"\n")
+        self.wfile.flush()
+
+
+class StateProtocol:
+    # Local query/subscribe socket, one JSON object per line:
+    #   {"cmd": "state"}      -> {"type": "state", "rectangles": {...}}
+    #   {"cmd": "subscribe"}  -> the same state message, then one
+    #                            {"type": "signal", ...} message per change
+    #   {"cmd": "stats"}      -> {"type": "stats", "poll": {...}}, see
+    #                            GpioMonitor.poll_stats
+    # Served by StateServer on threads or AsyncStateServer (runtime.py).
+    def state_message(self):
+        return {"type": "state", "rectangles": self.layout.signal_state()}
+
+    def signal_message(self, rect):
+        return {
+            "type": "signal",
+            "name": rect.name,
+            "gpio": rect.gpio,
+            "red": rect.red_signal,
+            "blue": rect.blue_signal,
+            "yellow": rect.yellow_signal
+        }
+
+    def reply(self, raw):
+        # (command, reply) for one request line, subscribe is up to the caller
+        try:
+            command = json.loads(raw).get("cmd")
+        except (ValueError, AttributeError):
+            return None, {"type": "error", "error": "requests are one JSON object per line"}
+        if command == "state":
+            return command, self.state_message()
+        if command == "stats" and self.monitor:
+            return command, {"type": "stats", "poll": self.monitor.poll_stats()}
+        if command == "subscribe":
+            return command, None
+        return command, {"type": "error", "error": f"unknown command {command!r}"}
+
+
+class StateServer(StateProtocol, socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, layout, host="127.0.0.1", port=DEFAULT_STATE_PORT, max_pending=1000, monitor=None):
+        super().__init__((host, port), StateRequestHandler)
+        self.layout = layout
+        self.monitor = monitor
+        self.max_pending = max_pending
+        self.subscribers = set()
+        self.subscribers_lock = Lock()
+
+    def subscribe(self):
+        messages = queue.Queue(self.max_pending + 1)
+        with self.subscribers_lock:
+            self.subscribers.add(messages)
+        return messages
+
+    def unsubscribe(self, messages):
+        with self.subscribers_lock:
+            self.subscribers.discard(messages)
+
+    def publish(self, rect):
+        message = self.signal_message(rect)
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+        for messages in subscribers:
+            try:
+                if messages.qsize() >= self.max_pending:
+                    raise queue.Full
+                messages.put_nowait(message)
+            except queue.Full:
+                # Drop clients that stopped reading rather than buffer forever,
+                # the last queue slot is kept free for this marker
+                self.unsubscribe(messages)
+                try:
+                    messages.put_nowait(None)
+                except queue.Full:
+                    pass
+
+
+class AgentRequestHandler(socketserver.StreamRequestHandler):
+    # One connected agent. Messages are JSON lines:
+    #   {"type": "hello", "node": "pi2", "seq": 41, "state": {"17": 0, "27": 1}, "token": "..."}
+    #   {"type": "delta", "seq": 42, "changes": {"27": 0}}
+    # A hello carries the full state, after that only changed pins are sent,
+    # batched per sampling interval. An empty delta is a heartbeat. The token
+    # is only needed when the main app was given one.
+    def handle(self):
+        node = None
+        try:
+            for raw in self.rfile:
+                node, reply = self.server.receive(node, raw, self.client_address)
+                if reply:
+                    self.wfile.write(reply)
+                    self.wfile.flush()
+        except OSError:
+            pass
+        if node is not None:
+            # Last known values stay in place until the agent resyncs
+            print(f"Agent '{node}' disconnected")
+
+
+class RemoteGPIO(socketserver.ThreadingTCPServer):
+    # GPIO backend for pins on other Pis, addressed as "node:pin". The agents
+    # (agent.py) connect here and stream their pin states, which are cached
+    # and handed to edge callbacks like RPi.GPIO would, so GpioMonitor treats
+    # remote pins like local ones. Other sources (picoserial.py) feed resync()
+    # directly, the TCP port is only opened by listen().
+    daemon_threads = True
+    allow_reuse_address = True
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self, host=DEFAULT_AGENT_HOST, port=DEFAULT_AGENT_PORT, token=None):
+        super().__init__((host, port), AgentRequestHandler, bind_and_activate=False)
+        self.token = token
+        self.values = {}
+        self.sequences = {}
+        self.event_callbacks = {}
+        self.lock = Lock()
+        self.listening = False
+
+    def listen(self):
+        self.server_bind()
+        self.server_activate()
+        self.listening = True
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def receive(self, node, raw, address):
+        # Applies one message line from the agent connection that so far
+        # said it is node. Returns the node and the bytes to send back.
+        # Everything is checked before anything is applied, so a bad message
+        # can't leave half of its pins updated
+        try:
+            message = json.loads(raw)
+            kind = message["type"]
+            seq = message["seq"]
+            changes = message.get("state" if kind == "hello" else "changes", {})
+            if kind == "hello" and not isinstance(message["node"], str):
+                raise TypeError("node is not a string")
+            if not isinstance(seq, int) or not isinstance(changes, dict):
+                raise TypeError("seq or pins of the wrong type")
+            changes = {int(pin): value for pin, value in changes.items()}
+        except (ValueError, KeyError, TypeError, AttributeError):
+            print(f"Ignoring malformed message from agent {node or address}")
+            return node, None
+
+        if kind == "hello":
+            if not self.authorized(message.get("token")):
+                print(f"Rejecting agent '{message['node']}' from {address[0]}: wrong or missing token")
+                # Ends the connection, the agent retries with backoff
+                raise ConnectionRefusedError("agent token mismatch")
+            if node is None:
+                print(f"Agent '{message['node']}' connected from {address[0]}")
+            node = message["node"]
+            self.resync(node, seq, changes)
+        elif kind == "delta" and node is not None:
+            if not self.apply_delta(node, seq, changes):
+                # A batch went missing, ask for the whole state again
+                return node, json.dumps({"cmd": "resync"}).encode() + b"\n"
+        return node, None
+
+    def authorized(self, token):
+        if self.token is None:
+            return True
+        return isinstance(token, str) and hmac.compare_digest(token.encode(), self.token.encode())
+
+    def input(self, pin):
+        return self.values.get(pin, self.LOW)
+
+    def read_snapshot(self, pins):
+        values = self.values
+        return {pin: values.get(pin, self.LOW) for pin in pins}
+
+    def add_event_detect(self, pin, callback, bouncetime=None):
+        self.event_callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.event_callbacks.pop(pin, None)
+
+    def set_mock_value(self, pin, value):
+        # A "node:pin" value as if its agent had sent it, for replays
+        node, _, number = pin.rpartition(":")
+        with self.lock:
+            self.update(node, {number: value})
+
+    def resync(self, node, seq, state):
+        with self.lock:
+            self.sequences[node] = seq
+            self.update(node, state)
+
+    def apply_delta(self, node, seq, changes):
+        # Returns False if batches were lost in between, the values in a batch
+        # are absolute so it is applied anyway
+        with self.lock:
+            expected = self.sequences.get(node, seq - 1) + 1
+            self.sequences[node] = seq
+            self.update(node, changes)
+        return seq == expected
+
+    def update(self, node, changes):
+        # Callbacks run under the lock, so agents are handled one at a time
+        for pin, value in changes.items():
+            key = f"{node}:{int(pin)}"
+            value = self.HIGH if value else self.LOW
+            if self.values.get(key) == value:
+                continue
+            self.values[key] = value
+            callback = self.event_callbacks.get(key)
+            if callback:
+                try:
+                    callback(key)
+                except Exception as e:
+                    print(f"Error in callback for remote pin {key}: {str(e)}")
+
+
+def start_remote_gpio(host=DEFAULT_AGENT_HOST, port=DEFAULT_AGENT_PORT, listen=True, token=None):
+    # Call before starting a GpioMonitor, the monitor picks up remote pins then
+    global remote_gpio
+    if remote_gpio is None:
+        remote_gpio = RemoteGPIO(host, port, token)
+    elif token is not None:
+        remote_gpio.token = token
+    if listen and not remote_gpio.listening:
+        remote_gpio.listen()
+        print(f"Accepting GPIO agents on {host}:{remote_gpio.server_address[1]}")
+    return remote_gpio
+
+
+def is_loopback(host):
+    return host == "localhost" or host == "::1" or host.startswith("127.")
+
+
+def accept_agents(port=DEFAULT_AGENT_PORT, runtime=None, host=DEFAULT_AGENT_HOST, token=None):
+    # Agents connect on their own threads, or as tasks of an AsyncRuntime.
+    # Anything that can reach the port can set pins, so beyond loopback the
+    # agents have to send the token in their hello.
+    if token is None and not is_loopback(host):
+        raise ValueError(f"Accepting agents on {host} needs a token")
+    if runtime:
+        runtime.serve_agents(start_remote_gpio(listen=False, token=token), host=host, port=port)
+    else:
+        start_remote_gpio(host, port, token=token)
+
+
+def start_pico(device, runtime=None):
+    # Pico buttons arrive over USB serial as pins "pico:0", "pico:1"...
+    from picoserial import PicoReader
+    reader = PicoReader(device, start_remote_gpio(listen=False))
+    if runtime:
+        runtime.watch_pico(reader)
+    else:
+        reader.start()
+    return reader
+
+
+def enable_profiling():
+    # Times GPIO reads, sampling cycles and rectangle drawing from now on, see
+    # perf.py. Nothing is wrapped before this is called.
+    perf.enable()
+    perf.instrument(GPIO, "read_snapshot", "gpio_read")
+    # The poll loop reads through sample_due, edge mode only samples on refresh
+    perf.instrument(GpioMonitor, "sample_due", "sample_cycle")
+    perf.instrument(GpioMonitor, "sample", "sample_all")
+    perf.instrument(Rectangle, "draw", "rectangle_draw")
+
+
+def run_headless(layout_file="qq.json", edge_events=True, port=DEFAULT_STATE_PORT, record_file=None, aspects=True, agent_port=None, pico_device=None,
+                 profile_interval=None, poll_caps=None, sampler_process=False, runtime=None, web_port=None, agent_host=DEFAULT_AGENT_HOST, agent_token=None):
+    # With a runtime (runtime.py) everything runs as tasks on its event loop
+    if profile_interval:
+        enable_profiling()
+
+        def dump_profile():
+            while True:
+                sleep(profile_interval)
+                perf.dump()
+
+        if runtime:
+            runtime.every(profile_interval, perf.dump)
+        else:
+            Thread(target=dump_profile, daemon=True).start()
+    if agent_port is not None:
+        accept_agents(agent_port, runtime, agent_host, agent_token)
+    if pico_device:
+        start_pico(pico_device, runtime)
+    layout = Layout()
+    layout.load(layout_file)
+    print(f"Canvas state loaded from {layout_file}")
+    aspect_engine = AspectEngine(layout) if aspects else None
+    if aspect_engine:
+        aspect_engine.refresh()
+
+    monitor = GpioMonitor(layout, edge_events=edge_events, pin_caps=poll_caps, sampler_process=sampler_process, runtime=runtime)
+    if runtime:
+        from runtime import AsyncStateServer
+        server = AsyncStateServer(runtime, layout, port=port, monitor=monitor)
+    else:
+        server = StateServer(layout, port=port, monitor=monitor)
+    viewers = None
+    if web_port is not None:
+        from webview import WebViewer
+        viewers = WebViewer(layout, port=web_port, runtime=runtime)
+    recorder = None
+    if record_file:
+        from recorder import TransitionRecorder
+        recorder = TransitionRecorder(record_file)
+        recorder.attach(monitor)
+        print(f"Recording GPIO transitions to {record_file}")
+
+    # Changes come from the polling thread, edge callbacks, agent connections
+    # and the Pico reader, so they are applied and published one at a time
+    changes_lock = Lock()
+
+    def on_pin_change(pin, value):
+        with changes_lock:
+            changed = layout.apply_pin_states({pin: value})
+            if aspect_engine and changed:
+                changed += [rect for rect in aspect_engine.update(changed) if rect not in changed]
+            for rect in changed:
+                server.publish(rect)
+            if viewers and changed:
+                viewers.publish(changed)
+
+    monitor.add_listener(on_pin_change)
+    monitor.start()
+
+    try:
+        if runtime:
+            print("Headless monitoring running on the asyncio runtime")
+            runtime.run()
+        else:
+            print(f"Headless monitoring running, state server on 127.0.0.1:{server.server_address[1]}")
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if not runtime:
+            server.server_close()
+        if viewers:
+            viewers.close()
+        monitor.stop()
+        if recorder:
+            recorder.close()
+        GPIO.cleanup()
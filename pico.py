@@ -1,45 +1,82 @@
 from machine import Pin
-from time import sleep
+from time import sleep_ms, ticks_ms, ticks_diff
+import sys
+
+# The button states go to the Pi over USB serial as small frames instead of
+# one Pi GPIO per button, see picoserial.py for the reader:
+#   0xA5 0x5A | sequence (0-255) | button count | state bits, LSB first | checksum
+# The checksum is the sum of the bytes between the start marker and itself.
+# Button i shows up on the Pi as pin "pico:i".
+FRAME_START = b"\xa5\x5a"
+DEBOUNCE_MS = 30
+# The full state is also sent this often, so a reader that just (re)opened
+# the port is in sync within a second
+KEEPALIVE_MS = 1000
+
+changed = False
+
 
 class Button:
-    def __init__(self, name: string, button_pin: int, led_pin: int, output_pin: int):
+    def __init__(self, name: str, button_pin: int, led_pin: int, output_pin: int = None):
         self.name = name
-        
+
         self.led = Pin(led_pin, Pin.OUT)
         self.led_state = False
         self.led.value(self.led_state)
-        
+
         self.button = Pin(button_pin, Pin.IN, Pin.PULL_UP)
-        self.button_state_now = 1
-        self.button_state_old = 1
-        
-        self.output = Pin(output_pin, Pin.OUT)
+        self.last_press = ticks_ms()
+        self.button.irq(trigger=Pin.IRQ_FALLING, handler=self.on_press)
+
+        # Optional direct wire to a Pi GPIO, as before the serial link
+        self.output = Pin(output_pin, Pin.OUT) if output_pin is not None else None
         self.output_state = False
-        self.output.value(self.output_state)
-        
-    def check_press(self, debug: bool) -> None:
-        self.button_state_now = self.button.value()
-        if self.button_state_now == 0 and self.button_state_old == 1:
-            self.led_state = not self.led_state
-            self.led.value(self.led_state)
-            
-            self.output_state = not self.output_state
+        if self.output:
+            self.output.value(self.output_state)
+
+    def on_press(self, pin) -> None:
+        # Soft IRQ on the falling edge, bounces within DEBOUNCE_MS are dropped
+        global changed
+        now = ticks_ms()
+        if ticks_diff(now, self.last_press) < DEBOUNCE_MS:
+            return
+        self.last_press = now
+
+        self.led_state = not self.led_state
+        self.led.value(self.led_state)
+
+        self.output_state = not self.output_state
+        if self.output:
             self.output.value(self.output_state)
-        if debug:
-            print(self.name, self.led_state, self.button_state_now, self.output_state)
-        self.button_state_old = self.button_state_now
+        changed = True
+
+
+def encode_frame(seq, states):
+    bitmap = bytearray((len(states) + 7) // 8)
+    for i, state in enumerate(states):
+        if state:
+            bitmap[i // 8] |= 1 << (i % 8)
+    body = bytes([seq, len(states)]) + bitmap
+    return FRAME_START + body + bytes([sum(body) & 0xFF])
+
 
+buttons = [
+    Button('yellow', 14, 15),
+    Button('blue', 17, 16),
+    Button('red', 11, 12),
+    Button('green', 22, 20),
+]
 
-but_yellow = Button('yellow', 14, 15, 0)
-but_blue = Button('blue', 17, 16, 1)
-but_red = Button('red', 11, 12, 2)
-but_green = Button('green', 22, 20, 3)
-debug = True
+seq = 0
+last_sent = ticks_ms()
+serial = sys.stdout.buffer
 
 while True:
-    but_yellow.check_press(debug)
-    but_blue.check_press(debug)
-    but_red.check_press(debug)
-    but_green.check_press(debug)
-    sleep(.1)
-    
\ No newline at end of file
+    now = ticks_ms()
+    if changed or ticks_diff(now, last_sent) >= KEEPALIVE_MS:
+        # Presses that land while sending are picked up by the next frame
+        changed = False
+        serial.write(encode_frame(seq, [button.output_state for button in buttons]))
+        seq = (seq + 1) & 0xFF
+        last_sent = now
+    sleep_ms(1)
@@ -0,0 +1,149 @@
+import os
+import sys
+import tty
+from threading import Thread
+from time import sleep
+
+# Frame format written by pico.py:
+#   0xA5 0x5A | sequence (0-255) | button count | state bits, LSB first | checksum
+FRAME_START = b"\xa5\x5a"
+# Seconds between attempts to (re)open the serial device
+REOPEN_DELAY = 1.0
+
+
+def encode_frame(seq, states):
+    # Same as pico.py, for tests and stand-ins
+    bitmap = bytearray((len(states) + 7) // 8)
+    for i, state in enumerate(states):
+        if state:
+            bitmap[i // 8] |= 1 << (i % 8)
+    body = bytes([seq & 0xFF, len(states)]) + bitmap
+    return FRAME_START + body + bytes([sum(body) & 0xFF])
+
+
+class FrameParser:
+    # Turns a byte stream into (seq, states) frames. Bytes before a start
+    # marker and frames with a bad checksum are skipped, so a reader that
+    # opens the port mid-frame resyncs on the next one.
+    def __init__(self):
+        self.buffer = bytearray()
+        self.bad_frames = 0
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(FRAME_START)
+            if start < 0:
+                # Keep a trailing first marker byte, the second may follow
+                del self.buffer[:-1 if self.buffer.endswith(FRAME_START[:1]) else len(self.buffer)]
+                return frames
+            del self.buffer[:start]
+            if len(self.buffer) < 4:
+                return frames
+
+            count = self.buffer[3]
+            size = 4 + (count + 7) // 8 + 1
+            if len(self.buffer) < size:
+                return frames
+            body = self.buffer[2:size - 1]
+            if sum(body) & 0xFF != self.buffer[size - 1]:
+                self.bad_frames += 1
+                del self.buffer[:len(FRAME_START)]
+                continue
+
+            states = [bool(body[2 + i // 8] >> (i % 8) & 1) for i in range(count)]
+            frames.append((body[0], states))
+            del self.buffer[:size]
+
+
+class PicoReader:
+    # Reads the Pico's frames from its USB serial device (e.g. /dev/ttyACM0)
+    # and hands them to a RemoteGPIO backend as pins "node:index". Every frame
+    # carries the full state, so it is a resync and lost frames only delay an
+    # update. The device is reopened if the Pico is unplugged.
+    def __init__(self, device, backend, node="pico"):
+        self.device = device
+        self.backend = backend
+        self.node = node
+        self.parser = FrameParser()
+        self.running = False
+        self.thread = None
+        self.fd = None
+        self.last_seq = None
+        self.frames = 0
+        self.lost_frames = 0
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.running = False
+        self.close()
+
+    def open(self):
+        self.fd = os.open(self.device, os.O_RDONLY | os.O_NOCTTY)
+        if os.isatty(self.fd):
+            # No line editing or echo, the frames are binary
+            tty.setraw(self.fd)
+        self.parser = FrameParser()
+        self.last_seq = None
+        print(f"Reading Pico frames from {self.device}")
+
+    def close(self):
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+
+    def run(self):
+        while self.running:
+            try:
+                self.open()
+                while self.running:
+                    self.read_frames()
+            except (OSError, EOFError) as e:
+                if self.running:
+                    print(f"Pico serial {self.device} unavailable: {e}, retrying")
+            finally:
+                self.close()
+            if self.running:
+                sleep(REOPEN_DELAY)
+
+    def read_frames(self):
+        # One read, blocks unless the device is readable (runtime.py waits for that)
+        data = os.read(self.fd, 256)
+        if not data:
+            raise EOFError(f"{self.device} closed")
+        for seq, states in self.parser.feed(data):
+            self.handle_frame(seq, states)
+
+    def handle_frame(self, seq, states):
+        if self.last_seq is not None:
+            self.lost_frames += (seq - self.last_seq - 1) & 0xFF
+        self.last_seq = seq
+        self.frames += 1
+        self.backend.resync(self.node, seq, {i: state for i, state in enumerate(states)})
+
+
+if __name__ == "__main__":
+    # python3 picoserial.py /dev/ttyACM0: prints the frames as they arrive
+    if len(sys.argv) < 2:
+        print("Usage: python3 picoserial.py DEVICE")
+        sys.exit(1)
+
+    class PrintBackend:
+        def resync(self, node, seq, state):
+            print(f"{node} #{seq}: " + " ".join(f"{pin}={int(value)}" for pin, value in state.items()))
+
+    reader = PicoReader(sys.argv[1], PrintBackend())
+    try:
+        reader.start().join()
+    except KeyboardInterrupt:
+        reader.stop()
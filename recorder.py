@@ -0,0 +1,239 @@
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import namedtuple
+from threading import Lock
+
+# File layout: one header followed by a fixed number of fixed-size records.
+# The header holds the total number of records ever written, records go to
+# slot written % capacity, so the oldest entries are overwritten in place.
+# Pins of other Pis ("node:pin") are stored as the pin number and the index
+# of the node's name in a table in the header, 1-based, 0 for local pins.
+MAGIC = b"PSTRANS2"
+# Files without the node table, remote pins were stored as -1
+MAGIC_V1 = b"PSTRANS1"
+HEADER = struct.Struct("<8sIIQ")  # magic, record size, capacity, records written
+NODE_COUNT = struct.Struct("<I")  # right after HEADER, names in the table
+NODE_TABLE_OFFSET = 64
+NODE_NAME_SIZE = 32
+MAX_NODES = 254
+HEADER_SIZE = NODE_TABLE_OFFSET + MAX_NODES * NODE_NAME_SIZE  # 8 KB
+HEADER_SIZE_V1 = 64
+RECORD = struct.Struct("<QdiBxH40s")  # monotonic ns, wall time, pin, value, node, rectangle name
+DEFAULT_CAPACITY = 100000  # ~6 MB
+
+Transition = namedtuple("Transition", ["monotonic", "wall_time", "pin", "value", "name"])
+
+
+def unpack_record(buffer, offset, nodes=()):
+    monotonic_ns, wall_time, pin, value, node, name = RECORD.unpack_from(buffer, offset)
+    if node:
+        pin = f"{nodes[node - 1]}:{pin}"
+    return Transition(monotonic_ns / 1e9, wall_time, pin, value, name.rstrip(b"\0").decode(errors="replace"))
+
+
+def header_size(magic):
+    return {MAGIC: HEADER_SIZE, MAGIC_V1: HEADER_SIZE_V1}.get(magic)
+
+
+def read_nodes(buffer):
+    count = NODE_COUNT.unpack_from(buffer, HEADER.size)[0]
+    return [
+        buffer[NODE_TABLE_OFFSET + index * NODE_NAME_SIZE:NODE_TABLE_OFFSET + (index + 1) * NODE_NAME_SIZE]
+        .rstrip(b"\0").decode(errors="replace")
+        for index in range(count)
+    ]
+
+
+class TransitionReader:
+    # Read-only view of a recorder file. Only the header and the records that
+    # are asked for are touched, the file is never loaded as a whole.
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, record_size, self.capacity, _ = HEADER.unpack_from(self.buffer, 0)
+        self.header_size = header_size(magic)
+        if self.header_size is None or record_size != RECORD.size:
+            raise ValueError(f"{path} is not a transition recording")
+        self.nodes = read_nodes(self.buffer) if magic == MAGIC else []
+
+    def written(self):
+        return HEADER.unpack_from(self.buffer, 0)[3]
+
+    def __len__(self):
+        return min(self.written(), self.capacity)
+
+    def record(self, index):
+        # index 0 is the oldest record still in the ring
+        written = self.written()
+        first = max(0, written - self.capacity)
+        slot = (first + index) % self.capacity
+        offset = self.header_size + slot * RECORD.size
+        if RECORD.unpack_from(self.buffer, offset)[4] > len(self.nodes):
+            # A node the recorder added since the table was read
+            self.nodes = read_nodes(self.buffer)
+        return unpack_record(self.buffer, offset, self.nodes)
+
+    def bisect(self, timestamp, clock):
+        # Records are appended in time order, so the ring can be binary searched
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if getattr(self.record(middle), clock) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def read_window(self, start, end, clock="monotonic"):
+        # Transitions with start <= timestamp < end. The monotonic clock restarts
+        # at boot, use clock="wall_time" to search across reboots.
+        first = self.bisect(start, clock)
+        last = self.bisect(end, clock)
+        return [self.record(index) for index in range(first, last)]
+
+    def latest(self, count):
+        size = len(self)
+        return [self.record(index) for index in range(max(0, size - count), size)]
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+
+class TransitionRecorder:
+    # Appends GPIO transitions to a memory-mapped ring file. An append is two
+    # struct.pack_into calls, the kernel writes the pages back, so a crashed
+    # process loses nothing that was recorded. Disk use is fixed at creation.
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, flush_interval=5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.lock = Lock()
+
+        if not os.path.exists(path) or os.path.getsize(path) < HEADER_SIZE_V1:
+            with open(path, "wb") as f:
+                f.truncate(HEADER_SIZE + capacity * RECORD.size)
+                f.seek(0)
+                f.write(HEADER.pack(MAGIC, RECORD.size, capacity, 0))
+
+        self.file = open(path, "r+b")
+        self.buffer = mmap.mmap(self.file.fileno(), 0)
+        magic, record_size, self.capacity, self.written = HEADER.unpack_from(self.buffer, 0)
+        self.header_size = header_size(magic)
+        if self.header_size is None or record_size != RECORD.size:
+            raise ValueError(f"{path} is not a transition recording")
+        if self.capacity != capacity:
+            print(f"Recorder: keeping existing capacity {self.capacity} of {path}")
+        if magic == MAGIC:
+            self.nodes = {name: index for index, name in enumerate(read_nodes(self.buffer))}
+        else:
+            # Appending to an old file keeps its format
+            print(f"Recorder: {path} has no node table, remote pins are recorded without their node")
+            self.nodes = None
+        # Set once the user was told about a node that can't be stored
+        self.unmapped = self.nodes is None
+        self.last_values = {}
+
+    def attach(self, monitor):
+        # Records from the threads that report pins: the poll loop, edge
+        # callbacks, agents and the Pico reader. The monitor also reports
+        # unchanged pins on a forced sample, only real transitions are kept.
+        def on_pin_change(pin, value):
+            name = monitor.pin_names.get(pin, "")
+            with self.lock:
+                if self.last_values.get(pin) == value:
+                    return
+                self.last_values[pin] = value
+                self.append(pin, value, name)
+
+        monitor.add_listener(on_pin_change)
+        return on_pin_change
+
+    def record(self, pin, value, name=""):
+        with self.lock:
+            self.append(pin, value, name)
+
+    def append(self, pin, value, name):
+        # Call with the lock
+        node = 0
+        if isinstance(pin, str):
+            node, pin = self.node_index(pin)
+        offset = self.header_size + (self.written % self.capacity) * RECORD.size
+        RECORD.pack_into(
+            self.buffer, offset,
+            time.monotonic_ns(), time.time(), pin, 1 if value else 0, node, (name or "").encode()[:40]
+        )
+        # Count the record only once it is fully written
+        self.written += 1
+        struct.pack_into("<Q", self.buffer, HEADER.size - 8, self.written)
+
+        now = time.monotonic()
+        if now - self.last_flush >= self.flush_interval:
+            # Bound what a power cut can take with it
+            self.buffer.flush()
+            self.last_flush = now
+
+    def node_index(self, pin):
+        # (node index, pin number) of a "node:pin" pin, (0, -1) if the node
+        # can't be stored. New names are written before the count that
+        # makes them visible to readers.
+        node, _, number = pin.rpartition(":")
+        index = self.nodes.get(node) if self.nodes is not None else None
+        if index is None:
+            encoded = node.encode()
+            if self.nodes is None or len(self.nodes) >= MAX_NODES or len(encoded) > NODE_NAME_SIZE:
+                if not self.unmapped:
+                    print(f"Recorder: can't store node '{node}', its transitions are recorded as pin -1")
+                    self.unmapped = True
+                return 0, -1
+            index = len(self.nodes)
+            offset = NODE_TABLE_OFFSET + index * NODE_NAME_SIZE
+            self.buffer[offset:offset + NODE_NAME_SIZE] = encoded.ljust(NODE_NAME_SIZE, b"\0")
+            NODE_COUNT.pack_into(self.buffer, HEADER.size, index + 1)
+            self.nodes[node] = index
+        return index + 1, int(number)
+
+    def flush(self):
+        with self.lock:
+            self.buffer.flush()
+
+    def close(self):
+        with self.lock:
+            self.buffer.flush()
+            self.buffer.close()
+            self.file.close()
+
+
+def print_transitions(transitions):
+    for transition in transitions:
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(transition.wall_time))
+        state = "HIGH" if transition.value else "LOW"
+        print(f"{stamp} +{transition.monotonic:.3f}s pin {transition.pin} ({transition.name}): {state}")
+
+
+if __name__ == "__main__":
+    # python3 recorder.py transitions.rec [--last=N] [--since=SECONDS_AGO]
+    if len(sys.argv) < 2:
+        print("Usage: python3 recorder.py FILE [--last=N] [--since=SECONDS_AGO]")
+        sys.exit(1)
+
+    reader = TransitionReader(sys.argv[1])
+    last = 50
+    since = None
+    for arg in sys.argv[2:]:
+        if arg.startswith("--last="):
+            last = int(arg.split("=")[1])
+        elif arg.startswith("--since="):
+            since = float(arg.split("=")[1])
+
+    if since is not None:
+        now = time.time()
+        print_transitions(reader.read_window(now - since, now + 1, clock="wall_time"))
+    else:
+        print_transitions(reader.latest(last))
+    print(f"{len(reader)} of {reader.capacity} records in use, {reader.written()} written in total")
+    reader.close()
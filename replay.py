@@ -0,0 +1,240 @@
+import heapq
+import json
+import math
+import random
+import sys
+import time
+from collections import namedtuple
+
+from core import GPIO, Layout, GpioMonitor, MockGPIO, backend_for, init_gpio
+from recorder import MAGIC, MAGIC_V1, TransitionReader
+
+ReplayEvent = namedtuple("ReplayEvent", ["time", "pin", "value"])
+
+
+def load_recording(path):
+    # Transitions from a recorder file, times relative to the first one
+    reader = TransitionReader(path)
+    events = []
+    previous = None
+    offset = 0.0
+    for index in range(len(reader)):
+        transition = reader.record(index)
+        # Remote pins of recordings without a node table
+        if transition.pin == -1:
+            continue
+        if previous is not None:
+            # The monotonic clock restarts at boot, don't let time run backwards
+            offset += max(0.0, transition.monotonic - previous)
+        previous = transition.monotonic
+        events.append(ReplayEvent(offset, transition.pin, transition.value))
+    reader.close()
+    return events
+
+
+def load_script(path):
+    # One transition per line, either {"t": 1.5, "pin": 17, "value": 1}
+    # or "1.5 17 1". Blank lines and lines starting with # are ignored.
+    events = []
+    with open(path, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                if line.startswith("{"):
+                    entry = json.loads(line)
+                    event = ReplayEvent(float(entry["t"]), int(entry["pin"]), int(entry["value"]))
+                else:
+                    t, pin, value = line.split()[:3]
+                    event = ReplayEvent(float(t), int(pin), int(value))
+            except (ValueError, KeyError) as e:
+                print(f"Skipping line {line_number} of {path}: {e}")
+                continue
+            events.append(event)
+    # Stable sort, transitions with the same time keep their order
+    events.sort(key=lambda event: event.time)
+    return events
+
+
+def load_events(path):
+    with open(path, "rb") as f:
+        is_recording = f.read(len(MAGIC)) in (MAGIC, MAGIC_V1)
+    return load_recording(path) if is_recording else load_script(path)
+
+
+def generate_traffic(pins, duration, mean_dwell=30.0, seed=0):
+    # Seeded occupancy traffic: every pin flips after an exponentially
+    # distributed dwell time. The same arguments always give the same stream.
+    rng = random.Random(seed)
+    heap = [(rng.expovariate(1 / mean_dwell), pin) for pin in sorted(pins)]
+    heapq.heapify(heap)
+    values = {pin: GPIO.LOW for pin in pins}
+    events = []
+    while heap and heap[0][0] < duration:
+        t, pin = heapq.heappop(heap)
+        values[pin] = GPIO.HIGH if values[pin] == GPIO.LOW else GPIO.LOW
+        events.append(ReplayEvent(t, pin, values[pin]))
+        heapq.heappush(heap, (t + rng.expovariate(1 / mean_dwell), pin))
+    return events
+
+
+class VirtualClock:
+    # Replay time in seconds. With a speed the clock is paced against the wall
+    # clock (1 = real time, 100 = a hundred times faster), without one it jumps
+    # straight to the next event.
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.now = 0.0
+        self.wall_start = None
+
+    def start(self):
+        self.now = 0.0
+        self.wall_start = time.perf_counter()
+
+    def advance_to(self, t):
+        if self.speed:
+            delay = self.wall_start + t / self.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        self.now = max(self.now, t)
+
+
+class ReplayEngine:
+    # Feeds a transition stream into the mock GPIO, so the rest of the pipeline
+    # (monitor, listeners, state queue, rendering) runs exactly as it does for
+    # real pins. With edge events the monitor reacts inside set_mock_value.
+    # A polling monitor has its thread paused and is sampled on the virtual
+    # clock instead, once per poll interval that saw a transition.
+    def __init__(self, monitor, events, speed=1.0):
+        self.monitor = monitor
+        self.events = events
+        self.clock = VirtualClock(speed)
+
+    def run(self):
+        # Every backend has set_mock_value, but only the mock one, or a real one
+        # in simulation mode, reads those values back instead of the pins
+        backend = init_gpio()
+        if not isinstance(backend, MockGPIO) and not backend.simulating:
+            raise RuntimeError(f"Replay needs the mock GPIO backend or simulation mode, "
+                               f"{type(backend).__name__} reads the real pins")
+
+        drive_sampling = not self.monitor.gpio_events
+        was_polling = self.monitor.polling
+        if was_polling:
+            self.monitor.stop()
+
+        interval = self.monitor.poll_interval
+        next_sample = None
+        samples = 0
+        skipped = 0
+        self.clock.start()
+
+        for event in self.events:
+            if next_sample is not None and next_sample <= event.time:
+                self.clock.advance_to(next_sample)
+                self.monitor.sample()
+                samples += 1
+                next_sample = None
+            self.clock.advance_to(event.time)
+            backend = backend_for(event.pin)
+            if backend is None:
+                # A pin of another Pi, but no agents are accepted
+                skipped += 1
+                continue
+            backend.set_mock_value(event.pin, event.value)
+            if drive_sampling and next_sample is None:
+                next_sample = (math.floor(event.time / interval) + 1) * interval
+
+        if next_sample is not None:
+            self.clock.advance_to(next_sample)
+            self.monitor.sample()
+            samples += 1
+
+        wall_time = time.perf_counter() - self.clock.wall_start
+        if skipped:
+            print(f"Skipped {skipped} transitions of remote pins, start with --agents to replay them")
+        if was_polling:
+            self.monitor.start()
+        return self.report(samples, wall_time)
+
+    def report(self, samples, wall_time):
+        # Built from what the sampler saw, safe to call off the layout's thread
+        sections = {}
+        for pin, names in self.monitor.pin_names.items():
+            for name in names.split(","):
+                sections[name] = self.monitor.values.get(pin) == GPIO.HIGH
+        return {
+            "events": len(self.events),
+            "samples": samples,
+            "virtual_s": self.clock.now,
+            "wall_s": wall_time,
+            "events_per_s": len(self.events) / wall_time if wall_time > 0 else None,
+            "speedup": self.clock.now / wall_time if wall_time > 0 else None,
+            "occupied": sorted(name for name, occupied in sections.items() if occupied),
+            "sections": sections
+        }
+
+
+def parse_speed(text):
+    return None if text in ("max", "0") else float(text)
+
+
+def print_report(report):
+    print(f"Replayed {report['events']} transitions ({report['samples']} samples) "
+          f"covering {report['virtual_s']:.1f} s in {report['wall_s']:.3f} s")
+    if report["events_per_s"]:
+        print(f"{report['events_per_s']:.0f} transitions/s, {report['speedup']:.1f}x real time")
+    print(f"Occupied sections: {', '.join(report['occupied']) or 'none'}")
+
+
+if __name__ == "__main__":
+    # python3 replay.py SOURCE [--load=qq.json] [--speed=1|100|max] [--poll]
+    # python3 replay.py --generate=HOURS [--seed=N] ...
+    layout_file = "qq.json"
+    speed = None
+    edge_events = "--poll" not in sys.argv
+    generate_hours = None
+    seed = 0
+    output = None
+    source = None
+
+    for arg in sys.argv[1:]:
+        if arg.startswith("--load="):
+            layout_file = arg.split("=")[1]
+        elif arg.startswith("--speed="):
+            speed = parse_speed(arg.split("=")[1])
+        elif arg.startswith("--generate="):
+            generate_hours = float(arg.split("=")[1])
+        elif arg.startswith("--seed="):
+            seed = int(arg.split("=")[1])
+        elif arg.startswith("--output="):
+            output = arg.split("=")[1]
+        elif not arg.startswith("--"):
+            source = arg
+
+    if source is None and generate_hours is None:
+        print("Usage: python3 replay.py SOURCE|--generate=HOURS [--load=FILE] [--speed=N|max] [--poll] [--seed=N] [--output=FILE]")
+        sys.exit(1)
+
+    layout = Layout()
+    layout.load(layout_file)
+    monitor = GpioMonitor(layout, edge_events=edge_events)
+
+    # Without a UI the replay thread is the only one changing the layout
+    monitor.add_listener(lambda pin, value: layout.apply_pin_states({pin: value}))
+    monitor.start()
+
+    if generate_hours is not None:
+        events = generate_traffic(monitor.pins, generate_hours * 3600, seed=seed)
+    else:
+        events = load_events(source)
+
+    report = ReplayEngine(monitor, events, speed).run()
+    monitor.stop()
+    print_report(report)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {output}")
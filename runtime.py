@@ -0,0 +1,269 @@
+import asyncio
+import json
+from threading import Lock, get_ident
+
+from core import DEFAULT_AGENT_HOST, DEFAULT_AGENT_PORT, DEFAULT_STATE_PORT, StateProtocol
+
+# Seconds between two passes over the Tk event queue
+TK_PUMP_INTERVAL = .005
+# Tk events handled per pass at most, so a burst of them can't starve the other tasks
+TK_EVENTS_PER_PASS = 100
+
+
+class AsyncRuntime:
+    # Runs the app's I/O as tasks on one asyncio loop, with --asyncio the
+    # main thread's (run() blocks until stop()): GPIO polling, the sampler
+    # process watcher, agent and Pico connections, the state socket, timers
+    # and, through a pump, the Tk event loop. Every source calls back on the
+    # thread that owns the layout and the canvas, and adding one costs a task
+    # instead of a thread.
+    # Tasks and callbacks can be scheduled before run(), they start with the
+    # loop. call_soon/call_later are safe from other threads, e.g. RPi.GPIO's
+    # edge callbacks or a replay.
+    def __init__(self):
+        self.loop = None
+        self.loop_thread = None
+        self.lock = Lock()
+        self.pending = []
+        self.tasks = set()
+        self.stopped = None
+        self.master = None
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.stopped = asyncio.Event()
+        with self.lock:
+            self.loop = asyncio.get_running_loop()
+            self.loop_thread = get_ident()
+            pending = self.pending
+            self.pending = []
+        for delay, callback, args in pending:
+            if delay is None:
+                self.loop.call_soon(callback, *args)
+            else:
+                self.loop.call_later(delay, callback, *args)
+        try:
+            await self.stopped.wait()
+        finally:
+            tasks = list(self.tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        self.call_soon(lambda: self.stopped.set())
+
+    def call_soon(self, callback, *args):
+        # Callbacks run in the order they were passed in, from any thread
+        self.call_later(None, callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        with self.lock:
+            if self.loop is None:
+                self.pending.append((delay, callback, args))
+                return
+        try:
+            if get_ident() == self.loop_thread:
+                if delay is None:
+                    self.loop.call_soon(callback, *args)
+                else:
+                    self.loop.call_later(delay, callback, *args)
+            elif delay is None:
+                self.loop.call_soon_threadsafe(callback, *args)
+            else:
+                self.loop.call_soon_threadsafe(self.loop.call_later, delay, callback, *args)
+        except RuntimeError:
+            # The loop is closed, the app is shutting down
+            pass
+
+    def spawn(self, factory):
+        # factory() makes the coroutine, on the loop thread once it runs
+        self.call_soon(self.start_task, factory)
+
+    def start_task(self, factory):
+        task = self.loop.create_task(factory())
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Runtime task {task.get_coro().__qualname__} failed: {task.exception()!r}")
+
+    def every(self, interval, callback):
+        async def repeat():
+            while True:
+                await asyncio.sleep(interval)
+                callback()
+        self.spawn(repeat)
+
+    def attach_tk(self, master):
+        # Replaces master.mainloop(): Tk events, after() timers included, are
+        # handled between the other tasks
+        self.master = master
+        self.spawn(self.pump_tk)
+
+    async def pump_tk(self):
+        import _tkinter
+        tk = self.master.tk
+        while True:
+            try:
+                for _ in range(TK_EVENTS_PER_PASS):
+                    if not tk.dooneevent(_tkinter.DONT_WAIT):
+                        break
+                tk.call("winfo", "exists", ".")
+            except _tkinter.TclError:
+                # The window was destroyed
+                self.stop()
+                return
+            await asyncio.sleep(TK_PUMP_INTERVAL)
+
+    def run_polling(self, monitor):
+        # GpioMonitor's poll loop, reads are short enough to run on the loop
+        async def poll():
+            while monitor.polling:
+                await asyncio.sleep(max(0, monitor.poll_once()))
+        self.spawn(poll)
+
+    def watch_sampler(self, sampler):
+        async def watch():
+            while sampler.running:
+                await asyncio.sleep(sampler.interval)
+                sampler.check()
+        self.spawn(watch)
+
+    def serve_agents(self, remote, host=DEFAULT_AGENT_HOST, port=DEFAULT_AGENT_PORT):
+        # Same protocol as RemoteGPIO.listen(), see AgentRequestHandler
+        async def serve():
+            server = await asyncio.start_server(lambda reader, writer: self.handle_agent(remote, reader, writer), host, port)
+            print(f"Accepting GPIO agents on {host}:{server.sockets[0].getsockname()[1]}")
+            async with server:
+                await server.serve_forever()
+        self.spawn(serve)
+
+    async def handle_agent(self, remote, reader, writer):
+        address = writer.get_extra_info("peername")
+        node = None
+        try:
+            while True:
+                raw = await reader.readline()
+                if not raw:
+                    break
+                node, reply = remote.receive(node, raw, address)
+                if reply:
+                    writer.write(reply)
+                    await writer.drain()
+        except (OSError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+        if node is not None:
+            # Last known values stay in place until the agent resyncs
+            print(f"Agent '{node}' disconnected")
+
+    def watch_pico(self, reader):
+        # PicoReader without its thread: frames are read when the device is readable
+        from picoserial import REOPEN_DELAY
+
+        async def watch():
+            loop = asyncio.get_running_loop()
+            reader.running = True
+            while reader.running:
+                try:
+                    reader.open()
+                    failed = loop.create_future()
+
+                    def readable():
+                        try:
+                            reader.read_frames()
+                        except (OSError, EOFError) as e:
+                            if not failed.done():
+                                failed.set_exception(e)
+
+                    loop.add_reader(reader.fd, readable)
+                    try:
+                        await failed
+                    finally:
+                        loop.remove_reader(reader.fd)
+                except (OSError, EOFError) as e:
+                    if reader.running:
+                        print(f"Pico serial {reader.device} unavailable: {e}, retrying")
+                finally:
+                    reader.close()
+                await asyncio.sleep(REOPEN_DELAY)
+        self.spawn(watch)
+
+
+class AsyncStateServer(StateProtocol):
+    # StateServer as a task on an AsyncRuntime, same protocol. Subscribers
+    # that fall max_pending messages behind are dropped like there.
+    def __init__(self, runtime, layout, host="127.0.0.1", port=DEFAULT_STATE_PORT, max_pending=1000, monitor=None):
+        self.runtime = runtime
+        self.layout = layout
+        self.monitor = monitor
+        self.host = host
+        self.port = port
+        self.max_pending = max_pending
+        self.subscribers = set()
+        self.server_address = None
+        runtime.spawn(self.serve)
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port, reuse_address=True)
+        self.server_address = server.sockets[0].getsockname()
+        print(f"State server on {self.host}:{self.server_address[1]}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                raw = await reader.readline()
+                if not raw:
+                    break
+                command, reply = self.reply(raw)
+                if command == "subscribe":
+                    await self.stream(writer)
+                    break
+                await self.send(writer, reply)
+        except (OSError, ValueError):
+            # Client went away or sent an overlong line
+            pass
+        except asyncio.CancelledError:
+            # The runtime is stopping
+            pass
+        finally:
+            writer.close()
+
+    async def stream(self, writer):
+        # Subscribed before the snapshot is built, so no change falls in between
+        messages = asyncio.Queue()
+        self.subscribers.add(messages)
+        try:
+            await self.send(writer, self.state_message())
+            while True:
+                message = await messages.get()
+                if message is None:
+                    await self.send(writer, {"type": "error", "error": "client too slow, unsubscribed"})
+                    break
+                await self.send(writer, message)
+        finally:
+            self.subscribers.discard(messages)
+
+    async def send(self, writer, message):
+        writer.write(json.dumps(message).encode() + b"\n")
+        await writer.drain()
+
+    def publish(self, rect):
+        # From any thread, the message is built now and delivered on the loop
+        self.runtime.call_soon(self.deliver, self.signal_message(rect))
+
+    def deliver(self, message):
+        for messages in list(self.subscribers):
+            if messages.qsize() >= self.max_pending:
+                self.subscribers.discard(messages)
+                messages.put_nowait(None)
+            else:
+                messages.put_nowait(message)
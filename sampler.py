@@ -0,0 +1,362 @@
+import multiprocessing
+import os
+import zlib
+from multiprocessing import shared_memory
+from threading import Thread, Lock
+from time import monotonic, sleep
+
+from core import GPIO, init_gpio
+
+# Seconds between two reads of all pins in the sampler process
+SAMPLER_INTERVAL = .01
+# How long start() waits for the first sample before giving up, in seconds
+SAMPLER_START_TIMEOUT = 10.0
+# A dead sampler process is restarted after this many seconds, doubling with
+# every exit up to SAMPLER_MAX_RESTART_DELAY. A process that ran longer than
+# that before exiting starts the backoff over.
+SAMPLER_RESTART_DELAY = 1.0
+SAMPLER_MAX_RESTART_DELAY = 30.0
+
+# Shared memory layout, native byte order:
+#   0         uint64    sequence, odd while the sampler writes, +2 per update
+#   8         uint32    pin count
+#   12        uint32    samples taken, wraps, only a sign of life
+#   16        uint32    CRC32 of the counters and pin states
+#   20        uint32    unused
+#   24        uint32[n] change counter per pin, in the order given at start
+#   24 + 4n   n bits    pin states, LSB first like the Pico frames
+HEADER_SIZE = 24
+
+
+def state_size(count):
+    return HEADER_SIZE + 4 * count + (count + 7) // 8
+
+
+class SharedPinState:
+    # The pin bitmap and change counters in shared memory. One process writes
+    # (publish), any number read (snapshot). Readers take no lock: they retry
+    # while the sequence is odd or moved during the copy, like a seqlock.
+    # Python can't issue memory barriers, so on a weakly ordered CPU like the
+    # Pi 4's a reader may see the sequence unchanged next to a half written
+    # update. The CRC32 written with every update catches those copies.
+    def __init__(self, name=None, count=0):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=state_size(count))
+            self.shm.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        buf = self.shm.buf
+        self.sequence = buf[0:8].cast("Q")
+        self.info = buf[8:HEADER_SIZE].cast("I")
+        if name is None:
+            self.info[0] = count
+        self.count = self.info[0]
+        self.data = buf[HEADER_SIZE:state_size(self.count)]
+        self.counters = self.data[:4 * self.count].cast("I")
+        self.bitmap = self.data[4 * self.count:]
+        if name is None:
+            self.info[2] = zlib.crc32(self.data)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def publish(self, changes, first=False):
+        # changes is a list of (index, value). The first sample of a run only
+        # sets the states, counters count changes seen by the sampler.
+        sequence = self.sequence
+        counters = self.counters
+        bitmap = self.bitmap
+        sequence[0] += 1
+        for index, value in changes:
+            byte, bit = divmod(index, 8)
+            if value:
+                bitmap[byte] |= 1 << bit
+            else:
+                bitmap[byte] &= ~(1 << bit) & 0xFF
+            if not first:
+                counters[index] = (counters[index] + 1) & 0xFFFFFFFF
+        self.info[2] = zlib.crc32(self.data)
+        sequence[0] += 1
+
+    def tick(self):
+        self.info[1] = (self.info[1] + 1) & 0xFFFFFFFF
+
+    def samples(self):
+        return self.info[1]
+
+    def snapshot(self):
+        # (sequence, counters, bitmap) from one consistent update
+        sequence = self.sequence
+        split = 4 * self.count
+        while True:
+            seq = sequence[0]
+            if seq & 1:
+                sleep(0)
+                continue
+            checksum = self.info[2]
+            data = bytes(self.data)
+            if sequence[0] == seq and zlib.crc32(data) == checksum:
+                return seq, memoryview(data)[:split].cast("I").tolist(), data[split:]
+
+    def close(self, unlink=False):
+        for view in (self.sequence, self.info, self.counters, self.bitmap, self.data):
+            view.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def run_sampler(name, pins, interval, backend, stop):
+    # Entry point of the sampler process. Exits on stop or when the main
+    # process is gone, so no sampler outlives the app.
+    init_gpio(backend)
+    state = SharedPinState(name)
+    parent = os.getppid()
+    try:
+        for pin in pins:
+            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+        high = GPIO.HIGH
+        values = [None] * len(pins)
+        deadline = monotonic()
+        while not stop.is_set() and os.getppid() == parent:
+            try:
+                snapshot = GPIO.read_snapshot(pins)
+            except Exception as e:
+                print(f"Sampler: error reading GPIO snapshot: {str(e)}")
+                snapshot = {}
+            changes = []
+            for index, pin in enumerate(pins):
+                value = snapshot.get(pin)
+                if value is not None and value != values[index]:
+                    changes.append((index, value == high))
+                    values[index] = value
+            if changes or not state.samples():
+                state.publish(changes, first=not state.samples())
+            state.tick()
+
+            # Fixed rate from the previous deadline, skipping cycles if late
+            deadline += interval
+            now = monotonic()
+            if deadline < now:
+                deadline = now
+            stop.wait(deadline - now)
+    finally:
+        state.close()
+
+
+def backend_name():
+    # The init_gpio() name of the backend in use, for the sampler process
+    return {"MockGPIO": "mock", "GpiodGPIO": "gpiod"}.get(type(init_gpio()).__name__, "rpi")
+
+
+class ProcessSampler:
+    # Samples the local pins in a separate process, so pin timing doesn't
+    # depend on Tk redraws or dialogs in this one, and another core does the
+    # reading. Here it acts as a GPIO backend for GpioMonitor: read_snapshot()
+    # and input() read the shared state, and check() raises edge callbacks for
+    # the pins whose change counters moved, from a watcher thread or from the
+    # runtime's event loop (start with watch=False). A changed pin set
+    # restarts the process with a new state block, so does an exit of the
+    # process, with backoff. Once the new one has sampled, every pin gets a
+    # callback so changes made while it was down or starting aren't missed.
+    # The process has its own GPIO backend, mock values set in this process
+    # (simulation, replay) are not seen by it.
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self, interval=SAMPLER_INTERVAL):
+        self.interval = interval
+        self.pins = ()
+        self.indexes = {}
+        self.state = None
+        self.process = None
+        self.stop_event = None
+        self.event_callbacks = {}
+        self.sequence = 0
+        self.counters = []
+        self.lock = Lock()
+        self.running = False
+        self.watcher = None
+        self.started = None
+        self.restart_at = None
+        self.restart_delay = SAMPLER_RESTART_DELAY
+        self.restarts = 0
+        self.last_exit = None
+        self.resync = False
+        # Pins of the newest start(), a process for them may still be starting
+        self.wanted = None
+        self.generation = 0
+
+    def start(self, pins, watch=True, block=False):
+        # A new process for a changed pin set is started and waited for on a
+        # thread of its own (block=False), the current one serves reads and
+        # callbacks until the new one has sampled
+        pins = tuple(sorted(pins))
+        with self.lock:
+            if pins == self.wanted:
+                return
+            self.wanted = pins
+            self.generation += 1
+            generation = self.generation
+        if block:
+            self.replace(pins, generation)
+        else:
+            Thread(target=self.replace, args=(pins, generation), name="sampler-start", daemon=True).start()
+        if not self.running:
+            self.running = True
+            if watch:
+                self.watcher = Thread(target=self.watch)
+                self.watcher.daemon = True
+                self.watcher.start()
+
+    def replace(self, pins, generation):
+        # Starts a process for pins and switches to it once its first sample,
+        # which holds the initial states, is in. Dropped if start() or stop()
+        # was called again meanwhile.
+        context = multiprocessing.get_context("spawn")
+        state = SharedPinState(count=len(pins))
+        stop_event = context.Event()
+        process = context.Process(target=run_sampler, name="gpio-sampler",
+                                  args=(state.name, pins, self.interval, backend_name(), stop_event))
+        process.daemon = True
+        process.start()
+        deadline = monotonic() + SAMPLER_START_TIMEOUT
+        while not state.samples() and process.is_alive() and monotonic() < deadline and self.generation == generation:
+            sleep(.005)
+        with self.lock:
+            current = self.generation == generation
+            if current:
+                old = (self.process, self.stop_event, self.state)
+                self.process, self.stop_event, self.state = process, stop_event, state
+                self.pins = pins
+                self.indexes = {pin: index for index, pin in enumerate(pins)}
+                self.started = monotonic()
+                self.restart_at = None
+                self.sequence = 0
+                self.counters = [0] * len(pins)
+                # Every pin gets a callback once the first sample is in
+                self.resync = True
+            else:
+                old = (process, stop_event, state)
+        self.stop_process(*old)
+        if current:
+            if state.samples():
+                print(f"Sampling {len(pins)} GPIO pins in process {process.pid}")
+            else:
+                print("Sampler process did not report any samples yet")
+
+    def stop(self):
+        self.running = False
+        if self.watcher and self.watcher.is_alive():
+            self.watcher.join(timeout=1)
+        with self.lock:
+            self.generation += 1
+            self.wanted = None
+            old = (self.process, self.stop_event, self.state)
+            self.process = self.stop_event = self.state = None
+        self.stop_process(*old)
+
+    def stop_process(self, process, stop_event, state):
+        if process is not None:
+            # A killed process can die holding the event's lock, set() would hang
+            if process.is_alive():
+                stop_event.set()
+            process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+        if state is not None:
+            state.close(unlink=True)
+
+    def watch(self):
+        while self.running:
+            sleep(self.interval)
+            self.check()
+
+    def check(self):
+        restart = None
+        with self.lock:
+            if self.process is None:
+                return
+            if not self.process.is_alive():
+                restart = self.restart()
+                changed = []
+            elif self.resync:
+                if not self.state.samples():
+                    return
+                self.resync = False
+                self.sequence, self.counters, _ = self.state.snapshot()
+                changed = list(self.pins)
+            else:
+                changed = self.poll_changes()
+        if restart is not None:
+            Thread(target=self.replace, args=(self.pins, restart), name="sampler-start", daemon=True).start()
+        for pin in changed:
+            callback = self.event_callbacks.get(pin)
+            if callback:
+                try:
+                    callback(pin)
+                except Exception as e:
+                    print(f"Error in callback for GPIO {pin}: {str(e)}")
+
+    def restart(self):
+        # Call with the lock, once per check() while the process is dead.
+        # Returns the generation to start a new process for once it is time.
+        now = monotonic()
+        if self.restart_at is None:
+            if now - self.started > SAMPLER_MAX_RESTART_DELAY:
+                self.restart_delay = SAMPLER_RESTART_DELAY
+            self.last_exit = self.process.exitcode
+            self.restart_at = now + self.restart_delay
+            print(f"Sampler process exited with code {self.last_exit}, restarting in {self.restart_delay:g} s")
+            return None
+        if now < self.restart_at:
+            return None
+        # Until replace() switches over
+        self.restart_at = float("inf")
+        self.restart_delay = min(self.restart_delay * 2, SAMPLER_MAX_RESTART_DELAY)
+        self.restarts += 1
+        self.generation += 1
+        return self.generation
+
+    def poll_changes(self):
+        # Pins whose counters moved since the last call, call with the lock.
+        # Reading the sequence alone is enough to see that nothing changed.
+        if self.state.sequence[0] == self.sequence:
+            return []
+        self.sequence, counters, _ = self.state.snapshot()
+        changed = [pin for pin, new, old in zip(self.pins, counters, self.counters) if new != old]
+        self.counters = counters
+        return changed
+
+    def read_snapshot(self, pins):
+        with self.lock:
+            if self.state is None:
+                return {}
+            _, _, bitmap = self.state.snapshot()
+        indexes = self.indexes
+        return {pin: bitmap[indexes[pin] // 8] >> (indexes[pin] % 8) & 1 for pin in pins if pin in indexes}
+
+    def input(self, pin):
+        return self.read_snapshot([pin]).get(pin, self.LOW)
+
+    def add_event_detect(self, pin, callback, bouncetime=None):
+        self.event_callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.event_callbacks.pop(pin, None)
+
+    def stats(self):
+        with self.lock:
+            if self.state is None:
+                return {"pins": 0, "running": False}
+            _, counters, _ = self.state.snapshot()
+            return {
+                "pins": len(self.pins),
+                "running": self.process.is_alive(),
+                "pid": self.process.pid,
+                "samples": self.state.samples(),
+                "changes": sum(counters),
+                "restarts": self.restarts,
+                "last_exit": self.last_exit
+            }
@@ -0,0 +1,213 @@
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from core import GPIO, Layout, GpioMonitor, MockGPIO, init_gpio, read_compiled_layout
+
+
+class SectionGraph:
+    # Rectangles are the sections, adjacency is stored CSR style: the
+    # neighbours of section i are indices[indptr[i]:indptr[i + 1]]
+    def __init__(self, names, pins, indptr, indices):
+        self.names = names
+        self.pins = pins
+        self.indptr = indptr
+        self.indices = indices
+        self.degree = np.diff(indptr)
+
+    def __len__(self):
+        return len(self.names)
+
+
+def compile_section_graph(compiled):
+    # Builds the graph from compiled layout rows (see core.compile_layout).
+    # Points are not sections, a line through a point joins the rectangles on
+    # either side of it.
+    if np is None:
+        raise RuntimeError("The train simulator needs numpy (pip3 install numpy)")
+
+    rect_rows, point_rows, line_rows = compiled
+    names = [row[0] for row in rect_rows]
+    section_index = {name: i for i, name in enumerate(names)}
+
+    links = {}
+    for _, start, end, _ in line_rows:
+        links.setdefault(start, set()).add(end)
+        links.setdefault(end, set()).add(start)
+
+    indptr = [0]
+    indices = []
+    for name in names:
+        neighbours = set()
+        seen = {name}
+        pending = list(links.get(name, ()))
+        while pending:
+            shape = pending.pop()
+            if shape in seen:
+                continue
+            seen.add(shape)
+            if shape in section_index:
+                neighbours.add(section_index[shape])
+            else:
+                pending.extend(links.get(shape, ()))
+        indices.extend(sorted(neighbours))
+        indptr.append(len(indices))
+
+    # Remote "node:pin" pins are left alone, the mock GPIO only has local ones
+    pins = np.array([row[5] if isinstance(row[5], int) else -1 for row in rect_rows], dtype=np.int64)
+    return SectionGraph(names, pins, np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int64))
+
+
+class TrainSimulator:
+    # Moves trains through the section graph one tick at a time, all trains at
+    # once with numpy. A train waits a random dwell time in a section, then
+    # moves to a free neighbour, avoiding the section it came from unless it is
+    # at a dead end. The occupancy is written to the mock GPIO pins in bulk.
+    def __init__(self, graph, trains=100, tick=0.1, dwell=(2.0, 10.0), seed=0):
+        self.graph = graph
+        self.tick = tick
+        self.dwell = dwell
+        self.rng = np.random.default_rng(seed)
+        self.time = 0.0
+        self.moves = 0
+
+        trains = min(trains, len(graph))
+        self.positions = self.rng.choice(len(graph), trains, replace=False)
+        self.previous = np.full(trains, -1, dtype=np.int64)
+        self.remaining = self.rng.uniform(dwell[0], dwell[1], trains)
+        self.occupancy = np.zeros(len(graph), dtype=bool)
+        self.occupancy[self.positions] = True
+
+        # Several sections can share a pin, a pin is HIGH if any of them is occupied
+        wired = graph.pins >= 0
+        self.wired_sections = np.flatnonzero(wired)
+        self.pin_numbers, self.pin_slots = np.unique(graph.pins[wired], return_inverse=True)
+        self.pin_values = np.zeros(len(self.pin_numbers), dtype=bool)
+        self.written = False
+
+    def step(self):
+        graph = self.graph
+        self.time += self.tick
+        self.remaining -= self.tick
+
+        ready = np.flatnonzero(self.remaining <= 0)
+        ready = ready[graph.degree[self.positions[ready]] > 0]
+        if len(ready):
+            current = self.positions[ready]
+            degree = graph.degree[current]
+            choice = self.rng.integers(0, degree)
+            targets = graph.indices[graph.indptr[current] + choice]
+
+            # Don't turn back unless there is nowhere else to go
+            back = (targets == self.previous[ready]) & (degree > 1)
+            choice[back] = (choice[back] + 1) % degree[back]
+            targets = graph.indices[graph.indptr[current] + choice]
+
+            # Trains wait for occupied sections, two trains heading for the
+            # same free section: the first one gets it, the other retries
+            free = ~self.occupancy[targets]
+            targets, first = np.unique(targets[free], return_index=True)
+            movers = ready[free][first]
+
+            self.occupancy[self.positions[movers]] = False
+            self.occupancy[targets] = True
+            self.previous[movers] = self.positions[movers]
+            self.positions[movers] = targets
+            self.remaining[movers] = self.rng.uniform(self.dwell[0], self.dwell[1], len(movers))
+            self.moves += len(movers)
+
+    def write_gpio(self):
+        occupied = self.occupancy[self.wired_sections]
+        values = np.bincount(self.pin_slots, weights=occupied, minlength=len(self.pin_numbers)) > 0
+        changed = np.flatnonzero(values != self.pin_values) if self.written else np.arange(len(values))
+        self.pin_values = values
+        self.written = True
+        if len(changed):
+            GPIO.set_mock_values({
+                int(self.pin_numbers[slot]): GPIO.HIGH if values[slot] else GPIO.LOW
+                for slot in changed
+            })
+        return len(changed)
+
+    def run(self, ticks, speed=None):
+        # speed=None runs as fast as possible, otherwise ticks are paced so
+        # that simulated time runs speed times faster than the wall clock
+        backend = init_gpio()
+        if not isinstance(backend, MockGPIO) and not backend.simulating:
+            raise RuntimeError(f"The train simulator needs the mock GPIO backend or simulation mode, "
+                               f"{type(backend).__name__} reads the real pins")
+        start = time.perf_counter()
+        start_moves = self.moves
+        start_time = self.time
+        pin_writes = 0
+        for tick in range(ticks):
+            self.step()
+            pin_writes += self.write_gpio()
+            if speed:
+                delay = start + (tick + 1) * self.tick / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        wall_time = time.perf_counter() - start
+        return {
+            "ticks": ticks,
+            "trains": len(self.positions),
+            "sections": len(self.graph),
+            "moves": self.moves - start_moves,
+            "pin_writes": pin_writes,
+            "simulated_s": self.time - start_time,
+            "wall_s": wall_time,
+            "ticks_per_s": ticks / wall_time if wall_time > 0 else None,
+            "speedup": (self.time - start_time) / wall_time if wall_time > 0 else None
+        }
+
+    def occupied_sections(self):
+        return [self.graph.names[i] for i in np.flatnonzero(self.occupancy)]
+
+
+def print_report(report):
+    print(f"{report['trains']} trains on {report['sections']} sections: {report['ticks']} ticks, "
+          f"{report['moves']} moves, {report['pin_writes']} pin writes in {report['wall_s']:.3f} s")
+    if report["ticks_per_s"]:
+        print(f"{report['ticks_per_s']:.0f} ticks/s, {report['speedup']:.1f}x real time")
+
+
+if __name__ == "__main__":
+    # python3 trainsim.py [--load=qq.json] [--trains=100] [--ticks=1000] [--speed=N|max] [--seed=N]
+    layout_file = "qq.json"
+    trains = 100
+    ticks = 1000
+    speed = None
+    seed = 0
+
+    for arg in sys.argv[1:]:
+        if arg.startswith("--load="):
+            layout_file = arg.split("=")[1]
+        elif arg.startswith("--trains="):
+            trains = int(arg.split("=")[1])
+        elif arg.startswith("--ticks="):
+            ticks = int(arg.split("=")[1])
+        elif arg.startswith("--speed="):
+            value = arg.split("=")[1]
+            speed = None if value in ("max", "0") else float(value)
+        elif arg.startswith("--seed="):
+            seed = int(arg.split("=")[1])
+
+    layout = Layout()
+    layout.load(layout_file)
+    monitor = GpioMonitor(layout, edge_events="--poll" not in sys.argv)
+
+    # Without a UI the simulator thread is the only one changing the layout
+    monitor.add_listener(lambda pin, value: layout.apply_pin_states({pin: value}))
+    monitor.start()
+
+    simulator = TrainSimulator(compile_section_graph(read_compiled_layout(layout_file)), trains, seed=seed)
+    report = simulator.run(ticks, speed)
+    monitor.sample()
+    monitor.stop()
+    print_report(report)
+    occupied = sorted(rect.name for rect in layout.rectangles.values() if rect.red_signal)
+    print(f"Occupied sections: {len(occupied)}")
@@ -0,0 +1,242 @@
+import asyncio
+import json
+from threading import Thread
+
+from core import DEFAULT_WEB_PORT, VISIBLE, coordinate
+
+# Seconds a client may take to accept a batch before it is disconnected
+CLIENT_TIMEOUT = 10.0
+# Idle clients get a comment this often, so dead connections are noticed
+KEEPALIVE_INTERVAL = 15.0
+# Longest request line or header accepted, in bytes
+MAX_REQUEST_LINE = 8192
+
+# Draws like Rectangle.create_items, without the connection points
+VIEWER_PAGE = b"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Layout viewer</title>
+<style>body{margin:0;background:#fff}#status{font:12px sans-serif;position:fixed;right:8px;top:4px;color:#888}</style>
+</head><body><div id="status">connecting</div><canvas id="view"></canvas>
+<script>
+const canvas = document.getElementById("view"), ctx = canvas.getContext("2d");
+const status = document.getElementById("status");
+const COLORS = [[1, "red"], [2, "blue"], [4, "yellow"]];
+let layout = null;
+
+function drawRect(i) {
+  const [name, x, y, w, h] = layout.rectangles[i], bits = layout.signals[i];
+  ctx.fillStyle = "lightblue"; ctx.strokeStyle = "black"; ctx.lineWidth = 1;
+  ctx.fillRect(x, y, w, h); ctx.strokeRect(x + .5, y + .5, w, h);
+  ctx.fillStyle = "black"; ctx.font = "10pt Arial"; ctx.textBaseline = "top";
+  ctx.fillText(name, x + 5, y + 5);
+  const boxHeight = (h - 20) / 3, boxX = x + w - 35;
+  COLORS.forEach(([bit, color], k) => {
+    ctx.fillStyle = bits & bit ? color : "gray";
+    ctx.fillRect(boxX, y + 10 + k * boxHeight, 30, boxHeight);
+  });
+}
+
+function drawAll() {
+  let width = 800, height = 600;
+  for (const [, x, y, w, h] of layout.rectangles) { width = Math.max(width, x + w + 10); height = Math.max(height, y + h + 10); }
+  canvas.width = width; canvas.height = height;
+  ctx.strokeStyle = "red"; ctx.lineWidth = 2;
+  for (const [x1, y1, x2, y2] of layout.lines) { ctx.beginPath(); ctx.moveTo(x1, y1); ctx.lineTo(x2, y2); ctx.stroke(); }
+  ctx.fillStyle = "black";
+  for (const [x, y] of layout.points) { ctx.beginPath(); ctx.arc(x, y, 3, 0, 2 * Math.PI); ctx.fill(); }
+  layout.rectangles.forEach((_, i) => drawRect(i));
+}
+
+const events = new EventSource("/events");
+events.addEventListener("layout", e => { layout = JSON.parse(e.data); drawAll(); status.textContent = "live"; });
+events.addEventListener("delta", e => {
+  const delta = JSON.parse(e.data);
+  for (let k = 0; k < delta.length; k += 2) { layout.signals[delta[k]] = delta[k + 1]; drawRect(delta[k]); }
+});
+// The browser reconnects by itself and gets the full layout again
+events.onerror = () => { status.textContent = "reconnecting"; };
+</script></body></html>
+"""
+
+
+class ViewerClient:
+    def __init__(self, writer):
+        self.writer = writer
+        # Rectangle index -> newest signal bits not sent yet
+        self.pending = {}
+        self.needs_layout = True
+        self.wake = asyncio.Event()
+
+
+class WebViewer:
+    # Read-only browser view of the layout, for extra displays without a Pi
+    # running the whole app. HTTP on port (default 8080):
+    #   GET /             the viewer page
+    #   GET /layout.json  what the layout event carries
+    #   GET /events       server-sent events:
+    #     layout  {"version": 3, "rectangles": [[name, x, y, width, height], ...],
+    #              "points": [[x, y], ...], "lines": [[x1, y1, x2, y2], ...],
+    #              "signals": [bits, ...]}
+    #     delta   [index, bits, index, bits, ...]
+    # bits are the store's signal bits (red 1, blue 2, yellow 4), indexes point
+    # into the last layout's rectangles. A client gets the layout on connect
+    # and after edits, otherwise only deltas, so the traffic follows the
+    # changes and not viewers x layout size.
+    # Each client keeps the newest bits per rectangle it wasn't sent yet and
+    # gets them as one batch once its socket has drained, so a slow client
+    # costs at most one entry per rectangle. One that doesn't drain within
+    # CLIENT_TIMEOUT is dropped, its browser reconnects and starts over.
+    # refresh() and publish() are called by the thread that owns the layout,
+    # the clients are served by an AsyncRuntime (runtime.py), a private one
+    # on its own thread unless one is passed in.
+    def __init__(self, layout, host="0.0.0.0", port=DEFAULT_WEB_PORT, runtime=None):
+        from runtime import AsyncRuntime
+        self.layout = layout
+        self.host = host
+        self.port = port
+        self.own_runtime = runtime is None
+        self.runtime = runtime or AsyncRuntime()
+        self.indexes = {}
+        self.version = 0
+        # Loop side: the current layout message and signal bits per rectangle
+        self.shapes = None
+        self.signals = []
+        self.clients = set()
+        self.server_address = None
+        self.bytes_sent = 0
+
+        self.refresh()
+        self.runtime.spawn(self.serve)
+        if self.own_runtime:
+            Thread(target=self.runtime.run, name="web-viewer", daemon=True).start()
+
+    def close(self):
+        if self.own_runtime:
+            self.runtime.stop()
+
+    def refresh(self):
+        # Call after shapes were added, moved or removed, resends the layout
+        store = self.layout.store
+        x, y, width, height = store.x, store.y, store.width, store.height
+        flags, signals = store.flags, store.signals
+        rects = list(self.layout.rectangles.values())
+        self.indexes = {rect.name: index for index, rect in enumerate(rects)}
+        self.version += 1
+        shapes = {
+            "version": self.version,
+            "rectangles": [
+                [rect.name, coordinate(x[rect.row]), coordinate(y[rect.row]),
+                 coordinate(width[rect.row]), coordinate(height[rect.row])]
+                for rect in rects
+            ],
+            "points": [
+                [coordinate(x[point.row]), coordinate(y[point.row])]
+                for point in self.layout.points.values() if flags[point.row] & VISIBLE
+            ],
+            "lines": [
+                [coordinate(line.x1), coordinate(line.y1), coordinate(line.x2), coordinate(line.y2)]
+                for line in self.layout.lines.values()
+            ]
+        }
+        self.runtime.call_soon(self.set_layout, shapes, [signals[rect.row] for rect in rects])
+
+    def publish(self, rects):
+        # Call after the signals of rects changed
+        signals = self.layout.store.signals
+        changes = [(self.indexes[rect.name], signals[rect.row]) for rect in rects if rect.name in self.indexes]
+        if changes:
+            self.runtime.call_soon(self.deliver, changes)
+
+    def set_layout(self, shapes, signals):
+        self.shapes = shapes
+        self.signals = signals
+        for client in self.clients:
+            client.needs_layout = True
+            client.pending.clear()
+            client.wake.set()
+
+    def deliver(self, changes):
+        signals = self.signals
+        for index, bits in changes:
+            signals[index] = bits
+        for client in self.clients:
+            if client.needs_layout:
+                continue
+            for index, bits in changes:
+                client.pending[index] = bits
+            client.wake.set()
+
+    def layout_message(self):
+        return dict(self.shapes, signals=self.signals)
+
+    def stats(self):
+        return {"clients": len(self.clients), "version": self.version, "bytes_sent": self.bytes_sent}
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port, reuse_address=True, limit=MAX_REQUEST_LINE)
+        self.server_address = server.sockets[0].getsockname()
+        print(f"Web viewer on http://{self.host}:{self.server_address[1]}/")
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            request = (await reader.readline()).decode("latin-1").split()
+            # Headers carry nothing needed here, but have to be read
+            while (await reader.readline()).strip():
+                pass
+            if len(request) < 2 or request[0] != "GET":
+                await self.respond(writer, "405 Method Not Allowed", "text/plain", b"Only GET is supported\n")
+                return
+            path = request[1].split("?")[0]
+            if path == "/":
+                await self.respond(writer, "200 OK", "text/html; charset=utf-8", VIEWER_PAGE)
+            elif path == "/layout.json":
+                await self.respond(writer, "200 OK", "application/json", json.dumps(self.layout_message()).encode())
+            elif path == "/events":
+                await self.stream(writer)
+            else:
+                await self.respond(writer, "404 Not Found", "text/plain", b"Not found\n")
+        except (OSError, ValueError, asyncio.TimeoutError):
+            # Client went away, sent garbage or stopped reading
+            pass
+        except asyncio.CancelledError:
+            # The runtime is stopping
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, content_type, body):
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + body)
+        self.bytes_sent += len(body)
+        await asyncio.wait_for(writer.drain(), CLIENT_TIMEOUT)
+
+    async def stream(self, writer):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Connection: keep-alive\r\n\r\n")
+        client = ViewerClient(writer)
+        self.clients.add(client)
+        try:
+            while True:
+                if client.needs_layout:
+                    client.needs_layout = False
+                    self.send_event(writer, "layout", self.layout_message())
+                elif client.pending:
+                    pending = client.pending
+                    client.pending = {}
+                    self.send_event(writer, "delta", [value for change in pending.items() for value in change])
+                else:
+                    try:
+                        await asyncio.wait_for(client.wake.wait(), KEEPALIVE_INTERVAL)
+                    except asyncio.TimeoutError:
+                        writer.write(b": keepalive\n\n")
+                    client.wake.clear()
+                # Everything coming in while this waits is merged into the next batch
+                await asyncio.wait_for(writer.drain(), CLIENT_TIMEOUT)
+        finally:
+            self.clients.discard(client)
+
+    def send_event(self, writer, event, data):
+        payload = f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+        self.bytes_sent += len(payload)
+        writer.write(payload)